@@ -0,0 +1,110 @@
+import torch
+import importlib
+import copy
+import multiprocessing
+
+from model_defs.TDID import TDID
+from utils import *
+
+
+def detect_image(net, img_data, target_embeddings, img_info, score_thresh):
+    """
+    Detect the targets in one scene image, the way test_net does.
+
+    Input parameters:
+        net: (TDID) the network
+        img_data: (torch Variable) 1x3xHxW scene image
+        target_embeddings: (tuple) stacked embeddings of the targets
+        img_info: (tuple) scene image shape
+        score_thresh: (float) proposal score threshold
+    """
+    with torch.no_grad():
+        img_features = net.features(img_data)
+        net.detect(img_features, target_embeddings, img_info,
+                   score_thresh=score_thresh)
+
+
+def benchmark_cpu_inference(cfg, img_size=(540,960), target_size=(80,80),
+                            num_targets=4, thread_counts=None, num_iters=5):
+    """
+    Images per second of cpu inference, with and without the cpu profile.
+
+    Every setting runs the same weights: the feature net of one scene image,
+    then detect with num_targets target embeddings computed beforehand.
+    Profiles are eager (the network as trained), channels last, and
+    channels last with the feature net frozen and its conv weights
+    pre-packed (TDID.optimize_for_cpu_inference).
+
+    Input parameters:
+        cfg: (Config) the network config, cfg.DEVICE is ignored
+
+        img_size (optional): (tuple) HxW of the scene image.
+                             Default: (540,960)
+        target_size (optional): (tuple) hxw of the target images.
+                                Default: (80,80)
+        num_targets (optional): (int) targets detected per image. Default: 4
+        thread_counts (optional): (list of int) intra op thread counts,
+                                  None for 1 and every core. Default: None
+        num_iters (optional): (int) timed images per setting. Default: 5
+    """
+    if thread_counts is None:
+        thread_counts = sorted(set([1, multiprocessing.cpu_count()]))
+    profiles = [('eager', False, False),
+                ('channels last', True, False),
+                ('channels last + prepack', True, True)]
+
+    base_net = TDID(cfg)
+    base_net.eval()
+    img_data = torch.rand(1, 3, *img_size)
+    target_data = torch.rand(num_targets*cfg.NUM_TARGETS, 3, *target_size)
+    img_info = (img_size[0], img_size[1], 3)
+
+    print('{} feature net, {}x{} image, {} targets, {} cores'.format(
+              cfg.FEATURE_NET_NAME, img_size[1], img_size[0], num_targets,
+              multiprocessing.cpu_count()))
+    print('threads  profile                   ms/img  img/s  speedup  '
+          'max_abs_diff')
+    ref_features = None
+    for num_threads in thread_counts:
+        torch.set_num_threads(num_threads)
+        base_time = None
+        for name, channels_last, prepack in profiles:
+            net = copy.deepcopy(base_net)
+            if channels_last or prepack:
+                net.cfg = copy.copy(cfg)
+                net.cfg.CPU_INTRA_OP_THREADS = num_threads
+                net.cfg.CPU_CHANNELS_LAST = channels_last
+                net.cfg.CPU_PREPACK_WEIGHTS = prepack
+                net.optimize_for_cpu_inference()
+            with torch.no_grad():
+                target_embeddings = net.encode_targets(target_data)
+                features = net.features(img_data)
+            if ref_features is None:
+                ref_features = features
+            max_diff = (features - ref_features).abs().max().item()
+
+            t = Timer()
+            detect_image(net, img_data, target_embeddings, img_info,
+                         cfg.SCORE_THRESH)
+            for _ in range(num_iters):
+                t.tic()
+                detect_image(net, img_data, target_embeddings, img_info,
+                             cfg.SCORE_THRESH)
+                t.toc()
+            if base_time is None:
+                base_time = t.average_time
+            print('{:7d}  {:24s}  {:6.1f}  {:5.2f}  {:7.2f}  {:.2e}'.format(
+                      num_threads, name, 1000*t.average_time, 
+                      1/t.average_time, base_time/t.average_time, max_diff))
+
+
+
+if __name__ == '__main__':
+
+    #load config file
+    cfg_file = 'configAVD1' #NO EXTENSTION!
+    cfg = importlib.import_module('configs.'+cfg_file)
+    cfg = cfg.Config()
+
+    set_cpu_threads(0, cfg.CPU_INTER_OP_THREADS)
+    benchmark_cpu_inference(cfg)
@@ -0,0 +1,122 @@
+import numpy as np
+
+from model_defs.nms import nms_wrapper
+from utils import Timer
+
+
+def random_dets(num_boxes, img_size=(540,960), seed=0):
+    """
+    Random proposal like boxes, clustered so that many of them overlap.
+
+    Input parameters:
+        num_boxes: (int) number of boxes
+
+        img_size (optional): (tuple) image height, width. Default: (540,960)
+        seed (optional): (int) random seed. Default: 0
+
+    Returns:
+        (ndarray) num_boxesx5 float32 boxes and scores
+    """
+    rng = np.random.RandomState(seed)
+    num_clusters = max(1, int(num_boxes/20))
+    centers = rng.rand(num_clusters, 2) * [img_size[1], img_size[0]]
+    ctrs = centers[rng.randint(num_clusters, size=num_boxes)]
+    ctrs += rng.randn(num_boxes, 2) * 8
+    sizes = rng.uniform(16, 256, size=(num_boxes, 2))
+    dets = np.zeros((num_boxes, 5), dtype=np.float32)
+    dets[:, :2] = np.maximum(0, ctrs - sizes/2)
+    dets[:, 2] = np.minimum(img_size[1] - 1, ctrs[:, 0] + sizes[:, 0]/2)
+    dets[:, 3] = np.minimum(img_size[0] - 1, ctrs[:, 1] + sizes[:, 1]/2)
+    dets[:, 4] = rng.rand(num_boxes)
+    return dets
+
+
+def benchmark_nms(num_boxes_list=[300,2000,6000], max_keep_list=[0,300,5],
+                  thresh=.7, num_iters=20):
+    """
+    Time every available nms backend, and check they keep the same boxes.
+
+    Input parameters:
+        num_boxes_list (optional): (list of int) Default: [300,2000,6000]
+        max_keep_list (optional): (list of int) max boxes to keep, 0 for 
+                                  all. Default: [0,300,5], (all, proposals,
+                                  final detections)
+        thresh (optional): (float) IoU threshold. Default: .7
+        num_iters (optional): (int) timed calls per setting. Default: 20
+    """
+    backends = nms_wrapper.available_backends()
+    print('backends: {}'.format(', '.join(backends)))
+    print('num_boxes  max_keep  backend  time(ms)  num_kept  same_as_numpy')
+    for num_boxes in num_boxes_list:
+        dets = random_dets(num_boxes)
+        for max_keep in max_keep_list:
+            reference = nms_wrapper.nms(dets, thresh, backend='numpy',
+                                        max_keep=max_keep)
+            for backend in backends:
+                keep = nms_wrapper.nms(dets, thresh, backend=backend,
+                                       max_keep=max_keep)
+                t = Timer()
+                for _ in range(num_iters):
+                    t.tic()
+                    nms_wrapper.nms(dets, thresh, backend=backend,
+                                    max_keep=max_keep)
+                    t.toc()
+                print('{:9d}  {:8d}  {:7s}  {:8.3f}  {:8d}  {}'.format(
+                          num_boxes, max_keep, backend, 1000*t.average_time,
+                          len(keep), np.array_equal(keep, reference)))
+            print('{:9d}  {:8d}  auto -> {}'.format(num_boxes, max_keep,
+                      nms_wrapper.choose_backend(num_boxes, 
+                                                 max_keep=max_keep)))
+
+
+
+def benchmark_batched_nms(num_groups_list=[5,28], num_boxes=300, 
+                          max_keep_list=[0,5], thresh=.7, num_iters=20):
+    """
+    Time batched_nms against one nms call per group (batch element/target).
+
+    Input parameters:
+        num_groups_list (optional): (list of int) Default: [5,28]
+        num_boxes (optional): (int) boxes per group. Default: 300
+        max_keep_list (optional): (list of int) max boxes to keep per group,
+                                  0 for all. Default: [0,5]
+        thresh (optional): (float) IoU threshold. Default: .7
+        num_iters (optional): (int) timed calls per setting. Default: 20
+    """
+    modes = ['exact']
+    if nms_wrapper.fast_nms is not None:
+        modes.append('matrix')
+    print('num_groups  max_keep  method     time(ms)  num_kept  same_as_loop')
+    for num_groups in num_groups_list:
+        dets = np.vstack([random_dets(num_boxes, seed=g) 
+                          for g in range(num_groups)])
+        group_ids = np.repeat(np.arange(num_groups), num_boxes)
+        for max_keep in max_keep_list:
+            def per_group():
+                return np.concatenate([num_boxes*g + nms_wrapper.nms(
+                                           dets[group_ids == g], thresh,
+                                           max_keep=max_keep)
+                                       for g in range(num_groups)])
+            reference = per_group()
+            methods = [('loop', per_group)]
+            for mode in modes:
+                methods.append((mode, lambda mode=mode: 
+                                nms_wrapper.batched_nms(dets, group_ids, 
+                                                        thresh, 
+                                                        max_keep=max_keep,
+                                                        mode=mode)))
+            for name, method in methods:
+                keep = method()
+                t = Timer()
+                for _ in range(num_iters):
+                    t.tic()
+                    method()
+                    t.toc()
+                print('{:10d}  {:8d}  {:7s}  {:8.3f}  {:8d}  {}'.format(
+                          num_groups, max_keep, name, 1000*t.average_time,
+                          len(keep), np.array_equal(keep, reference)))
+
+
+if __name__ == '__main__':
+    benchmark_nms()
+    benchmark_batched_nms()
@@ -0,0 +1,83 @@
+import numpy as np
+
+from model_defs.anchors import cython_bbox
+from model_defs.anchors.anchor_grid import AnchorGrid
+from model_defs.anchors.bbox_transform import bbox_transform_inv, clip_boxes
+from model_defs.anchors.workspace import Workspace
+from utils import Timer
+
+
+def benchmark_decode(height=34, width=60, batch_size=5, anchor_scales=[1,2,4],
+                     min_size=8, num_iters=20):
+    """
+    Time decoding, clipping and size filtering every anchor of a batch.
+
+    Compares the separate numpy steps (bbox_transform_inv, clip_boxes, then
+    a size mask) with the fused cython decode_clip_filter, and checks they
+    give the same boxes. The fused kernel uses expf, which can differ from
+    numpy's float32 exp in the last bit, so boxes are compared with a
+    small tolerance.
+
+    Input parameters:
+        height (optional): (int) feature map height. Default: 34
+        width (optional): (int) feature map width. Default: 60
+        batch_size (optional): (int) Default: 5
+        anchor_scales (optional): (list of int) 3 anchors per scale.
+                                  Default: [1,2,4], 9 anchors per cell
+        min_size (optional): (float) min box side. Default: 8
+        num_iters (optional): (int) timed calls per method. Default: 20
+    """
+    img_info = (height*16, width*16, 3)
+    grid = AnchorGrid(height, width, 16, anchor_scales, img_info)
+    anchors = grid.anchors
+    num_anchors = anchors.shape[0]
+    rng = np.random.RandomState(0)
+    deltas = (rng.randn(batch_size, num_anchors, 4)*.2).astype(np.float32)
+    inds = np.arange(num_anchors)
+
+    def numpy_steps():
+        boxes = bbox_transform_inv(anchors[np.newaxis].repeat(batch_size, 0),
+                                   deltas)
+        boxes = clip_boxes(boxes, img_info[:2])
+        ws = boxes[:,:, 2] - boxes[:,:, 0] + 1
+        hs = boxes[:,:, 3] - boxes[:,:, 1] + 1
+        keep = ~((ws < min_size) & (hs < min_size))
+        boxes[~keep] = 0
+        return boxes, keep
+
+    workspace = Workspace()
+    def fused():
+        boxes = workspace.get('boxes', deltas.shape)
+        keep = workspace.get('keep', deltas.shape[:2], np.uint8)
+        for batch_ind in range(batch_size):
+            cython_bbox.decode_clip_filter(anchors, deltas[batch_ind], inds,
+                                           img_info[0], img_info[1],
+                                           min_size, boxes[batch_ind],
+                                           keep[batch_ind])
+        return boxes, keep
+
+    ref_boxes, ref_keep = numpy_steps()
+    boxes, keep = fused()
+    print('{}x{} map, {} anchors per cell, batch {}, {} kernel threads'.format(
+              width, height, grid.num_base_anchors, batch_size,
+              cython_bbox.get_num_threads()))
+    print('same keep mask: {}, max box difference: {}'.format(
+              np.array_equal(ref_keep, keep.astype(bool)),
+              np.abs(ref_boxes - boxes).max()))
+
+    print('method       time(ms)  speedup')
+    base_time = None
+    for name, method in [('numpy steps', numpy_steps), ('fused', fused)]:
+        t = Timer()
+        for _ in range(num_iters):
+            t.tic()
+            method()
+            t.toc()
+        if base_time is None:
+            base_time = t.average_time
+        print('{:11s}  {:8.3f}  {:7.2f}'.format(name, 1000*t.average_time,
+                                                base_time/t.average_time))
+
+
+if __name__ == '__main__':
+    benchmark_decode()
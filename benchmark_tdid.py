@@ -0,0 +1,310 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+import importlib
+
+from model_defs.TDID import TDID
+from utils import *
+
+
+def loop_condition_on_targets(net, img_features, target_features):
+    """
+    Reference per batch element, per target type conditioning.
+
+    This is the python loop TDID.forward used before the batched
+    TDID.condition_on_targets. Kept here to check outputs and compare speed.
+
+    Input parameters:
+        net: (TDID) the network
+        img_features: (torch Variable) BxCxHxW scene image features
+        target_features: (torch Variable) (B*NUM_TARGETS)xCxhxw target features
+
+    Returns:
+        corrs: (torch Variable) Bx(NUM_TARGETS*C)xHxW
+        diffs: (torch Variable) Bx(NUM_TARGETS*C)xHxW
+    """
+    all_corrs = []
+    all_diffs = []
+    for batch_ind in range(img_features.size()[0]):
+        img_ind = np_to_variable(np.asarray([batch_ind]),
+                                 device=img_features.device, 
+                                 dtype=torch.LongTensor)
+        cur_img_feats = torch.index_select(img_features,0,img_ind)
+
+        cur_diffs = []
+        cur_corrs = []
+        for target_type in range(net.cfg.NUM_TARGETS):
+            target_ind = np_to_variable(np.asarray([batch_ind*
+                                        net.cfg.NUM_TARGETS+target_type]),
+                                        device=img_features.device,
+                                        dtype=torch.LongTensor)
+            cur_target_feats = torch.index_select(target_features,0,
+                                                  target_ind[0])
+            cur_target_feats = cur_target_feats.view(-1,1,
+                                                 cur_target_feats.size()[2],
+                                                 cur_target_feats.size()[3])
+            pooled_target_feats = F.max_pool2d(cur_target_feats,
+                                     (cur_target_feats.size()[2],
+                                      cur_target_feats.size()[3]))
+
+            cur_diffs.append(cur_img_feats -
+                pooled_target_feats.permute(1,0,2,3).expand_as(cur_img_feats))
+            if net.cfg.CORR_WITH_POOLED:
+                cur_corrs.append(F.conv2d(cur_img_feats,
+                                         pooled_target_feats,
+                                         groups=net.num_feature_channels))
+            else:
+                target_conv_padding = (max(0,int(
+                                      target_features.size()[2]/2)),
+                                       max(0,int(
+                                       target_features.size()[3]/2)))
+                cur_corrs.append(F.conv2d(cur_img_feats,cur_target_feats,
+                                         padding=target_conv_padding,
+                                         groups=net.num_feature_channels))
+
+        cur_corrs = torch.cat(cur_corrs,1)
+        cur_corrs = net.select_to_match_dimensions(cur_corrs,cur_img_feats)
+        all_corrs.append(cur_corrs)
+        all_diffs.append(torch.cat(cur_diffs,1))
+
+    return torch.cat(all_corrs,0), torch.cat(all_diffs,0)
+
+
+def time_function(fn, num_iters=20, num_warmup=3):
+    """
+    Average wall clock time of fn(), in seconds.
+
+    Waits for queued gpu work before starting and stopping the clock.
+    """
+    def synchronize():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    for _ in range(num_warmup):
+        fn()
+    synchronize()
+    t = Timer()
+    for _ in range(num_iters):
+        t.tic()
+        fn()
+        synchronize()
+        t.toc()
+    return t.average_time
+
+
+def benchmark_conditioning(net, batch_sizes=[1,2,4,8,16],
+                           img_feat_size=(34,60), target_feat_size=(5,5),
+                           num_iters=20):
+    """
+    Compare loop and batched target conditioning across batch sizes.
+
+    Input parameters:
+        net: (TDID) the network
+
+        batch_sizes (optional): (list of int) Default: [1,2,4,8,16]
+        img_feat_size (optional): (tuple) HxW of the scene feature map.
+                                  Default: (34,60), a 540x960 image
+        target_feat_size (optional): (tuple) hxw of the target feature map
+                                     Default: (5,5)
+        num_iters (optional): (int) timed calls per setting. Default: 20
+    """
+    num_channels = net.num_feature_channels
+    print('batch_size  loop(ms)  batched(ms)  speedup  max_abs_diff')
+    for batch_size in batch_sizes:
+        img_features = np_to_variable(np.random.rand(batch_size,
+                                      num_channels,
+                                      *img_feat_size).astype(np.float32),
+                                      device=net.device)
+        target_features = np_to_variable(np.random.rand(
+                                   batch_size*net.cfg.NUM_TARGETS,
+                                   num_channels,
+                                   *target_feat_size).astype(np.float32),
+                                   device=net.device)
+
+        loop_corrs, loop_diffs = loop_condition_on_targets(net, img_features,
+                                                           target_features)
+        corrs, diffs = net.condition_on_targets(img_features,
+                                   net.encode_targets(target_features,
+                                                      features_given=True))
+        max_diff = max((loop_corrs - corrs).abs().max().data.item(),
+                       (loop_diffs - diffs).abs().max().data.item())
+
+        loop_time = time_function(lambda: loop_condition_on_targets(net,
+                                               img_features, target_features),
+                                  num_iters=num_iters)
+        batched_time = time_function(lambda: net.condition_on_targets(
+                                               img_features,
+                                               net.encode_targets(
+                                                   target_features,
+                                                   features_given=True)),
+                                     num_iters=num_iters)
+        print('{:10d}  {:8.3f}  {:11.3f}  {:7.2f}  {:.2e}'.format(batch_size,
+                  1000*loop_time, 1000*batched_time, loop_time/batched_time,
+                  max_diff))
+
+
+def benchmark_multi_target(net, num_targets_list=[1,4,8,16,28],
+                           img_feat_size=(34,60), target_feat_size=(5,5),
+                           img_info=(540,960,3), num_iters=5):
+    """
+    Compare per target detection with detecting all targets in one pass.
+
+    Times TDID.detect on one scene image against N targets, with scene
+    features and target embeddings already computed (as in test_net).
+
+    Input parameters:
+        net: (TDID) the network
+
+        num_targets_list (optional): (list of int) Default: [1,4,8,16,28]
+        img_feat_size (optional): (tuple) HxW of the scene feature map.
+                                  Default: (34,60), a 540x960 image
+        target_feat_size (optional): (tuple) hxw of the target feature map
+                                     Default: (5,5)
+        img_info (optional): (tuple) scene image shape. Default: (540,960,3)
+        num_iters (optional): (int) timed calls per setting. Default: 5
+    """
+    num_channels = net.num_feature_channels
+    img_features = np_to_variable(np.random.rand(1, num_channels,
+                                  *img_feat_size).astype(np.float32),
+                                  device=net.device)
+    print('num_targets  per_target(ms)  one_pass(ms)  speedup')
+    for num_targets in num_targets_list:
+        all_embeddings = []
+        for _ in range(num_targets):
+            target_features = np_to_variable(np.random.rand(
+                                       net.cfg.NUM_TARGETS, num_channels,
+                                       *target_feat_size).astype(np.float32),
+                                       device=net.device)
+            all_embeddings.append(net.encode_targets(target_features,
+                                                     features_given=True))
+        stacked_embeddings = net.stack_target_embeddings(all_embeddings)
+
+        def per_target():
+            for target_embeddings in all_embeddings:
+                net.detect(img_features, target_embeddings, img_info)
+
+        per_target_time = time_function(per_target, num_iters=num_iters)
+        one_pass_time = time_function(lambda: net.detect(img_features,
+                                                         stacked_embeddings,
+                                                         img_info),
+                                      num_iters=num_iters)
+        print('{:11d}  {:14.3f}  {:12.3f}  {:7.2f}'.format(num_targets,
+                  1000*per_target_time, 1000*one_pass_time,
+                  per_target_time/one_pass_time))
+
+
+
+def benchmark_folded_targets(net, num_targets_list=[1,4,8,16,28],
+                             img_feat_size=(34,60), target_feat_size=(5,5),
+                             img_info=(540,960,3), num_iters=5):
+    """
+    Compare detect with tiled corr/diff maps and with folded targets.
+
+    Both detect all targets in one pass over one scene image. Folded
+    targets (TDID.fold_targets) run corr_conv and diff_conv on the scene
+    features directly. Needs cfg.CORR_WITH_POOLED.
+
+    Input parameters:
+        net: (TDID) the network
+
+        num_targets_list (optional): (list of int) Default: [1,4,8,16,28]
+        img_feat_size (optional): (tuple) HxW of the scene feature map.
+                                  Default: (34,60), a 540x960 image
+        target_feat_size (optional): (tuple) hxw of the target feature map
+                                     Default: (5,5)
+        img_info (optional): (tuple) scene image shape. Default: (540,960,3)
+        num_iters (optional): (int) timed calls per setting. Default: 5
+    """
+    num_channels = net.num_feature_channels
+    img_features = np_to_variable(np.random.rand(1, num_channels,
+                                  *img_feat_size).astype(np.float32),
+                                  device=net.device)
+    print('num_targets  tiled(ms)  folded(ms)  speedup  max_abs_diff')
+    for num_targets in num_targets_list:
+        target_features = np_to_variable(np.random.rand(
+                                   num_targets*net.cfg.NUM_TARGETS, 
+                                   num_channels,
+                                   *target_feat_size).astype(np.float32),
+                                   device=net.device)
+        with torch.no_grad():
+            tiled = net.encode_targets(target_features, features_given=True)
+            folded = net.encode_targets(target_features, features_given=True,
+                                        fold=True)
+            tiled_scores = net.detect(img_features, tiled, img_info)[0]
+            folded_scores = net.detect(img_features, folded, img_info)[0]
+            max_diff = (tiled_scores - folded_scores).abs().max().item()
+
+            tiled_time = time_function(lambda: net.detect(img_features, 
+                                                          tiled, img_info),
+                                       num_iters=num_iters)
+            folded_time = time_function(lambda: net.detect(img_features, 
+                                                           folded, img_info),
+                                        num_iters=num_iters)
+        print('{:11d}  {:9.3f}  {:10.3f}  {:7.2f}  {:.2e}'.format(num_targets,
+                  1000*tiled_time, 1000*folded_time, tiled_time/folded_time,
+                  max_diff))
+
+
+def count_step_transfers(net, batch_size=2, img_size=(540,960),
+                         target_size=(80,80)):
+    """
+    Count host/device transfers of one training and one test forward pass.
+
+    The input images are made on the device first, so every transfer
+    counted comes from the network and its layers. gt_boxes stay numpy
+    arrays, as in train_tdid.py, and are copied once by the layers.
+
+    Input parameters:
+        net: (TDID) the network
+
+        batch_size (optional): (int) Default: 2
+        img_size (optional): (tuple) HxW of the scene images. 
+                             Default: (540,960)
+        target_size (optional): (tuple) hxw of the target images. 
+                                Default: (80,80)
+    """
+    img_data = np_to_variable(np.random.rand(batch_size, 3, 
+                                             *img_size).astype(np.float32),
+                                             device=net.device)
+    target_data = np_to_variable(np.random.rand(
+                                   batch_size*net.cfg.NUM_TARGETS, 3, 
+                                   *target_size).astype(np.float32),
+                                   device=net.device)
+    img_info = (img_size[0], img_size[1], 3)
+    gt_boxes = np.tile(np.asarray([[100, 100, 200, 180, 1]], np.float32), 
+                       (batch_size, 1))
+
+    was_training = net.training
+    for training in [True, False]:
+        net.train(training)
+        with TransferCounter() as counter:
+            if training:
+                net(target_data, img_data, img_info, gt_boxes=gt_boxes)
+                net.loss
+            else:
+                net(target_data, img_data, img_info)
+        print('{} step: {}'.format('train' if training else 'test', counter))
+    net.train(was_training)
+
+
+
+if __name__ == '__main__':
+
+    #load config file
+    cfg_file = 'configAVD1' #NO EXTENSTION!
+    cfg = importlib.import_module('configs.'+cfg_file)
+    cfg = cfg.Config()
+
+    net = TDID(cfg)
+    net.to(get_device(cfg.DEVICE))
+    net.eval()
+
+    for corr_with_pooled in [True, False]:
+        cfg.CORR_WITH_POOLED = corr_with_pooled
+        print('CORR_WITH_POOLED = {}'.format(corr_with_pooled))
+        benchmark_conditioning(net)
+
+    cfg.CORR_WITH_POOLED = True
+    benchmark_multi_target(net)
+    benchmark_folded_targets(net)
+    count_step_transfers(net)
@@ -0,0 +1,66 @@
+import threading
+import numpy as np
+
+from model_defs.anchors import cython_bbox
+from model_defs.nms import nms_wrapper
+from benchmark_nms import random_dets
+from utils import Timer
+
+
+def benchmark_threads(num_threads_list=[1,2,4,8,16], num_iters=10):
+    """
+    Time the cython box kernels with more and more threads.
+
+    Times bbox_overlaps of all anchors of a 60x34 feature map (9 anchors
+    per cell) with a batch of 20 gt boxes, and cpu_nms of 6000 proposals.
+    Threads only help if the kernels were built with OpenMP.
+
+    Input parameters:
+        num_threads_list (optional): (list of int) Default: [1,2,4,8,16]
+        num_iters (optional): (int) timed calls per setting. Default: 10
+    """
+    if nms_wrapper.cpu_nms is None:
+        print('cpu_nms is not built')
+        return
+    anchors = random_dets(60*34*9, seed=0)[:, :4].copy()
+    gt_boxes = random_dets(20, seed=1)[:, :4].copy()
+    dets = random_dets(6000, seed=2)
+
+    kernels = [('bbox_overlaps', 
+                lambda: cython_bbox.bbox_overlaps(anchors, gt_boxes)),
+               ('cpu_nms', lambda: nms_wrapper.nms(dets, .7, backend='cpu')),
+               ('cpu_nms x4 python threads', 
+                lambda: _in_threads(lambda: nms_wrapper.nms(dets, .7,
+                                                           backend='cpu'),
+                                    4))]
+    print('kernel                      threads  time(ms)  speedup')
+    for name, kernel in kernels:
+        base_time = None
+        for num_threads in num_threads_list:
+            nms_wrapper.set_num_threads(num_threads)
+            kernel()
+            t = Timer()
+            for _ in range(num_iters):
+                t.tic()
+                kernel()
+                t.toc()
+            if base_time is None:
+                base_time = t.average_time
+            print('{:26s}  {:7d}  {:8.3f}  {:7.2f}'.format(
+                      name, num_threads, 1000*t.average_time, 
+                      base_time / t.average_time))
+    nms_wrapper.set_num_threads(0)
+
+
+def _in_threads(fn, num_threads):
+    """Run fn once in each of num_threads python threads, the kernels
+    release the GIL so they can overlap."""
+    threads = [threading.Thread(target=fn) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    benchmark_threads()
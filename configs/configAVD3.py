@@ -41,6 +41,8 @@ class Config():
     RESIZE_IMG_FACTOR = .5 
     CHOOSE_PRESENT_TARGET = .6
     DET4CLASS = False 
+    USE_ROI_LOSS_ONLY = False 
+    TRAIN_LAZY_PROPOSALS = True #only make proposals in training if asked for
 
     #Target Images
     PRELOAD_TARGET_IMAGES= False
@@ -85,6 +87,9 @@ class Config():
     MAX_DETS_PER_TARGET = 5
     SCORE_THRESH = .01
     TEST_NMS_OVERLAP_THRESH = .7
+    TEST_NMS_MODE = 'exact' #'exact' or 'matrix' (approximate, faster)
+    TEST_PROPOSAL_PREFILTER = True #drop anchors under SCORE_THRESH before decode and nms
+    TEST_SINGLE_STAGE_POSTPROCESS = False #one nms at TEST_NMS_OVERLAP_THRESH in the proposal layer, not two
 
     TEST_OBJ_IDS= TRAIN_OBJ_IDS
     TEST_FRACTION_OF_NO_BOX_IMAGES =  1 
@@ -94,9 +99,13 @@ class Config():
                  'Home_002_1',
                 ]
     TEST_ONE_AT_A_TIME = False 
+    TEST_TARGETS_IN_ONE_PASS = True 
+    TEST_TARGET_BATCH_MEMORY_MB = 1024 
+    TEST_FOLD_TARGETS = True #with CORR_WITH_POOLED, fold each target into corr_conv/diff_conv weights
     ###############################################
     #Model paramters
     ANCHOR_SCALES = [1,2,4]
+    ANCHOR_CACHE_SIZE = 8 #max number of feature map sizes with cached anchors
     NUM_TARGETS = 2
     CORR_WITH_POOLED = True 
     USE_IMG_FEATS = False 
@@ -105,14 +114,26 @@ class Config():
 
     PRE_NMS_TOP_N = 6000
     POST_NMS_TOP_N = 300
+    PROPOSAL_BUDGET_MODE = 'fixed' #'fixed' or 'adaptive': TOP_N scaled by feature map size
+    PROPOSAL_BUDGET_REF_CELLS = 68*120 #feature map cells the TOP_N are for (full 1080x1920 image)
+    PROPOSAL_MIN_SCORE_FRACTION = .01 #adaptive: drop anchors under this fraction of the image's max score
     NMS_THRESH = .7
+    NMS_BACKEND = 'auto' #'auto', 'gpu', 'torch', 'cpu' or 'numpy'
+    CPU_KERNEL_THREADS = 0 #threads for cython box/nms kernels, 0 for all cores
+    DEVICE = 'auto' #'auto' (the gpu if there is one), 'cuda' or 'cpu'
+    CPU_INTRA_OP_THREADS = 0 #cpu inference: torch threads inside an op, 0 for torch's default
+    CPU_INTER_OP_THREADS = 0 #cpu inference: torch threads across ops, 0 for torch's default
+    CPU_CHANNELS_LAST = True #cpu inference: channels last feature net, faster oneDNN convs
+    CPU_PREPACK_WEIGHTS = True #cpu inference: freeze feature net, fold batchnorms, pre-pack conv weights
+    TORCH_PROPOSAL_LAYER = 'auto' #'auto' (torch on the gpu, numpy on the cpu), True or False
+    TORCH_ANCHOR_TARGET_LAYER = 'auto' #'auto' (torch on the gpu, numpy on the cpu), True or False
+    ANCHOR_ASSIGNMENT_CACHE_DIR = '' #precomputed anchor labels, see precompute_anchor_assignments.py
     PROPOSAL_MIN_BOX_SIZE = 8 
     PROPOSAL_CLOBBER_POSITIVES = False 
     PROPOSAL_NEGATIVE_OVERLAP = .3
     PROPOSAL_POSITIVE_OVERLAP = .6
     PROPOSAL_FG_FRACTION = .5
     PROPOSAL_BATCH_SIZE = 300 
-    PROPOSAL_POSITIVE_WEIGHT = -1
     PROPOSAL_BBOX_INSIDE_WEIGHTS = [1,1,1,1]
 
     EPS = 1e-14
@@ -7,7 +7,14 @@ import numpy as np
 import sys
 
 from .anchors.proposal_layer import proposal_layer as proposal_layer_py
+from .anchors.proposal_layer_torch import proposal_layer as proposal_layer_torch
 from .anchors.anchor_target_layer import anchor_target_layer as anchor_target_layer_py
+from .anchors.anchor_target_layer_torch import anchor_target_layer as anchor_target_layer_torch
+from .anchors.anchor_grid import AnchorGridCache
+from .anchors.anchor_assignment_cache import AnchorAssignmentCache
+from .anchors.proposal_budget import ProposalBudget
+from .anchors.workspace import Workspace
+from .nms import nms_wrapper
 from utils import *
 
 class TDID(torch.nn.Module):
@@ -40,11 +47,66 @@ class TDID(torch.nn.Module):
         # 4 = number of bounding box parameters
         self.score_conv = Conv2d(512, len(self.anchor_scales) * 3 * 2, 1, relu=False, same_padding=False)
         self.bbox_conv = Conv2d(512, len(self.anchor_scales) * 3 * 4, 1, relu=False, same_padding=False)
+        #constant of the box loss, moves with the network so it is not 
+        #copied to the device every step. Not saved with the weights
+        self.register_buffer('bbox_inside_weights', 
+                         torch.FloatTensor(cfg.PROPOSAL_BBOX_INSIDE_WEIGHTS),
+                         persistent=False)
 
         # loss
         self.class_cross_entropy_loss = None
         self.box_regression_loss = None
-        self.roi_cross_entropy_loss = None
+        self._roi_cross_entropy_loss = None
+
+        # number of valid (non padding) proposals per batch element,
+        # from the last forward pass
+        self.num_valid_proposals = None
+
+        # network outputs of the last forward pass, for making proposals
+        # only when they are asked for
+        self._proposal_inputs = None
+        self._proposals = None
+
+        # shifted anchors for each feature map / image size seen so far
+        self.anchor_cache = AnchorGridCache(cfg.ANCHOR_CACHE_SIZE)
+        # temporary arrays of the numpy proposal and anchor target layers,
+        # kept between steps
+        self.workspace = Workspace()
+        # pre and post nms proposal counts, and how many were used
+        self.proposal_budget = ProposalBudget(cfg)
+        # precomputed anchor labels of the training boxes, if there are any
+        self.assignment_cache = None
+        if cfg.ANCHOR_ASSIGNMENT_CACHE_DIR:
+            self.assignment_cache = AnchorAssignmentCache(
+                                            cfg.ANCHOR_ASSIGNMENT_CACHE_DIR,
+                                            cfg, self._feat_stride)
+        nms_wrapper.set_num_threads(cfg.CPU_KERNEL_THREADS)
+
+    @property
+    def device(self):
+        '''
+        The torch.device the network is on
+        '''
+        return self.bbox_inside_weights.device
+
+    def optimize_for_cpu_inference(self):
+        '''
+        Prepare the network for inference on the cpu, as set by the config
+
+        Sets the torch thread counts (cfg.CPU_INTRA_OP_THREADS and 
+        cfg.CPU_INTER_OP_THREADS) and replaces the feature net with a 
+        CPUFeatureNet (cfg.CPU_CHANNELS_LAST, cfg.CPU_PREPACK_WEIGHTS).
+        Call after loading the weights. Afterwards the feature net can not
+        be trained, and its weights may be missing from state_dict.
+        '''
+        cfg = self.cfg
+        set_cpu_threads(cfg.CPU_INTRA_OP_THREADS, cfg.CPU_INTER_OP_THREADS)
+        self.cpu()
+        self.eval()
+        if cfg.CPU_CHANNELS_LAST or cfg.CPU_PREPACK_WEIGHTS:
+            self.features = CPUFeatureNet(self.features,
+                                          channels_last=cfg.CPU_CHANNELS_LAST,
+                                          prepack=cfg.CPU_PREPACK_WEIGHTS)
 
     @property
     def loss(self):
@@ -53,8 +115,70 @@ class TDID(torch.nn.Module):
         '''
         return self.class_cross_entropy_loss + self.box_regression_loss * 10
 
+    @property
+    def roi_cross_entropy_loss(self):
+        '''
+        Get classification loss of the proposals of the last training pass
+
+        Runs the proposal layer if it was skipped during the forward pass.
+        '''
+        if (self._roi_cross_entropy_loss is None and 
+                self._proposal_inputs is not None and
+                self._proposal_inputs['gt_boxes'] is not None):
+            rois, scores, anchor_inds, labels = self.proposals(all_outputs=True)
+            self._roi_cross_entropy_loss = self.build_roi_loss(
+                                           self._proposal_inputs['class_score'],
+                                           scores, anchor_inds, labels)
+        return self._roi_cross_entropy_loss
+
+    def proposals(self, all_outputs=False):
+        '''
+        Get the proposals of the last forward pass
+
+        Runs the proposal layer on the outputs of the last forward pass the
+        first time it is called after that pass. When training with 
+        cfg.TRAIN_LAZY_PROPOSALS the forward pass does not make proposals, 
+        so they are only made if the roi loss or logging needs them.
+
+        Input parameters:
+            all_outputs (optional): (bool) If True also return the 
+                                    anchor_inds and labels of the proposals.
+                                    Default: False
+
+        Returns:
+            scores: (torch.autograd.variable.Variable) BxMx1
+            rois: (torch.autograd.variable.Variable) BxMx4
+            
+            or if all_outputs, rois, scores, anchor_inds, labels as returned
+            by proposal_layer
+        '''
+        if self._proposals is None:
+            inputs = self._proposal_inputs
+            assert inputs is not None, 'no forward pass to make proposals for'
+            rois, scores, anchor_inds, labels, num_valid = self.proposal_layer(
+                                                   inputs['class_prob_reshape'],
+                                                   inputs['bbox_pred'],
+                                                   inputs['img_info'],
+                                                   self.cfg,
+                                                   self._feat_stride, 
+                                                   self.anchor_scales,
+                                                   inputs['gt_boxes'],
+                                                   inputs['anchor_grid'],
+                                                   self.workspace,
+                                                   inputs['score_thresh'],
+                                                   inputs['max_dets'],
+                                                   inputs['nms_thresh'],
+                                                   self.proposal_budget)
+            self.num_valid_proposals = num_valid
+            self._proposals = (rois, scores, anchor_inds, labels)
+
+        if all_outputs:
+            return self._proposals
+        return self._proposals[1], self._proposals[0]
+
     def forward(self, target_data, img_data, img_info, gt_boxes=None,
-                features_given=False):
+                features_given=False, score_thresh=None, max_dets=0,
+                nms_thresh=None):
         '''
         Forward pass through TDID network.
 
@@ -75,6 +199,9 @@ class TDID(torch.nn.Module):
                                        are assumed to be feature maps. The feature
                                        extraction portion of the forward pass
                                        is skipped. Default: False
+            score_thresh (optional): (float) see detect. Default: None
+            max_dets (optional): (int) see detect. Default: 0
+            nms_thresh (optional): (float) see detect. Default: None
 
         Returns:
             scores: (torch.autograd.variable.Variable) Bxcfg.PROPOSAL_BATCH_SIZEx1
@@ -83,57 +210,179 @@ class TDID(torch.nn.Module):
         '''
         if features_given:
             img_features = img_data
-            target_features = target_data 
+            target_embeddings = self.encode_targets(target_data,
+                                                    features_given=True)
         else:
             img_features = self.features(img_data)
+            target_embeddings = self.encode_targets(target_data)
+
+        return self.detect(img_features, target_embeddings, img_info,
+                           gt_boxes=gt_boxes, score_thresh=score_thresh,
+                           max_dets=max_dets, nms_thresh=nms_thresh)
+
+
+    def encode_targets(self, target_data, features_given=False, fold=False):
+        '''
+        Compute the per target type embeddings used to condition detection.
+
+        Only depends on the target images, so it can be run once per target
+        and reused with detect for any number of scene images.
+
+        B = batch size
+        T = cfg.NUM_TARGETS
+        C = number of channels
+
+        Input parameters:
+            target_data: (torch.FloatTensor) (B*T)xCxhxw tensor of target
+                         data, ordered with all target types of a batch
+                         element next to each other
+
+            features_given (optional): (bool) If True, target_data is assumed
+                                       to be feature maps from self.features
+                                       Default: False
+            fold (optional): (bool) If True, also fold the targets into the
+                             corr_conv and diff_conv weights, see
+                             fold_targets. Needs cfg.CORR_WITH_POOLED, for
+                             inference only. Default: False
+
+        Returns:
+            (tuple) target_embeddings:
+                pooled_target_feats: (torch.autograd.variable.Variable)
+                                     Bx(T*C)x1x1 max pooled target features
+                target_features: (torch.autograd.variable.Variable)
+                                 (B*T)xCxhxw target features, only kept when
+                                 not cfg.CORR_WITH_POOLED, otherwise None
+                folded_targets: (tuple) only if fold, from fold_targets
+        '''
+        if features_given:
+            target_features = target_data
+        else:
             target_features = self.features(target_data)
 
+        num_channels = target_features.size()[1]
+        pooled_target_feats = F.max_pool2d(target_features,
+                                           (target_features.size()[2],
+                                            target_features.size()[3]))
+        pooled_target_feats = pooled_target_feats.view(-1,
+                                           self.cfg.NUM_TARGETS*num_channels,
+                                           1, 1)
+        if self.cfg.CORR_WITH_POOLED:
+            target_features = None
+        if fold:
+            return (pooled_target_feats, target_features, 
+                    self.fold_targets(pooled_target_feats))
+        return pooled_target_feats, target_features
+
+
+    def fold_targets(self, pooled_target_feats):
+        '''
+        Fold pooled targets into per target corr_conv and diff_conv weights
+
+        With cfg.CORR_WITH_POOLED the corr_conv input is the scene features
+        scaled by the pooled target, and the diff_conv input is the scene
+        features minus the pooled target, so both convs are linear in the
+        scene features. Scaling does not change the zero padding, so 
+        corr_conv becomes one conv of the scene features with per target
+        weights. diff_conv becomes one target independent conv of the 
+        scene features, minus a per target offset from the kernel taps 
+        that are inside the image (the padding is zero, not -target).
+
+        Weights are not differentiated, for inference only.
+
+        B = number of targets
+        T = cfg.NUM_TARGETS
+        C = number of channels
+        O = output channels of corr_conv/diff_conv
+        k = kernel size
+
+        Input parameters:
+            pooled_target_feats: (torch.autograd.variable.Variable)
+                                 Bx(T*C)x1x1 from encode_targets
+
+        Returns:
+            (tuple) folded_targets:
+                corr_weights: (torch.FloatTensor) BxOxCxkxk corr_conv 
+                              weights of each target
+                diff_offsets: (torch.FloatTensor) BxOxkxk target part of 
+                              each diff_conv kernel tap
+        '''
+        assert self.cfg.CORR_WITH_POOLED
+        num_targets = self.cfg.NUM_TARGETS
+        batch_size = pooled_target_feats.size()[0]
+        pooled = pooled_target_feats.detach().view(batch_size, num_targets,
+                                                   -1)
+        with torch.no_grad():
+            corr_weight = self.corr_conv.conv.weight
+            num_out, _, kh, kw = corr_weight.size()
+            corr_weight = corr_weight.view(num_out, num_targets, -1, kh, kw)
+            corr_weights = torch.einsum('otchw,btc->bochw', corr_weight, 
+                                        pooled)
+            diff_weight = self.diff_conv.conv.weight.view(num_out, 
+                                                          num_targets, -1,
+                                                          kh, kw)
+            diff_offsets = torch.einsum('otchw,btc->bohw', diff_weight, 
+                                        pooled)
+        return corr_weights, diff_offsets
+
+    def detect(self, img_features, target_embeddings, img_info,
+               gt_boxes=None, score_thresh=None, max_dets=0, 
+               nms_thresh=None):
+        '''
+        Detect targets in scene features, given precomputed target embeddings
+
+        Runs everything in the forward pass after feature extraction and
+        target encoding. A single scene image (B=1) can be given with the
+        embeddings of N targets, which detects all N targets in one pass.
+
+        Input parameters:
+            img_features: (torch.autograd.variable.Variable) BxCxHxW scene 
+                          image features, from self.features
+            target_embeddings: (tuple) B target embeddings, from 
+                               encode_targets or stack_target_embeddings.
+                               If folded, the B x (T*C) channel corr/diff 
+                               maps are never made
+            img_info: (tuple) shape of original scene image
+            
+            gt_boxes (optional): (ndarray) ground truth bounding boxes for this
+                                 scene/target pair. Must be provided for training
+                                 not used for testing. Default: None
+            score_thresh (optional): (float) If not None, only proposals
+                                     scoring over it are made, anchors 
+                                     under it are dropped before decoding
+                                     and nms. For testing. Default: None
+            max_dets (optional): (int) If > 0, make at most this many 
+                                 proposals per batch element. Default: 0
+            nms_thresh (optional): (float) IoU threshold of the proposal
+                                   nms, cfg.NMS_THRESH if None. 
+                                   Default: None
+
+            With score_thresh, max_dets and nms_thresh set to the test 
+            values, the proposals are the final detections, made with one
+            nms instead of the proposal nms and another one after it.
+
+        Returns:
+            scores: (torch.autograd.variable.Variable) Bxcfg.PROPOSAL_BATCH_SIZEx1
+            rois: (torch.autograd.variable.Variable) Bxcfg.PROPOSAL_BATCH_SIZEx4
 
-        all_corrs = []
-        all_diffs = []
-        for batch_ind in range(img_features.size()[0]):
-            img_ind = np_to_variable(np.asarray([batch_ind]),
-                                     is_cuda=True, dtype=torch.LongTensor)
-            cur_img_feats = torch.index_select(img_features,0,img_ind)
-
-            cur_diffs = []
-            cur_corrs = []
-            for target_type in range(self.cfg.NUM_TARGETS):
-                target_ind = np_to_variable(np.asarray([batch_ind*
-                                            self.cfg.NUM_TARGETS+target_type]),
-                                            is_cuda=True,dtype=torch.LongTensor)
-                cur_target_feats = torch.index_select(target_features,0,
-                                                      target_ind[0])
-                cur_target_feats = cur_target_feats.view(-1,1,
-                                                     cur_target_feats.size()[2],
-                                                     cur_target_feats.size()[3])
-                pooled_target_feats = F.max_pool2d(cur_target_feats,
-                                         (cur_target_feats.size()[2],
-                                          cur_target_feats.size()[3]))
-
-                cur_diffs.append(cur_img_feats -
-                    pooled_target_feats.permute(1,0,2,3).expand_as(cur_img_feats))
-                if self.cfg.CORR_WITH_POOLED:
-                    cur_corrs.append(F.conv2d(cur_img_feats,
-                                             pooled_target_feats,
-                                             groups=self.num_feature_channels))
-                else:
-                    target_conv_padding = (max(0,int(
-                                          target_features.size()[2]/2)), 
-                                           max(0,int(
-                                           target_features.size()[3]/2)))
-                    cur_corrs.append(F.conv2d(cur_img_feats,cur_target_feats,
-                                             padding=target_conv_padding,
-                                             groups=self.num_feature_channels))
-                
-
-            cur_corrs = torch.cat(cur_corrs,1)
-            cur_corrs = self.select_to_match_dimensions(cur_corrs,cur_img_feats)
-            all_corrs.append(cur_corrs)
-            all_diffs.append(torch.cat(cur_diffs,1))
-
-        corr = self.corr_conv(torch.cat(all_corrs,0))
-        diff = self.diff_conv(torch.cat(all_diffs,0))
+            When training with cfg.TRAIN_LAZY_PROPOSALS, no proposals are made
+            and (None, None) is returned. Use self.proposals() to get them.
+        '''
+        num_embeddings = target_embeddings[0].size()[0]
+        folded_targets = None
+        if len(target_embeddings) > 2:
+            #before expanding, the scene features are shared by the targets
+            folded_targets = target_embeddings[2]
+            corr, diff = self.folded_convs(img_features, folded_targets)
+        if img_features.size()[0] == 1 and num_embeddings > 1:
+            #same scene for every target
+            img_features = img_features.expand(num_embeddings,
+                                               *img_features.size()[1:])
+
+        if folded_targets is None:
+            corrs, diffs = self.condition_on_targets(img_features, 
+                                                     target_embeddings)
+            corr = self.corr_conv(corrs)
+            diff = self.diff_conv(diffs)
       
         if self.cfg.USE_IMG_FEATS and self.cfg.USE_DIFF_FEATS:
             if self.cfg.USE_CC_FEATS: 
@@ -156,67 +405,268 @@ class TDID(torch.nn.Module):
         embedding_feats = self.embedding_conv(concat_feats)
         class_score = self.score_conv(embedding_feats)
         class_score_reshape = self.reshape_layer(class_score, 2)
-        class_prob = F.softmax(class_score_reshape)
+        class_prob = F.softmax(class_score_reshape, dim=1)
         class_prob_reshape = self.reshape_layer(class_prob, len(self.anchor_scales)*3*2)
 
         bbox_pred = self.bbox_conv(embedding_feats)
-
-        # proposal layer
-        rois, scores, anchor_inds, labels = self.proposal_layer(
-                                                           class_prob_reshape,
-                                                           bbox_pred,
-                                                           img_info,
-                                                           self.cfg,
-                                                           self._feat_stride, 
-                                                           self.anchor_scales,
-                                                           gt_boxes)
+        anchor_grid = self.anchor_cache.get(class_score.size()[2],
+                                            class_score.size()[3],
+                                            self._feat_stride,
+                                            self.anchor_scales, img_info)
+
+        # proposal layer inputs, proposals are made by self.proposals()
+        self._proposal_inputs = {'class_score': class_score,
+                                 'class_prob_reshape': class_prob_reshape,
+                                 'bbox_pred': bbox_pred,
+                                 'img_info': img_info,
+                                 'gt_boxes': gt_boxes,
+                                 'anchor_grid': anchor_grid,
+                                 'score_thresh': score_thresh,
+                                 'max_dets': max_dets,
+                                 'nms_thresh': nms_thresh}
+        self._proposals = None
+        self._roi_cross_entropy_loss = None
+        self.num_valid_proposals = None
     
         if self.training:
             assert gt_boxes is not None
             anchor_data = self.anchor_target_layer(class_score,gt_boxes, 
                                                 img_info, self.cfg,
                                                 self._feat_stride, 
-                                                self.anchor_scales)
+                                                self.anchor_scales,
+                                                anchor_grid,
+                                                self.assignment_cache,
+                                                self.workspace)
             self.class_cross_entropy_loss, self.box_regression_loss = \
                     self.build_loss(class_score_reshape, bbox_pred, anchor_data)
 
-            self.roi_cross_entropy_loss = self.build_roi_loss(class_score, 
+            if self.cfg.TRAIN_LAZY_PROPOSALS:
+                #proposals and roi loss are made when asked for
+                return None, None
+
+            rois, scores, anchor_inds, labels = self.proposals(all_outputs=True)
+            self._roi_cross_entropy_loss = self.build_roi_loss(class_score, 
                                                     scores,anchor_inds, labels)
+            return scores, rois
+
+        return self.proposals()
 
-        return scores, rois
 
 
+    @staticmethod
+    def stack_target_embeddings(target_embeddings_list):
+        '''
+        Combine the embeddings of several targets into one batch for detect
+
+        Input parameters:
+            target_embeddings_list: (list) embeddings from encode_targets.
+                                    Full target feature maps (when not
+                                    cfg.CORR_WITH_POOLED) must all be the 
+                                    same size.
+
+        Returns:
+            (tuple) target embeddings, batch size is the sum of the inputs
+        '''
+        pooled_target_feats = torch.cat([emb[0] for emb in
+                                         target_embeddings_list], 0)
+        if target_embeddings_list[0][1] is None:
+            target_features = None
+        else:
+            target_features = torch.cat([emb[1] for emb in
+                                         target_embeddings_list], 0)
+        if len(target_embeddings_list[0]) > 2:
+            folded_targets = tuple(torch.cat([emb[2][ind] for emb in
+                                              target_embeddings_list], 0)
+                                   for ind in range(2))
+            return pooled_target_feats, target_features, folded_targets
+        return pooled_target_feats, target_features
+
+
+    def targets_per_batch(self, img_features, memory_budget_mb, 
+                          folded=False):
+        '''
+        Number of targets detect can run on a scene at once within a budget
+
+        Estimates the activation memory of detect for each target from the
+        size of the scene feature map.
+
+        Input parameters:
+            img_features: (torch.autograd.variable.Variable) 1xCxHxW scene
+                          image features
+            memory_budget_mb: (float) megabytes allowed for one detect call
+
+            folded (optional): (bool) If True, the targets are folded (see
+                               fold_targets), so there are no tiled scene,
+                               corr and diff inputs. Default: False
+
+        Returns:
+            (int) max number of targets to batch, at least 1
+        '''
+        num_channels = img_features.size()[1]
+        num_cells = img_features.size()[2] * img_features.size()[3]
+        num_anchors = len(self.anchor_scales) * 3
+        #tiled scene, corr and diff inputs, conv outputs, concat, embedding,
+        #score/prob/bbox maps
+        num_inputs = 0 if folded else 3*self.cfg.NUM_TARGETS*num_channels
+        floats_per_target = num_cells * (num_inputs + 
+                                         5*num_channels + 512 + 
+                                         num_anchors*(2+2+2+4))
+        bytes_per_target = 4 * floats_per_target
+        return max(1, int(memory_budget_mb * 2**20 / bytes_per_target))
+
+
+    def condition_on_targets(self, img_features, target_embeddings):
+        '''
+        Compute difference and correlation maps for every scene/target pair
+
+        All batch elements and all target types are handled together, with
+        a constant number of tensor ops regardless of batch size.
+
+        B = batch size
+        T = cfg.NUM_TARGETS
+        C = number of channels
+
+        Input parameters:
+            img_features: (torch.autograd.variable.Variable) BxCxHxW scene
+                          image features
+            target_embeddings: (tuple) B target embeddings, from 
+                               encode_targets
+
+        Returns:
+            corrs: (torch.autograd.variable.Variable) Bx(T*C)xHxW
+            diffs: (torch.autograd.variable.Variable) Bx(T*C)xHxW
+        '''
+        pooled_target_feats, target_features = target_embeddings
+        batch_size, num_channels, height, width = img_features.size()
+        num_targets = self.cfg.NUM_TARGETS
+
+        #one copy of the scene features for each target type, (B,T*C,H,W)
+        tiled_img_feats = img_features.unsqueeze(1).expand(batch_size,
+                                                           num_targets,
+                                                           num_channels,
+                                                           height,
+                                                           width)
+        tiled_img_feats = tiled_img_feats.contiguous().view(batch_size,
+                                                  num_targets*num_channels,
+                                                  height, width)
+        pooled_target_feats = pooled_target_feats.expand_as(tiled_img_feats)
+
+        diffs = tiled_img_feats - pooled_target_feats
+        if self.cfg.CORR_WITH_POOLED:
+            #a depthwise 1x1 conv is just a per channel scale
+            corrs = tiled_img_feats * pooled_target_feats
+        else:
+            #every (batch element, target type, channel) is its own group
+            target_height = target_features.size()[2]
+            target_width = target_features.size()[3]
+            target_conv_padding = (max(0,int(target_height/2)),
+                                   max(0,int(target_width/2)))
+            corrs = F.conv2d(tiled_img_feats.view(1, -1, height, width),
+                             target_features.contiguous().view(-1, 1,
+                                                               target_height,
+                                                               target_width),
+                             padding=target_conv_padding,
+                             groups=batch_size*num_targets*num_channels)
+            corrs = corrs.view(batch_size, num_targets*num_channels,
+                               corrs.size()[2], corrs.size()[3])
+            corrs = self.select_to_match_dimensions(corrs, img_features)
+
+        return corrs, diffs
+
+
+    def folded_convs(self, img_features, folded_targets):
+        '''
+        corr_conv and diff_conv outputs from targets folded into the weights
+
+        Same as corr_conv and diff_conv of condition_on_targets, without 
+        making their Bx(T*C)xHxW inputs. See fold_targets.
+
+        B = number of targets
+        O = output channels of corr_conv/diff_conv
+
+        Input parameters:
+            img_features: (torch.autograd.variable.Variable) 1xCxHxW or 
+                          BxCxHxW scene image features
+            folded_targets: (tuple) B folded targets, from fold_targets
+
+        Returns:
+            corr: (torch.autograd.variable.Variable) BxOxHxW
+            diff: (torch.autograd.variable.Variable) BxOxHxW
+        '''
+        corr_weights, diff_offsets = folded_targets
+        batch_size, num_out, num_channels, kh, kw = corr_weights.size()
+        num_imgs, _, height, width = img_features.size()
+        corr_conv = self.corr_conv.conv
+        diff_conv = self.diff_conv.conv
+        assert self.corr_conv.bn is None and self.diff_conv.bn is None
+        assert num_imgs in (1, batch_size)
+
+        #one conv per target, all in one call. A single scene image is
+        #shared by all targets, else each target has its own image
+        corr = F.conv2d(img_features.contiguous().view(1, -1, height, width),
+                        corr_weights.view(-1, num_channels, kh, kw),
+                        corr_conv.bias.repeat(batch_size), 
+                        padding=corr_conv.padding, groups=num_imgs)
+        corr = corr.view(batch_size, num_out, height, width)
+
+        #the target independent part is one conv per scene image
+        num_targets = self.cfg.NUM_TARGETS
+        diff_weight = diff_conv.weight.view(num_out, num_targets, 
+                                            num_channels, kh, kw).sum(1)
+        diff = F.conv2d(img_features, diff_weight, diff_conv.bias,
+                        padding=diff_conv.padding)
+        #target part, summed over the kernel taps inside the image
+        inside = img_features.new_ones((1, 1, height, width))
+        offsets = F.conv2d(inside, diff_offsets.view(-1, 1, kh, kw),
+                           padding=diff_conv.padding)
+        diff = diff - offsets.view(batch_size, num_out, height, width)
+
+        if self.corr_conv.relu is not None:
+            corr = F.relu(corr)
+        if self.diff_conv.relu is not None:
+            diff = F.relu(diff)
+        return corr, diff
+
 
     def build_loss(self, class_score_reshape, bbox_pred, anchor_data):
         '''
         Compute loss of a batch from a single forward pass
     
+        Only the sampled anchors are gathered from the score and box maps.
+
         Input parameters:
-            class_score_reshape: (torch.FloatTensor)
-            bbox_pred: (torch.FloatTensor)
-            anchor_data: (ndarray)
+            class_score_reshape: (torch.FloatTensor) Bx2x(A*H)xW
+            bbox_pred: (torch.FloatTensor) Bx(A*4)xHxW
+            anchor_data: (tuple) anchor_inds, labels, bbox_targets from
+                         anchor_target_layer
 
         Returns:
             cross_entropy: (torch.autograd.variable.Variable) classifcation loss
             loss_box: (torch.autograd.variable.Variable) bbox regression loss
 
         '''
-        # classification loss
-        class_score = class_score_reshape.permute(0, 2, 3, 1).contiguous().view(-1, 2)
+        anchor_inds, anchor_label, bbox_targets = anchor_data
+        batch_size, _, height, width = bbox_pred.size()
+        num_anchors = int(bbox_pred.size()[1] / 4)
+
+        # anchor_inds are batch_ind*(H*W*A) + (h*W + w)*A + a
+        batch_inds = anchor_inds // (height*width*num_anchors)
+        cell_inds = (anchor_inds // num_anchors) % (height*width)
+        a_inds = anchor_inds % num_anchors
 
-        anchor_label = anchor_data[0].view(-1)
-        keep = Variable(anchor_label.data.ne(-1).nonzero().squeeze()).cuda()
-        class_score = torch.index_select(class_score, 0, keep)
-        anchor_label = torch.index_select(anchor_label, 0, keep)
+        # classification loss
+        class_score = class_score_reshape.view(batch_size, 2, num_anchors,
+                                               height*width)
+        class_score = class_score[batch_inds, :, a_inds, cell_inds]
 
-        fg_cnt = torch.sum(anchor_label.data.ne(0))
+        fg = anchor_label.data.eq(1)
+        fg_cnt = torch.sum(fg)
 
-        # box loss
-        bbox_targets = anchor_data[1]
-        bbox_inside_weights = anchor_data[2]
-        bbox_outside_weights = anchor_data[3]
-        bbox_targets = torch.mul(bbox_targets, bbox_inside_weights)
-        bbox_pred = torch.mul(bbox_pred, bbox_inside_weights)
+        # box loss, only fg anchors have nonzero inside weights
+        bbox_pred = bbox_pred.view(batch_size, num_anchors, 4, height*width)
+        bbox_pred = bbox_pred[batch_inds[fg], a_inds[fg], :, cell_inds[fg]]
+        bbox_targets = torch.mul(bbox_targets, self.bbox_inside_weights)
+        bbox_pred = torch.mul(bbox_pred, self.bbox_inside_weights)
 
         cross_entropy = F.cross_entropy(class_score,anchor_label, size_average=False)
         loss_box = F.smooth_l1_loss(bbox_pred, bbox_targets, size_average=False) / (fg_cnt + 1e-4)
@@ -228,15 +678,20 @@ class TDID(torch.nn.Module):
         Compute classifcation loss of specified anchor boxes
 
         Input paramters:
-
+            class_score: (torch.autograd.variable.Variable) Bx(A*2)xHxW
+            scores: (torch.autograd.variable.Variable) not used
+            anchor_inds: (torch.autograd.variable.Variable) BxMx1 anchor of
+                         each proposal, from proposal_layer
+            labels: (torch.autograd.variable.Variable) BxM
 
         Returns:
-            
+            (torch.autograd.variable.Variable) roi classification loss
         '''
-
+        num_anchors = int(class_score.size()[1] / 2)
         class_score = class_score.permute(0, 2, 3, 1)
-        bg_scores = torch.index_select(class_score,3,np_to_variable(np.arange(0,9),is_cuda=True, dtype=torch.LongTensor))
-        fg_scores = torch.index_select(class_score,3,np_to_variable(np.arange(9,18),is_cuda=True, dtype=torch.LongTensor))
+        #first A channels are bg scores, the next A fg scores
+        bg_scores = class_score[:, :, :, :num_anchors]
+        fg_scores = class_score[:, :, :, num_anchors:2*num_anchors]
         bg_scores = bg_scores.contiguous().view(-1,1)
         fg_scores = fg_scores.contiguous().view(-1,1)
         class_score = torch.cat([bg_scores, fg_scores],1)
@@ -288,25 +743,22 @@ class TDID(torch.nn.Module):
         
         '''
 
+        #leading rows/columns, a view instead of an index_select
         if a.size()[2] > b.size()[2]:
-            a = torch.index_select(a, 2, 
-                                  np_to_variable(np.arange(0,
-                                        b.size()[2]).astype(np.int32),
-                                         is_cuda=True,dtype=torch.LongTensor))
+            a = a.narrow(2, 0, b.size()[2])
         if a.size()[3] > b.size()[3]:
-            a = torch.index_select(a, 3, 
-                                  np_to_variable(np.arange(0,
-                                    b.size()[3]).astype(np.int32),
-                                          is_cuda=True,dtype=torch.LongTensor))
+            a = a.narrow(3, 0, b.size()[3])
         return a 
 
 
     @staticmethod
-    def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride, anchor_scales, gt_boxes=None):
+    def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride, anchor_scales, gt_boxes=None, anchor_grid=None, workspace=None, score_thresh=None, max_keep=0, nms_thresh=None, budget=None):
         '''
         Get top scoring detections
  
-        Wrapper for proposal_layer_py. 
+        Wrapper for proposal_layer_torch, or proposal_layer_py if 
+        cfg.TORCH_PROPOSAL_LAYER is False. With 'auto' the torch layer runs
+        for network outputs on the gpu, the (faster) numpy one on the cpu.
 
         Input parameters:
             class_prob_reshape: (torch.autograd.variable.Variable)
@@ -317,37 +769,82 @@ class TDID(torch.nn.Module):
             anchor_scales: (list of int)
             
             gt_boxes (optional): (ndarray) Defatul: None
+            anchor_grid (optional): (AnchorGrid) Default: None
+            workspace (optional): (Workspace) only used by proposal_layer_py
+                                  Default: None
+            score_thresh (optional): (float) Default: None
+            max_keep (optional): (int) Default: 0
+            nms_thresh (optional): (float) Default: None
+            budget (optional): (ProposalBudget) Default: None
                         
-        
+        Returns:
+            rois: (torch.autograd.variable.Variable) BxMx4
+            scores: (torch.autograd.variable.Variable) BxMx1
+            anchor_inds: (torch.autograd.variable.Variable) BxMx1
+            labels: (torch.autograd.variable.Variable) BxM
+            num_valid: (torch.LongTensor) B number of valid proposals for
+                       each batch element, the rest are padding
         '''
+        use_torch = cfg.TORCH_PROPOSAL_LAYER
+        if use_torch == 'auto':
+            use_torch = class_prob_reshape.is_cuda
+        if use_torch:
+            #stays on the device of the network output
+            rois, scores, anchor_inds, labels, num_valid = proposal_layer_torch(
+                                                       class_prob_reshape.data,
+                                                       bbox_pred.data,
+                                                       img_info, cfg, 
+                                                       _feat_stride=_feat_stride,
+                                                       anchor_scales=anchor_scales,
+                                                       gt_boxes=gt_boxes,
+                                                       anchor_grid=anchor_grid,
+                                                       score_thresh=score_thresh,
+                                                       max_keep=max_keep,
+                                                       nms_thresh=nms_thresh,
+                                                       budget=budget)
+            return (Variable(rois), Variable(scores), Variable(anchor_inds),
+                    Variable(labels), num_valid)
         
         #convert to  numpy
+        device = class_prob_reshape.device
         class_prob_reshape = class_prob_reshape.data.cpu().numpy()
         bbox_pred = bbox_pred.data.cpu().numpy()
 
-        rois, scores, anchor_inds, labels = proposal_layer_py(
+        rois, scores, anchor_inds, labels, num_valid = proposal_layer_py(
                                                        class_prob_reshape,
                                                        bbox_pred,
                                                        img_info, cfg, 
                                                        _feat_stride=_feat_stride,
                                                        anchor_scales=anchor_scales,
-                                                       gt_boxes=gt_boxes)
+                                                       gt_boxes=gt_boxes,
+                                                       anchor_grid=anchor_grid,
+                                                       workspace=workspace,
+                                                       score_thresh=score_thresh,
+                                                       max_keep=max_keep,
+                                                       nms_thresh=nms_thresh,
+                                                       budget=budget)
         #convert to pytorch
-        rois = np_to_variable(rois, is_cuda=True)
-        anchor_inds = np_to_variable(anchor_inds, is_cuda=True,
+        rois = np_to_variable(rois, device=device)
+        anchor_inds = np_to_variable(anchor_inds, device=device,
                                                  dtype=torch.LongTensor)
-        labels = np_to_variable(labels, is_cuda=True,
+        labels = np_to_variable(labels, device=device,
                                              dtype=torch.LongTensor)
-        scores = np_to_variable(scores, is_cuda=True)
-        return rois, scores, anchor_inds, labels
+        scores = np_to_variable(scores, device=device)
+        num_valid = torch.from_numpy(num_valid)
+        return rois, scores, anchor_inds, labels, num_valid
 
 
     @staticmethod
     def anchor_target_layer(class_score, gt_boxes, img_info,
-                            cfg, _feat_stride, anchor_scales):
+                            cfg, _feat_stride, anchor_scales,
+                            anchor_grid=None, assignment_cache=None,
+                            workspace=None):
         ''' 
         Assigns fg/bg label to anchor boxes.      
 
+        Wrapper for anchor_target_layer_torch, or anchor_target_layer_py if 
+        cfg.TORCH_ANCHOR_TARGET_LAYER is False. With 'auto' the torch layer
+        runs for network outputs on the gpu, the numpy one on the cpu.
 
         Input parameters:
             class_score:  (torch.autograd.variable.Variable)
@@ -357,26 +854,48 @@ class TDID(torch.nn.Module):
             _feat_stride:  (int)
             anchor_scales: (list of int)
 
+            anchor_grid (optional): (AnchorGrid) Default: None
+            assignment_cache (optional): (AnchorAssignmentCache) 
+                                         Default: None
+            workspace (optional): (Workspace) only used by 
+                                  anchor_target_layer_py. Default: None
+
         Returns:
-            labels: (torch.autograd.variable.Variable)
-            bbox_targets: (torch.autograd.variable.Variable)
-            bbox_inside_weights:(torch.autograd.variable.Variable)
-            bbox_outside_weights:(torch.autograd.variable.Variable)
+            anchor_inds: (torch.autograd.variable.Variable) S sampled anchors
+            labels: (torch.autograd.variable.Variable) S
+            bbox_targets: (torch.autograd.variable.Variable) Fx4, for the
+                          anchors with label 1
         ''' 
-        class_score = class_score.data.cpu().numpy()
-        labels, bbox_targets, bbox_inside_weights, bbox_outside_weights = \
-            anchor_target_layer_py(class_score, gt_boxes, img_info,
-                                   cfg, _feat_stride, anchor_scales)
-
-        labels = np_to_variable(labels, is_cuda=True, dtype=torch.LongTensor)
-        bbox_targets = np_to_variable(bbox_targets, is_cuda=True)
-        bbox_inside_weights = np_to_variable(bbox_inside_weights, is_cuda=True)
-        bbox_outside_weights = np_to_variable(bbox_outside_weights, is_cuda=True)
-
-        return labels, bbox_targets, bbox_inside_weights, bbox_outside_weights
+        use_torch = cfg.TORCH_ANCHOR_TARGET_LAYER
+        if use_torch == 'auto':
+            use_torch = class_score.is_cuda
+        if use_torch:
+            #made on the device of the network output
+            anchor_data = anchor_target_layer_torch(class_score.data, gt_boxes,
+                                                    img_info, cfg, 
+                                                    _feat_stride, anchor_scales,
+                                            anchor_grid=anchor_grid,
+                                            assignment_cache=assignment_cache)
+            return tuple(Variable(data) for data in anchor_data)
+
+        #only the shape of class_score is used, no need to copy it
+        anchor_inds, labels, bbox_targets = \
+            anchor_target_layer_py(class_score.data, gt_boxes, img_info,
+                                   cfg, _feat_stride, anchor_scales,
+                                   anchor_grid=anchor_grid,
+                                   assignment_cache=assignment_cache,
+                                   workspace=workspace)
+
+        device = class_score.device
+        anchor_inds = np_to_variable(anchor_inds, device=device,
+                                     dtype=torch.LongTensor)
+        labels = np_to_variable(labels, device=device, dtype=torch.LongTensor)
+        bbox_targets = np_to_variable(bbox_targets, device=device)
+
+        return anchor_inds, labels, bbox_targets
 
     def get_features(self, img_data):
-        img_data = np_to_variable(img_data, is_cuda=True)
+        img_data = np_to_variable(img_data, device=self.device)
         img_data = img_data.permute(0, 3, 1, 2)
         features = self.features(img_data)
 
@@ -0,0 +1,172 @@
+# --------------------------------------------------------
+# Offline anchor assignment cache
+#
+# Before subsampling, the labels of the anchors only depend on the gt box,
+# the anchor grid (feature map and image size) and a few config values.
+# Every training pair (scene image, target instance, resize) always has the
+# same gt box, so its labels can be computed once, stored on disk, and only
+# the random subsampling is left for training time.
+# --------------------------------------------------------
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from .anchor_target_layer import anchor_labels
+
+#bump when the stored format or the labeling rules change
+CACHE_VERSION = 1
+
+
+def cache_signature(cfg, _feat_stride=16):
+    '''
+    Hash of everything the stored labels depend on besides the gt box and
+    grid, so a cache made with other settings is never used
+
+    Input parameters:
+        cfg: (Config)
+
+        _feat_stride (optional): (int) Default: 16
+
+    Returns:
+        (str) hex signature
+    '''
+    settings = _cache_settings(cfg, _feat_stride)
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()
+                       ).hexdigest()[:16]
+
+
+def _cache_settings(cfg, _feat_stride):
+    return {'version': CACHE_VERSION,
+            'anchor_scales': [float(s) for s in cfg.ANCHOR_SCALES],
+            'feat_stride': int(_feat_stride),
+            'negative_overlap': float(cfg.PROPOSAL_NEGATIVE_OVERLAP),
+            'positive_overlap': float(cfg.PROPOSAL_POSITIVE_OVERLAP),
+            'clobber_positives': bool(cfg.PROPOSAL_CLOBBER_POSITIVES)}
+
+
+def _entry_key(anchor_grid, gt_box):
+    '''(H, W, image height, image width, x1, y1, x2, y2) float32 key'''
+    return np.array([anchor_grid.height, anchor_grid.width,
+                     anchor_grid.img_height, anchor_grid.img_width] +
+                    list(np.asarray(gt_box[:4], dtype=np.float32)),
+                    dtype=np.float32)
+
+
+class AnchorAssignmentCache(object):
+    '''
+    Read only, memory mapped anchor labels made by write_anchor_assignments
+
+    For each stored (anchor grid, gt box) it has the positions (in the
+    grid's inds_inside) of the fg anchors (label 1) and of the dont care
+    anchors (label -1). Every other inside anchor is bg (label 0).
+
+    If there is no cache for the current settings (see cache_signature),
+    nothing is found and the anchor target layer computes all labels.
+
+    Input parameters:
+        cache_dir: (str) directory with one sub directory per signature
+        cfg: (Config)
+
+        _feat_stride (optional): (int) Default: 16
+    '''
+
+    def __init__(self, cache_dir, cfg, _feat_stride=16):
+        self.path = os.path.join(cache_dir, cache_signature(cfg, _feat_stride))
+        self._index = {}
+        if not os.path.isfile(os.path.join(self.path, 'keys.npy')):
+            return
+        load = lambda name: np.load(os.path.join(self.path, name + '.npy'),
+                                    mmap_mode='r')
+        self._fg = load('fg')
+        self._fg_offsets = np.asarray(load('fg_offsets'))
+        self._ignore = load('ignore')
+        self._ignore_offsets = np.asarray(load('ignore_offsets'))
+        keys = np.asarray(load('keys'))
+        self._index = dict((key.tobytes(), ind)
+                           for ind, key in enumerate(keys))
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, anchor_grid, gt_boxes):
+        '''
+        Stored labels of each gt box
+
+        Input parameters:
+            anchor_grid: (AnchorGrid)
+            gt_boxes: (ndarray) Gx4 (or more columns) gt boxes
+
+        Returns:
+            (list) for each box, None if it is not stored, else a tuple
+            (fg positions, dont care positions) of int32 ndarrays
+        '''
+        found = []
+        for gt_box in gt_boxes:
+            ind = self._index.get(_entry_key(anchor_grid, gt_box).tobytes())
+            if ind is None:
+                found.append(None)
+                continue
+            found.append((self._fg[self._fg_offsets[ind]:
+                                   self._fg_offsets[ind+1]],
+                          self._ignore[self._ignore_offsets[ind]:
+                                       self._ignore_offsets[ind+1]]))
+        return found
+
+
+def write_anchor_assignments(cache_dir, cfg, grids_and_boxes,
+                             _feat_stride=16):
+    '''
+    Computes and stores the anchor labels of many (anchor grid, gt box)
+    pairs, replacing any cache made with the same settings
+
+    Input parameters:
+        cache_dir: (str) directory with one sub directory per signature
+        cfg: (Config)
+        grids_and_boxes: (iterable) of (AnchorGrid, Gx4 ndarray gt boxes)
+
+        _feat_stride (optional): (int) Default: 16
+
+    Returns:
+        (str) path of the written cache
+    '''
+    path = os.path.join(cache_dir, cache_signature(cfg, _feat_stride))
+    all_keys = []
+    all_fg = []
+    all_ignore = []
+    seen = set()
+    for anchor_grid, gt_boxes in grids_and_boxes:
+        keys = [_entry_key(anchor_grid, gt_box) for gt_box in gt_boxes]
+        new = [ind for ind, key in enumerate(keys)
+               if key.tobytes() not in seen]
+        if len(new) == 0:
+            continue
+        labels = anchor_labels(anchor_grid, np.asarray(gt_boxes)[new], cfg)
+        for ind, row in zip(new, labels):
+            seen.add(keys[ind].tobytes())
+            all_keys.append(keys[ind])
+            all_fg.append(np.where(row == 1)[0].astype(np.int32))
+            all_ignore.append(np.where(row == -1)[0].astype(np.int32))
+
+    # write next to the old cache, then swap, so readers never see half
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    save = lambda name, arr: np.save(os.path.join(tmp_path, name + '.npy'),
+                                     arr)
+    save('keys', np.asarray(all_keys, dtype=np.float32).reshape((-1, 8)))
+    for name, sets in (('fg', all_fg), ('ignore', all_ignore)):
+        offsets = np.zeros(len(sets) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in sets])
+        save(name, np.concatenate(sets) if len(sets) > 0
+                   else np.zeros(0, dtype=np.int32))
+        save(name + '_offsets', offsets)
+    with open(os.path.join(tmp_path, 'settings.json'), 'w') as f:
+        json.dump(_cache_settings(cfg, _feat_stride), f, sort_keys=True)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return path
@@ -0,0 +1,212 @@
+# --------------------------------------------------------
+# Anchor grid cache
+#
+# The shifted anchors for a feature map only depend on its size, the
+# feature stride, the anchor scales and (for the inside-image set) the
+# image size. AVD scenes almost always have the same resolution, so these
+# are computed once and reused by the proposal and anchor target layers.
+# --------------------------------------------------------
+
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from .generate_anchors import generate_anchors
+
+
+class AnchorGrid(object):
+    '''
+    All shifted anchors of one feature map, plus values derived from them.
+
+    Anchor rows are ordered by (h, w, a), slowest to fastest.
+
+    Input parameters:
+        height: (int) feature map height
+        width: (int) feature map width
+        _feat_stride: (int) scaling factor between feature map and image
+        anchor_scales: (list of int) scale for size of anchor boxes
+        img_info: (tuple of int) image (height, width, ...)
+
+        allowed_border (optional): (int) how far anchors can sit over the
+                                   image edge and still be inside. Default: 0
+
+    Attributes:
+        num_base_anchors: (int) A, anchors per feature map cell
+        anchors: (ndarray) (H*W*A)x4 float32
+        widths, heights, ctr_x, ctr_y, areas: (ndarray) H*W*A, as computed
+                                              by bbox_transform
+        inds_inside: (ndarray) indices of anchors fully inside the image
+        inside_anchors: (ndarray) len(inds_inside)x4 anchors[inds_inside]
+        inside_areas: (ndarray) areas[inds_inside]
+        inside_pos: (ndarray) H*W*A position of each anchor in inds_inside,
+                    -1 for anchors that are not inside
+    '''
+
+    def __init__(self, height, width, _feat_stride, anchor_scales, img_info,
+                 allowed_border=0):
+        self.height = height
+        self.width = width
+        self.feat_stride = _feat_stride
+        self.img_height = int(img_info[0])
+        self.img_width = int(img_info[1])
+
+        _anchors = generate_anchors(scales=np.array(anchor_scales))
+        self.num_base_anchors = _anchors.shape[0]
+        self.base_anchors = _anchors
+
+        # Enumerate all shifts
+        shift_x = np.arange(0, width) * _feat_stride
+        shift_y = np.arange(0, height) * _feat_stride
+        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                            shift_x.ravel(), shift_y.ravel())).transpose()
+
+        # add A anchors (1, A, 4) to
+        # cell K shifts (K, 1, 4) to get
+        # shift anchors (K, A, 4)
+        # reshape to (K*A, 4) shifted anchors
+        A = self.num_base_anchors
+        K = shifts.shape[0]
+        anchors = (_anchors.reshape((1, A, 4)) +
+                   shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
+        #anchor corners are whole or half pixels, exact in float32
+        self.anchors = anchors.reshape((K * A, 4)).astype(np.float32)
+        self.num_anchors = K * A
+
+        self.widths = self.anchors[:, 2] - self.anchors[:, 0] + 1.0
+        self.heights = self.anchors[:, 3] - self.anchors[:, 1] + 1.0
+        self.ctr_x = self.anchors[:, 0] + 0.5 * self.widths
+        self.ctr_y = self.anchors[:, 1] + 0.5 * self.heights
+        self.areas = self.widths * self.heights
+
+        # only keep anchors inside the image
+        self.inds_inside = np.where(
+            (self.anchors[:, 0] >= -allowed_border) &
+            (self.anchors[:, 1] >= -allowed_border) &
+            (self.anchors[:, 2] < img_info[1] + allowed_border) &  # width
+            (self.anchors[:, 3] < img_info[0] + allowed_border)  # height
+        )[0]
+        self.inside_anchors = self.anchors[self.inds_inside, :]
+        self.inside_areas = self.areas[self.inds_inside]
+        # position of each anchor in inds_inside, -1 if it is not inside
+        self.inside_pos = np.full(self.num_anchors, -1, dtype=np.int64)
+        self.inside_pos[self.inds_inside] = np.arange(len(self.inds_inside))
+
+        self._torch_copies = {}
+
+    def window_inds(self, boxes):
+        '''
+        Inside anchors that can overlap each box
+
+        Anchors are found by cell, only the cells in the window around a
+        box that anchors of any shape can reach are checked. All other
+        anchors have an IoU of 0 with the box.
+
+        Input parameters:
+            boxes: (ndarray) Gx4 (x1, y1, x2, y2)
+
+        Returns:
+            box_ids: (ndarray) int64 index of the box of each pair
+            positions: (ndarray) int64 position of the anchor of each pair
+                       in inds_inside, ascending for each box
+        '''
+        boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+        stride = self.feat_stride
+        A = self.num_base_anchors
+
+        # how far anchors of any shape reach from their cell's corner
+        min_x1, min_y1 = self.base_anchors[:, :2].min(axis=0)
+        max_x2, max_y2 = self.base_anchors[:, 2:].max(axis=0)
+        # an anchor overlaps a box if their +1 extents intersect
+        w_min = np.maximum(np.floor((boxes[:, 0] - 1 - max_x2) / stride), 0)
+        w_max = np.minimum(np.ceil((boxes[:, 2] + 1 - min_x1) / stride),
+                           self.width - 1)
+        h_min = np.maximum(np.floor((boxes[:, 1] - 1 - max_y2) / stride), 0)
+        h_max = np.minimum(np.ceil((boxes[:, 3] + 1 - min_y1) / stride),
+                           self.height - 1)
+        num_w = np.maximum(w_max - w_min + 1, 0).astype(np.int64)
+        num_h = np.maximum(h_max - h_min + 1, 0).astype(np.int64)
+
+        # all cells of all windows, box by box in (h, w) order
+        num_cells = num_w * num_h
+        box_ids = np.repeat(np.arange(len(boxes)), num_cells)
+        cell_inds = (np.arange(num_cells.sum()) -
+                     np.repeat(np.cumsum(num_cells) - num_cells, num_cells))
+        cells = ((h_min[box_ids] + cell_inds // num_w[box_ids]) * self.width +
+                 w_min[box_ids] + cell_inds % num_w[box_ids]).astype(np.int64)
+
+        positions = self.inside_pos[(cells[:, np.newaxis] * A + 
+                                     np.arange(A)).ravel()]
+        box_ids = np.repeat(box_ids, A)
+        inside = positions >= 0
+        return box_ids[inside], positions[inside]
+
+    def torch_anchors(self, like):
+        '''
+        The anchors as a tensor with the same dtype and device as like
+        '''
+        return self._torch_copy('anchors', like.device, like.dtype)
+
+    def torch_inside(self, like):
+        '''
+        inside_anchors and inds_inside as tensors on the device of like
+
+        Returns:
+            inside_anchors: (torch.Tensor) same dtype as like
+            inds_inside: (torch.LongTensor)
+        '''
+        return (self._torch_copy('inside_anchors', like.device, like.dtype),
+                self._torch_copy('inds_inside', like.device, torch.long))
+
+    def _torch_copy(self, name, device, dtype):
+        '''
+        Tensor copy of attribute name, made once per (device, dtype) and kept
+        '''
+        key = (name, str(device), dtype)
+        if key not in self._torch_copies:
+            self._torch_copies[key] = torch.from_numpy(
+                                         getattr(self, name)).to(device=device,
+                                                                 dtype=dtype)
+        return self._torch_copies[key]
+
+
+class AnchorGridCache(object):
+    '''
+    Bounded, least recently used cache of AnchorGrids
+
+    Input parameters:
+        max_size (optional): (int) max number of grids kept. Default: 8
+    '''
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self._grids = OrderedDict()
+
+    def get(self, height, width, _feat_stride, anchor_scales, img_info):
+        '''
+        Get the AnchorGrid for a feature map, building it if needed
+
+        Input parameters:
+            height: (int) feature map height
+            width: (int) feature map width
+            _feat_stride: (int) scaling factor between feature map and image
+            anchor_scales: (list of int) scale for size of anchor boxes
+            img_info: (tuple of int) image (height, width, ...)
+
+        Returns:
+            (AnchorGrid)
+        '''
+        key = (int(height), int(width), _feat_stride, tuple(anchor_scales),
+               int(img_info[0]), int(img_info[1]))
+        if key in self._grids:
+            grid = self._grids.pop(key)
+        else:
+            grid = AnchorGrid(height, width, _feat_stride, anchor_scales,
+                              img_info)
+            if len(self._grids) >= self.max_size:
+                self._grids.popitem(last=False)
+        self._grids[key] = grid
+        return grid
+
+    def __len__(self):
+        return len(self._grids)
@@ -11,12 +11,13 @@ import yaml
 import numpy as np
 import numpy.random as npr
 
-from .generate_anchors import generate_anchors
-from .cython_bbox import bbox_overlaps, bbox_intersections
-from .bbox_transform import bbox_transform
+from .anchor_grid import AnchorGrid
+from .cython_bbox import bbox_pair_overlaps
+from .workspace import Workspace
 
 def anchor_target_layer(cls_score, gt_boxes, img_info, cfg, _feat_stride=16,
-                        anchor_scales=[2, 4, 8,]):
+                        anchor_scales=[2, 4, 8,], anchor_grid=None,
+                        assignment_cache=None, workspace=None):
     ''' 
     Produces anchor classification labels and bounding-box regression targets.
     
@@ -31,12 +32,21 @@ def anchor_target_layer(cls_score, gt_boxes, img_info, cfg, _feat_stride=16,
                                 Default: 16 
         anchor_scales (optional):  (list of int) scale for size of anchor boxes
                                    Default: [2,4,8]
+        anchor_grid (optional): (AnchorGrid) shifted anchors for this feature
+                                map size, made here if None. Default: None
+        assignment_cache (optional): (AnchorAssignmentCache) stored labels
+                                     of known gt boxes. Default: None
+        workspace (optional): (Workspace) reused temporary arrays, made 
+                              here if None. Default: None
 
     Returns:
-        all_labels : (ndarray) labels assigned to each anchor box
-        all_bbox_targets:  (ndarray) box parameter targets for each anchor
-        all_bbox_inside_weights: (ndarray) to be removed
-        all_bbox_outside_weights: (ndarray) to be removed
+        all_anchor_inds: (ndarray) S int64 index of each sampled anchor box,
+                         batch_ind*(H*W*A) + anchor index, with anchors 
+                         ordered by (h, w, a)
+        all_labels : (ndarray) S int64 fg(1)/bg(0) label of each sampled 
+                     anchor box
+        all_bbox_targets:  (ndarray) Fx4 float32 box parameter targets of 
+                           the fg sampled anchors (all_labels == 1), in order
 
     ''' 
     # Algorithm:
@@ -48,196 +58,210 @@ def anchor_target_layer(cls_score, gt_boxes, img_info, cfg, _feat_stride=16,
     # measure GT overlap
 
     batch_size = cls_score.shape[0]
-
-    _anchors = generate_anchors(scales=np.array(anchor_scales))
-    _num_anchors = _anchors.shape[0]
-
-    # allow boxes to sit over the edge by a small amount
-    _allowed_border = 0
+    if workspace is None:
+        workspace = Workspace()
 
     # map of shape (..., H, W)
     # pytorch (bs, c, h, w)
     height, width = cls_score.shape[2:4]
 
-    # 1. Generate proposals from bbox deltas and shifted anchors
-    shift_x = np.arange(0, width) * _feat_stride
-    shift_y = np.arange(0, height) * _feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)  # in W H order
-    # K is H x W
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                        shift_x.ravel(), shift_y.ravel())).transpose()
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    A = _num_anchors
-    K = shifts.shape[0]
-    all_anchors = (_anchors.reshape((1, A, 4)) +
-                   shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
-    all_anchors = all_anchors.reshape((K * A, 4))
-    total_anchors = int(K * A)
-
-    # only keep anchors inside the image
-    inds_inside = np.where(
-        (all_anchors[:, 0] >= -_allowed_border) &
-        (all_anchors[:, 1] >= -_allowed_border) &
-        (all_anchors[:, 2] < img_info[1] + _allowed_border) &  # width
-        (all_anchors[:, 3] < img_info[0] + _allowed_border)  # height
-    )[0]
-
-    # keep only inside anchors
-    anchors = all_anchors[inds_inside, :]
-
-    all_labels = None 
-    all_bbox_targets = None 
-    all_bbox_inside_weights = None
-    all_bbox_outside_weights = None 
-
-    for batch_ind in range(batch_size):
-
-        # label: 1 is positive, 0 is negative, -1 is dont care
-        labels = np.empty((len(inds_inside),), dtype=np.float32)
-        labels.fill(-1)
-
-        #get rid of background gt_boxes
-        gt_box = np.expand_dims(gt_boxes[batch_ind,:], 0)
-        if gt_box[0,-1] == 0:
-            #if target is not present(no gt box) all boxes are bg (0)
-            labels.fill(0)
-        else:
-            # overlaps between the anchors and the gt boxes
-            # overlaps (ex, gt), shape is A x G
-            overlaps = bbox_overlaps(
-                np.ascontiguousarray(anchors, dtype=np.float),
-                np.ascontiguousarray(gt_box, dtype=np.float))
-            argmax_overlaps = overlaps.argmax(axis=1)  # (A)
-            max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-            gt_argmax_overlaps = overlaps.argmax(axis=0)  # G
-            gt_max_overlaps = overlaps[gt_argmax_overlaps,
-                                       np.arange(overlaps.shape[1])]
-            gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
-
-            if not cfg.PROPOSAL_CLOBBER_POSITIVES:
-                # assign bg labels first so that positive labels can clobber them
-                labels[max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP] = 0
-
-            # fg label: for each gt, anchor with highest overlap
-            labels[gt_argmax_overlaps] = 1
-            # fg label: above threshold IOU
-            labels[max_overlaps >= cfg.PROPOSAL_POSITIVE_OVERLAP] = 1
-
-            if cfg.PROPOSAL_CLOBBER_POSITIVES:
-                # assign bg labels last so that negative labels can clobber positives
-                labels[max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP] = 0
-
-
-        # subsample positive labels if we have too many
-        num_fg = int(cfg.PROPOSAL_FG_FRACTION * cfg.PROPOSAL_BATCH_SIZE)
-        fg_inds = np.where(labels == 1)[0]
-        if len(fg_inds) > num_fg:
-            disable_inds = npr.choice(
-                fg_inds, size=(len(fg_inds) - num_fg), replace=False)
-            labels[disable_inds] = -1
-
-        # subsample negative labels if we have too many
-        num_bg = cfg.PROPOSAL_BATCH_SIZE - np.sum(labels == 1)
-        bg_inds = np.where(labels == 0)[0]
-        if len(bg_inds) > num_bg:
-
-            disable_inds = npr.choice(
-                bg_inds, size=(len(bg_inds) - num_bg), replace=False)
-            labels[disable_inds] = -1
-
-        #if the gt_box is a dummy bg, there are no bbox_targets
-        if gt_box[0,-1] == 0:
-            bbox_targets = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        else:
-            bbox_targets = _compute_targets(anchors, gt_box[argmax_overlaps, :])
-
-        bbox_inside_weights = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        bbox_inside_weights[labels == 1, :] = np.array(cfg.PROPOSAL_BBOX_INSIDE_WEIGHTS)
-
-        bbox_outside_weights = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        if cfg.PROPOSAL_POSITIVE_WEIGHT < 0:
-            # uniform weighting of examples (given non-uniform sampling)
-            positive_weights = np.ones((1, 4))
-            negative_weights = np.zeros((1, 4))
-        else:
-            assert ((cfg.PROPOSAL_POSITIVE_WEIGHT > 0) &
-                    (cfg.PROPOSAL_POSITIVE_WEIGHT < 1))
-            positive_weights = (cfg.PROPOSAL_POSITIVE_WEIGHT /
-                                (np.sum(labels == 1)) + 1)
-            negative_weights = ((1.0 - cfg.PROPOSAL_POSITIVE_WEIGHT) /
-                                (np.sum(labels == 0)) + 1)
-        bbox_outside_weights[labels == 1, :] = positive_weights
-        bbox_outside_weights[labels == 0, :] = negative_weights
-
-        # map up to original set of anchors
-        labels = _unmap(labels, total_anchors, inds_inside, fill=-1)
-        bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, fill=0)
-        bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, fill=0)
-        bbox_outside_weights = _unmap(bbox_outside_weights, total_anchors, inds_inside, fill=0)
-
-        # labels
-        labels = labels.reshape((1, height, width, A))
-        labels = labels.transpose(0, 3, 1, 2)
-        labels = labels.reshape((1, 1, A * height, width)).transpose(0, 2, 3, 1)
-        #labels = labels
-
-        # bbox_targets
-        bbox_targets = bbox_targets \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-
-        bbox_targets = bbox_targets
-        # bbox_inside_weights
-        bbox_inside_weights = bbox_inside_weights \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-
-        bbox_inside_weights = bbox_inside_weights
-
-        # bbox_outside_weights
-        bbox_outside_weights = bbox_outside_weights \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-
-        bbox_outside_weights = bbox_outside_weights
-
-        #finished one batch, update data structs
-        if all_labels is None:
-            all_labels = labels
-            all_bbox_targets = bbox_targets
-            all_bbox_inside_weights = bbox_inside_weights
-            all_bbox_outside_weights = bbox_outside_weights
-        else:
-            all_labels = np.concatenate((all_labels,labels),0)
-            all_bbox_targets = np.concatenate((all_bbox_targets,
-                                                  bbox_targets), 0)
-            all_bbox_inside_weights = np.concatenate((all_bbox_inside_weights,
-                                                          bbox_inside_weights),0)
-            all_bbox_outside_weights = np.concatenate((all_bbox_outside_weights,
-                                                           bbox_outside_weights),0)
-
-    return all_labels, all_bbox_targets, all_bbox_inside_weights, all_bbox_outside_weights
-
-
-def _unmap(data, count, inds, fill=0):
-    """ Unmap a subset of item (data) back to the original set of items (of
-    size count) """
-    if len(data.shape) == 1:
-        ret = np.empty((count,), dtype=np.float32)
-        ret.fill(fill)
-        ret[inds] = data
-    else:
-        ret = np.empty((count,) + data.shape[1:], dtype=np.float32)
-        ret.fill(fill)
-        ret[inds, :] = data
-    return ret
-
-
-def _compute_targets(ex_rois, gt_rois):
-    """Compute bounding-box regression targets for an image."""
-
-    assert ex_rois.shape[0] == gt_rois.shape[0]
-    assert ex_rois.shape[1] == 4
+    # 1. Generate shifted anchors, only keep anchors inside the image
+    # (anchors may not sit over the image edge)
+    if anchor_grid is None:
+        anchor_grid = AnchorGrid(height, width, _feat_stride, anchor_scales,
+                                 img_info)
+    inds_inside = anchor_grid.inds_inside
+    num_inside = len(inds_inside)
+
+    # every batch element has one gt box, dummy bg boxes have class 0
+    has_gt = gt_boxes[:, -1] != 0
+
+    # label: 1 is positive, 0 is negative, -1 is dont care
+    # rows are batch elements, columns are inside anchors.
+    # if target is not present(no gt box) all boxes are bg (0)
+    labels = workspace.get('anchor_labels', (batch_size, num_inside))
+    labels.fill(-1)
+    labels[~has_gt] = 0
+
+    gt_inds = np.where(has_gt)[0]
+    if gt_inds.size > 0 and num_inside > 0:
+        stored = [None] * len(gt_inds)
+        if assignment_cache is not None:
+            # labels of pairs seen before are read from the offline cache
+            stored = assignment_cache.lookup(anchor_grid, gt_boxes[gt_inds])
+        for gt_ind, found in zip(gt_inds, stored):
+            if found is not None:
+                fg_positions, ignore_positions = found
+                labels[gt_ind] = 0
+                labels[gt_ind, ignore_positions] = -1
+                labels[gt_ind, fg_positions] = 1
+        missing = gt_inds[[found is None for found in stored]]
+        if missing.size > 0:
+            labels[missing] = anchor_labels(anchor_grid, gt_boxes[missing], 
+                                            cfg, 
+                                            workspace.get('missing_labels',
+                                                          (missing.size,
+                                                           num_inside)))
+
+    # subsample positive labels if we have too many
+    num_fg = int(cfg.PROPOSAL_FG_FRACTION * cfg.PROPOSAL_BATCH_SIZE)
+    mask = workspace.get('anchor_label_mask', labels.shape, np.bool_)
+    np.equal(labels, 1, out=mask)
+    labels[_subsample(mask, num_fg, workspace)] = -1
+
+    # subsample negative labels if we have too many
+    num_bg = cfg.PROPOSAL_BATCH_SIZE - np.sum(np.equal(labels, 1, out=mask),
+                                              axis=1)
+    np.equal(labels, 0, out=mask)
+    labels[_subsample(mask, num_bg, workspace)] = -1
+
+    # only the sampled anchors are returned, indexed like the proposal
+    # layer's anchor_inds: batch_ind*total_anchors + anchor index, with
+    # anchors ordered by (h, w, a)
+    total_anchors = anchor_grid.num_anchors
+    batch_inds, sampled = np.nonzero(np.not_equal(labels, -1, out=mask))
+    all_anchor_inds = batch_inds*total_anchors + inds_inside[sampled]
+    all_labels = labels[batch_inds, sampled].astype(np.int64)
+
+    # regression targets of the fg anchors. A dummy bg gt_box has no fg
+    fg = all_labels == 1
+    all_bbox_targets = _compute_targets(anchor_grid, 
+                                        inds_inside[sampled[fg]],
+                                        gt_boxes[batch_inds[fg], :])
+
+    return all_anchor_inds, all_labels, all_bbox_targets
+
+
+def anchor_labels(anchor_grid, gt_boxes, cfg, out=None):
+    """
+    fg(1)/bg(0)/dont care(-1) label of every inside anchor for each gt box,
+    before subsampling
+
+    Input parameters:
+        anchor_grid: (AnchorGrid)
+        gt_boxes: (ndarray) Gx4 (or more columns) gt boxes
+        cfg: (Config)
+
+        out (optional): (ndarray) GxN float32 array for the labels. 
+                        Default: None
+
+    Returns:
+        (ndarray) GxN float32 labels, N = len(anchor_grid.inds_inside)
+    """
+    gt = np.asarray(gt_boxes)[:, :4].astype(np.float32)
+    labels = out
+    if labels is None:
+        labels = np.empty((len(gt), len(anchor_grid.inds_inside)), 
+                          dtype=np.float32)
+    if labels.size == 0:
+        return labels
+
+    # only anchors in the window around a gt box can overlap it, so
+    # overlaps are only computed for those (box, anchor) pairs. One gt
+    # box per element, so its overlaps are the max overlaps
+    box_ids, positions = anchor_grid.window_inds(gt)
+    window_overlaps = bbox_pair_overlaps(anchor_grid.inside_anchors, gt, 
+                                         positions, box_ids)
+    # every other anchor has overlap 0. Pairs are grouped by box
+    gt_max_overlaps = np.zeros(len(gt), dtype=np.float32)
+    if box_ids.size > 0:
+        starts = np.flatnonzero(np.diff(box_ids, prepend=-1))
+        gt_max_overlaps[box_ids[starts]] = np.maximum.reduceat(
+                                                window_overlaps, starts)
+
+    # anchors outside the windows all get the label of overlap 0
+    labels[:] = _overlap_labels(np.zeros_like(gt_max_overlaps),
+                                gt_max_overlaps, cfg)[:, np.newaxis]
+    labels[box_ids, positions] = _overlap_labels(window_overlaps, 
+                                                 gt_max_overlaps[box_ids], 
+                                                 cfg)
+    return labels
+
+
+def _overlap_labels(max_overlaps, gt_max_overlaps, cfg):
+    """
+    fg(1)/bg(0)/dont care(-1) label of anchors from their overlap with
+    their gt box, and the highest overlap of any anchor with that box
+    """
+    labels = np.empty(max_overlaps.shape, dtype=np.float32)
+    labels.fill(-1)
+
+    if not cfg.PROPOSAL_CLOBBER_POSITIVES:
+        # assign bg labels first so that positive labels can clobber them
+        labels[max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP] = 0
+
+    # fg label: for each gt, anchor with highest overlap
+    labels[max_overlaps == gt_max_overlaps] = 1
+    # fg label: above threshold IOU
+    labels[max_overlaps >= cfg.PROPOSAL_POSITIVE_OVERLAP] = 1
+
+    if cfg.PROPOSAL_CLOBBER_POSITIVES:
+        # assign bg labels last so that negative labels can clobber positives
+        labels[max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP] = 0
+    return labels
+
+
+def _subsample(mask, max_num, workspace=None):
+    """
+    Pick random entries of each row of mask to disable, leaving max_num.
+
+    Same as disabling a random (npr.choice) subset of each row's True 
+    entries, for all rows at once.
+
+    Input parameters:
+        mask: (ndarray) BxN bool
+        max_num: (int or ndarray) max True entries to keep in each row
+
+        workspace (optional): (Workspace) for the returned array, made here
+                              if None. Default: None
+
+    Returns:
+        (ndarray) BxN bool, True for the entries to disable
+    """
+    if workspace is None:
+        workspace = Workspace()
+    disable = workspace.zeros('subsample_disable', mask.shape, np.bool_)
+    max_num = np.broadcast_to(max_num, (mask.shape[0],))
+    rows = np.where(mask.sum(axis=1) > max_num)[0]
+    if rows.size == 0:
+        return disable
+
+    # keep the max_num True entries with the smallest random keys
+    keys = npr.rand(rows.size, mask.shape[1])
+    keys[~mask[rows]] = 2
+    max_num = max_num[rows]
+    thresholds = np.partition(keys, np.unique(max_num), axis=1)
+    thresholds = thresholds[np.arange(rows.size), max_num]
+    disable[rows] = keys >= thresholds[:, np.newaxis]
+    disable[rows] &= mask[rows]
+    return disable
+
+
+def _compute_targets(anchor_grid, anchor_inds, gt_rois):
+    """
+    Compute bounding-box regression targets of anchors, same as 
+    bbox_transform with the anchor sizes and centers from anchor_grid.
+
+    Returns:
+        (ndarray) len(anchor_inds)x4 float32
+    """
+    assert anchor_inds.shape[0] == gt_rois.shape[0]
     assert gt_rois.shape[1] == 5
 
-    return bbox_transform(ex_rois, gt_rois[:, :4]).astype(np.float32, copy=False)
+    ex_widths = anchor_grid.widths[anchor_inds]
+    ex_heights = anchor_grid.heights[anchor_inds]
+    ex_ctr_x = anchor_grid.ctr_x[anchor_inds]
+    ex_ctr_y = anchor_grid.ctr_y[anchor_inds]
+
+    gt_rois = gt_rois.astype(np.float32, copy=False)
+    gt_widths = gt_rois[:, 2] - gt_rois[:, 0] + 1.0
+    gt_heights = gt_rois[:, 3] - gt_rois[:, 1] + 1.0
+    gt_ctr_x = gt_rois[:, 0] + 0.5 * gt_widths
+    gt_ctr_y = gt_rois[:, 1] + 0.5 * gt_heights
+
+    targets = np.empty((len(anchor_inds), 4), dtype=np.float32)
+    targets[:, 0] = (gt_ctr_x - ex_ctr_x) / ex_widths
+    targets[:, 1] = (gt_ctr_y - ex_ctr_y) / ex_heights
+    targets[:, 2] = np.log(gt_widths / ex_widths)
+    targets[:, 3] = np.log(gt_heights / ex_heights)
+    return targets
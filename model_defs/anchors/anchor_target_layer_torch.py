@@ -0,0 +1,230 @@
+# --------------------------------------------------------
+# Torch port of anchor_target_layer.py
+#
+# Same algorithm as the numpy anchor_target_layer, but the labels and
+# targets are made on the device of the score map, so they do not have to
+# be copied there every training step.
+# --------------------------------------------------------
+
+import numpy as np
+import torch
+
+from .anchor_grid import AnchorGrid
+
+
+def anchor_target_layer(cls_score, gt_boxes, img_info, cfg, _feat_stride=16,
+                        anchor_scales=[2, 4, 8,], anchor_grid=None,
+                        assignment_cache=None):
+    '''
+    Produces anchor classification labels and bounding-box regression targets.
+
+    Torch version of anchor_target_layer.anchor_target_layer, see there for
+    the algorithm.
+
+    Input parameters:
+        cls_score:  (torch.FloatTensor) network output score map
+        gt_boxes: (ndarray) Bx5 ground truth bounding boxes
+        img_info:  (tuple of int)
+        cfg: (Config)
+
+        _feat_stride(optional): (int) scaling factor between input feature
+                                map (class_prob_reshape) and original image.
+                                Default: 16
+        anchor_scales (optional):  (list of int) scale for size of anchor boxes
+                                   Default: [2,4,8]
+        anchor_grid (optional): (AnchorGrid) shifted anchors for this feature
+                                map size, made here if None. Default: None
+        assignment_cache (optional): (AnchorAssignmentCache) stored labels
+                                     of known gt boxes. Default: None
+
+    Returns:
+        all_anchor_inds: (torch.LongTensor) S index of each sampled anchor 
+                         box, batch_ind*(H*W*A) + anchor index
+        all_labels : (torch.LongTensor) S fg(1)/bg(0) label of each sampled
+                     anchor box
+        all_bbox_targets:  (torch.FloatTensor) Fx4 box parameter targets of
+                           the fg sampled anchors (all_labels == 1), in order
+    '''
+    batch_size = cls_score.size()[0]
+    height, width = cls_score.size()[2:4]
+    if anchor_grid is None:
+        anchor_grid = AnchorGrid(height, width, _feat_stride, anchor_scales,
+                                 img_info)
+    anchors, inds_inside = anchor_grid.torch_inside(cls_score)
+    num_inside = inds_inside.numel()
+    if num_inside == 0:
+        # no anchor fits in the image, nothing to label
+        return (inds_inside.new_zeros((0,)), inds_inside.new_zeros((0,)),
+                cls_score.new_zeros((0, 4)))
+
+    # every batch element has one gt box, dummy bg boxes have class 0
+    gt_boxes = np.asarray(gt_boxes, dtype=np.float32)
+    gt_inds = np.where(gt_boxes[:, -1] != 0)[0]
+
+    # label: 1 is positive, 0 is negative, -1 is dont care
+    # if target is not present(no gt box) all boxes are bg (0)
+    labels = cls_score.new_zeros((batch_size, num_inside))
+
+    if assignment_cache is not None and gt_inds.size > 0 and num_inside > 0:
+        # labels of pairs seen before are read from the offline cache, and
+        # set with one copy to the device
+        stored = assignment_cache.lookup(anchor_grid, gt_boxes[gt_inds])
+        rows, cols, values = [], [], []
+        for gt_ind, found in zip(gt_inds, stored):
+            if found is None:
+                continue
+            for value, found_positions in zip((1, -1), found):
+                rows.append(np.full(len(found_positions), gt_ind))
+                cols.append(found_positions)
+                values.append(np.full(len(found_positions), value, 
+                                      dtype=np.float32))
+        if len(rows) > 0:
+            cached = torch.from_numpy(np.stack((np.concatenate(rows),
+                                                np.concatenate(cols))
+                                               ).astype(np.int64))
+            cached = cached.to(labels.device)
+            labels[cached[0], cached[1]] = torch.from_numpy(
+                                np.concatenate(values)).to(labels.device)
+        gt_inds = gt_inds[[found is None for found in stored]]
+
+    # window of each gt box, found on the cpu before gt_boxes is moved
+    box_ids, positions = anchor_grid.window_inds(gt_boxes[gt_inds, :4])
+    gt_boxes = cls_score.new_tensor(gt_boxes)
+
+    if gt_inds.size > 0 and num_inside > 0:
+        # only anchors in the window around a gt box can overlap it, so
+        # overlaps are only computed for those (box, anchor) pairs. One gt
+        # box per element, so its overlaps are the max overlaps
+        # one copy to the device for all three index arrays
+        num_gt, num_pairs = gt_inds.size, box_ids.size
+        all_inds = torch.from_numpy(np.concatenate((gt_inds, box_ids, 
+                                                    positions)).astype(
+                                                        np.int64, copy=False))
+        all_inds = all_inds.to(labels.device)
+        gt_inds = all_inds[:num_gt]
+        box_ids = all_inds[num_gt:num_gt+num_pairs]
+        positions = all_inds[num_gt+num_pairs:]
+        window_overlaps = _pair_overlaps(anchors[positions],
+                                         gt_boxes[gt_inds[box_ids], :4])
+        # every other anchor has overlap 0
+        gt_max_overlaps = window_overlaps.new_zeros((gt_inds.numel(),))
+        gt_max_overlaps.scatter_reduce_(0, box_ids, window_overlaps, 'amax')
+
+        # anchors outside the windows all get the label of overlap 0
+        labels[gt_inds] = _overlap_labels(torch.zeros_like(gt_max_overlaps),
+                                          gt_max_overlaps, cfg).unsqueeze(1)
+        labels[gt_inds[box_ids], positions] = _overlap_labels(
+                                                window_overlaps,
+                                                gt_max_overlaps[box_ids], cfg)
+
+    # subsample positive labels if we have too many
+    num_fg = int(cfg.PROPOSAL_FG_FRACTION * cfg.PROPOSAL_BATCH_SIZE)
+    labels.masked_fill_(_subsample(labels == 1, num_fg), -1)
+
+    # subsample negative labels if we have too many
+    num_bg = cfg.PROPOSAL_BATCH_SIZE - (labels == 1).sum(1)
+    labels.masked_fill_(_subsample(labels == 0, num_bg), -1)
+
+    # only the sampled anchors are returned, indexed like the proposal
+    # layer's anchor_inds: batch_ind*total_anchors + anchor index, with
+    # anchors ordered by (h, w, a)
+    total_anchors = anchor_grid.num_anchors
+    batch_inds, sampled = (labels != -1).nonzero().t()
+    all_anchor_inds = batch_inds*total_anchors + inds_inside[sampled]
+    all_labels = labels[batch_inds, sampled].long()
+
+    # regression targets of the fg anchors. A dummy bg gt_box has no fg
+    fg = all_labels == 1
+    all_bbox_targets = _compute_targets(anchors[sampled[fg]],
+                                        gt_boxes[batch_inds[fg]])
+
+    return all_anchor_inds, all_labels, all_bbox_targets
+
+
+def _pair_overlaps(anchors, gt_boxes):
+    '''
+    IoU of each of N anchors with the gt box in the same row, same math as
+    proposal_layer_torch.bbox_overlaps
+
+    Returns:
+        (torch.FloatTensor) N overlaps
+    '''
+    anchor_areas = ((anchors[:, 2] - anchors[:, 0] + 1) *
+                    (anchors[:, 3] - anchors[:, 1] + 1))
+    gt_areas = ((gt_boxes[:, 2] - gt_boxes[:, 0] + 1) *
+                (gt_boxes[:, 3] - gt_boxes[:, 1] + 1))
+    iw = (torch.min(anchors[:, 2], gt_boxes[:, 2]) -
+          torch.max(anchors[:, 0], gt_boxes[:, 0]) + 1)
+    ih = (torch.min(anchors[:, 3], gt_boxes[:, 3]) -
+          torch.max(anchors[:, 1], gt_boxes[:, 1]) + 1)
+    inter = iw.clamp(min=0) * ih.clamp(min=0)
+    return inter / (anchor_areas + gt_areas - inter)
+
+
+def _overlap_labels(max_overlaps, gt_max_overlaps, cfg):
+    '''
+    fg(1)/bg(0)/dont care(-1) label of anchors from their overlap with
+    their gt box, and the highest overlap of any anchor with that box
+    '''
+    labels = torch.full_like(max_overlaps, -1)
+
+    if not cfg.PROPOSAL_CLOBBER_POSITIVES:
+        # assign bg labels first so that positive labels can clobber them
+        labels.masked_fill_(max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP, 0)
+
+    # fg label: for each gt, anchor with highest overlap
+    labels.masked_fill_(max_overlaps == gt_max_overlaps, 1)
+    # fg label: above threshold IOU
+    labels.masked_fill_(max_overlaps >= cfg.PROPOSAL_POSITIVE_OVERLAP, 1)
+
+    if cfg.PROPOSAL_CLOBBER_POSITIVES:
+        # assign bg labels last so that negative labels can clobber positives
+        labels.masked_fill_(max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP, 0)
+    return labels
+
+
+def _subsample(mask, max_num):
+    '''
+    Pick random entries of each row of mask to disable, leaving max_num.
+
+    Input parameters:
+        mask: (torch.ByteTensor) BxN bool
+        max_num: (int or torch.LongTensor) max True entries to keep in each
+                 row
+
+    Returns:
+        (torch.BoolTensor) BxN, True for the entries to disable
+    '''
+    num_entries = mask.size()[1]
+    if not torch.is_tensor(max_num):
+        max_num = torch.full((mask.size()[0],), max_num, dtype=torch.long,
+                             device=mask.device)
+
+    # keep the max_num True entries with the smallest random keys
+    keys = torch.rand(mask.size(), device=mask.device)
+    keys.masked_fill_(~mask, 2)
+    thresholds = keys.sort(1)[0].gather(1, max_num.clamp(max=num_entries-1
+                                                         ).view(-1, 1))
+    thresholds.masked_fill_((max_num >= num_entries).view(-1, 1), 3)
+    return mask & (keys >= thresholds)
+
+
+def _compute_targets(ex_rois, gt_rois):
+    '''
+    Regression targets of Nx4 ex_rois for Nx5 gt_rois, 
+    same as bbox_transform.bbox_transform
+    '''
+    ex_widths = ex_rois[:, 2] - ex_rois[:, 0] + 1.0
+    ex_heights = ex_rois[:, 3] - ex_rois[:, 1] + 1.0
+    ex_ctr_x = ex_rois[:, 0] + 0.5 * ex_widths
+    ex_ctr_y = ex_rois[:, 1] + 0.5 * ex_heights
+
+    gt_widths = gt_rois[:, 2] - gt_rois[:, 0] + 1.0
+    gt_heights = gt_rois[:, 3] - gt_rois[:, 1] + 1.0
+    gt_ctr_x = gt_rois[:, 0] + 0.5 * gt_widths
+    gt_ctr_y = gt_rois[:, 1] + 0.5 * gt_heights
+
+    return torch.stack(((gt_ctr_x - ex_ctr_x) / ex_widths,
+                        (gt_ctr_y - ex_ctr_y) / ex_heights,
+                        torch.log(gt_widths / ex_widths),
+                        torch.log(gt_heights / ex_heights)), 1)
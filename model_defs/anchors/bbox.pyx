@@ -6,40 +6,126 @@
 # --------------------------------------------------------
 
 cimport cython
+from cython.parallel cimport prange
+from libc.math cimport exp, expf
+import os
 import numpy as np
 cimport numpy as np
 
-DTYPE = np.float
-ctypedef np.float_t DTYPE_t
+#compiled for float32 and float64 boxes, results have the type of the
+#inputs, so float32 boxes are never copied to float64
+ctypedef fused DTYPE_t:
+    np.float32_t
+    np.float64_t
 
-def bbox_overlaps(np.ndarray[DTYPE_t, ndim=2] boxes,
-        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+#threads used by the kernels, only has an effect in an OpenMP build
+cdef int _num_threads = os.cpu_count() or 1
+
+
+def set_num_threads(int num_threads):
+    """Threads for the overlap kernels, <= 0 for one per core."""
+    global _num_threads
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+    _num_threads = num_threads
+
+
+def get_num_threads():
+    return _num_threads
+
+
+def bbox_overlaps(const DTYPE_t[:, :] boxes, const DTYPE_t[:, :] query_boxes):
     return bbox_overlaps_c(boxes, query_boxes)
 
-cdef np.ndarray[DTYPE_t, ndim=2] bbox_overlaps_c(
-        np.ndarray[DTYPE_t, ndim=2] boxes,
-        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bbox_overlaps_c(
+        const DTYPE_t[:, :] boxes,
+        const DTYPE_t[:, :] query_boxes):
     """
     Parameters
     ----------
-    boxes: (N, 4) ndarray of float
-    query_boxes: (K, 4) ndarray of float
+    boxes: (N, 4) ndarray of float32 or float64
+    query_boxes: (K, 4) ndarray of the same type
     Returns
     -------
     overlaps: (N, K) ndarray of overlap between boxes and query_boxes
     """
-    cdef unsigned int N = boxes.shape[0]
-    cdef unsigned int K = query_boxes.shape[0]
-    cdef np.ndarray[DTYPE_t, ndim=2] overlaps = np.zeros((N, K), dtype=DTYPE)
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    dtype = np.float32 if DTYPE_t is np.float32_t else np.float64
+    overlaps_arr = np.zeros((N, K), dtype=dtype)
+    cdef DTYPE_t[:, ::1] overlaps = overlaps_arr
+    cdef DTYPE_t[::1] query_areas = np.empty(K, dtype=dtype)
     cdef DTYPE_t iw, ih, box_area
     cdef DTYPE_t ua
-    cdef unsigned int k, n
-    for k in range(K):
-        box_area = (
-            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
-            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
-        )
-        for n in range(N):
+    cdef Py_ssize_t k, n
+    with nogil:
+        for k in range(K):
+            query_areas[k] = (
+                (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
+                (query_boxes[k, 3] - query_boxes[k, 1] + 1)
+            )
+        #rows are independent, split them over the threads
+        for n in prange(N, num_threads=_num_threads, schedule='static'):
+            box_area = (
+                (boxes[n, 2] - boxes[n, 0] + 1) *
+                (boxes[n, 3] - boxes[n, 1] + 1)
+            )
+            for k in range(K):
+                iw = (
+                    min(boxes[n, 2], query_boxes[k, 2]) -
+                    max(boxes[n, 0], query_boxes[k, 0]) + 1
+                )
+                if iw > 0:
+                    ih = (
+                        min(boxes[n, 3], query_boxes[k, 3]) -
+                        max(boxes[n, 1], query_boxes[k, 1]) + 1
+                    )
+                    if ih > 0:
+                        ua = box_area + query_areas[k] - iw * ih
+                        overlaps[n, k] = iw * ih / ua
+    return overlaps_arr
+
+
+def bbox_pair_overlaps(const DTYPE_t[:, :] boxes, 
+                       const DTYPE_t[:, :] query_boxes,
+                       const np.int64_t[:] box_inds,
+                       const np.int64_t[:] query_inds):
+    return bbox_pair_overlaps_c(boxes, query_boxes, box_inds, query_inds)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bbox_pair_overlaps_c(
+        const DTYPE_t[:, :] boxes,
+        const DTYPE_t[:, :] query_boxes,
+        const np.int64_t[:] box_inds,
+        const np.int64_t[:] query_inds):
+    """
+    Overlap of only some (box, query box) pairs, same values as
+    bbox_overlaps(boxes, query_boxes)[box_inds, query_inds]
+    ----------
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float32 or float64
+    query_boxes: (K, 4) ndarray of the same type
+    box_inds: (P,) int64 ndarray of indices into boxes
+    query_inds: (P,) int64 ndarray of indices into query_boxes
+    Returns
+    -------
+    overlaps: (P,) ndarray of overlap between the pairs
+    """
+    cdef Py_ssize_t P = box_inds.shape[0]
+    dtype = np.float32 if DTYPE_t is np.float32_t else np.float64
+    overlaps_arr = np.zeros(P, dtype=dtype)
+    cdef DTYPE_t[::1] overlaps = overlaps_arr
+    cdef DTYPE_t iw, ih, box_area, query_area
+    cdef DTYPE_t ua
+    cdef Py_ssize_t p, n, k
+    with nogil:
+        for p in prange(P, num_threads=_num_threads, schedule='static'):
+            n = box_inds[p]
+            k = query_inds[p]
             iw = (
                 min(boxes[n, 2], query_boxes[k, 2]) -
                 max(boxes[n, 0], query_boxes[k, 0]) + 1
@@ -50,56 +136,137 @@ cdef np.ndarray[DTYPE_t, ndim=2] bbox_overlaps_c(
                     max(boxes[n, 1], query_boxes[k, 1]) + 1
                 )
                 if ih > 0:
-                    ua = float(
+                    box_area = (
                         (boxes[n, 2] - boxes[n, 0] + 1) *
-                        (boxes[n, 3] - boxes[n, 1] + 1) +
-                        box_area - iw * ih
+                        (boxes[n, 3] - boxes[n, 1] + 1)
+                    )
+                    query_area = (
+                        (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
+                        (query_boxes[k, 3] - query_boxes[k, 1] + 1)
                     )
-                    overlaps[n, k] = iw * ih / ua
-    return overlaps
+                    ua = box_area + query_area - iw * ih
+                    overlaps[p] = iw * ih / ua
+    return overlaps_arr
 
 
 def bbox_intersections(
-        np.ndarray[DTYPE_t, ndim=2] boxes,
-        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+        const DTYPE_t[:, :] boxes,
+        const DTYPE_t[:, :] query_boxes):
     return bbox_intersections_c(boxes, query_boxes)
 
 
-cdef np.ndarray[DTYPE_t, ndim=2] bbox_intersections_c(
-        np.ndarray[DTYPE_t, ndim=2] boxes,
-        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bbox_intersections_c(
+        const DTYPE_t[:, :] boxes,
+        const DTYPE_t[:, :] query_boxes):
     """
     For each query box compute the intersection ratio covered by boxes
     ----------
     Parameters
     ----------
-    boxes: (N, 4) ndarray of float
-    query_boxes: (K, 4) ndarray of float
+    boxes: (N, 4) ndarray of float32 or float64
+    query_boxes: (K, 4) ndarray of the same type
     Returns
     -------
     overlaps: (N, K) ndarray of intersec between boxes and query_boxes
     """
-    cdef unsigned int N = boxes.shape[0]
-    cdef unsigned int K = query_boxes.shape[0]
-    cdef np.ndarray[DTYPE_t, ndim=2] intersec = np.zeros((N, K), dtype=DTYPE)
-    cdef DTYPE_t iw, ih, box_area
-    cdef DTYPE_t ua
-    cdef unsigned int k, n
-    for k in range(K):
-        box_area = (
-            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
-            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
-        )
-        for n in range(N):
-            iw = (
-                min(boxes[n, 2], query_boxes[k, 2]) -
-                max(boxes[n, 0], query_boxes[k, 0]) + 1
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    dtype = np.float32 if DTYPE_t is np.float32_t else np.float64
+    intersec_arr = np.zeros((N, K), dtype=dtype)
+    cdef DTYPE_t[:, ::1] intersec = intersec_arr
+    cdef DTYPE_t[::1] query_areas = np.empty(K, dtype=dtype)
+    cdef DTYPE_t iw, ih
+    cdef Py_ssize_t k, n
+    with nogil:
+        for k in range(K):
+            query_areas[k] = (
+                (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
+                (query_boxes[k, 3] - query_boxes[k, 1] + 1)
             )
-            if iw > 0:
-                ih = (
-                    min(boxes[n, 3], query_boxes[k, 3]) -
-                    max(boxes[n, 1], query_boxes[k, 1]) + 1
+        for n in prange(N, num_threads=_num_threads, schedule='static'):
+            for k in range(K):
+                iw = (
+                    min(boxes[n, 2], query_boxes[k, 2]) -
+                    max(boxes[n, 0], query_boxes[k, 0]) + 1
                 )
-                if ih > 0:
-                    intersec[n, k] = iw * ih / box_area
-    return intersec
\ No newline at end of file
+                if iw > 0:
+                    ih = (
+                        min(boxes[n, 3], query_boxes[k, 3]) -
+                        max(boxes[n, 1], query_boxes[k, 1]) + 1
+                    )
+                    if ih > 0:
+                        intersec[n, k] = iw * ih / query_areas[k]
+    return intersec_arr
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def decode_clip_filter(const DTYPE_t[:, :] anchors,
+                       const DTYPE_t[:, :] deltas,
+                       const np.int64_t[:] inds,
+                       double im_height, double im_width, double min_size,
+                       DTYPE_t[:, ::1] boxes, np.uint8_t[::1] keep):
+    """
+    Decode, clip and size filter some anchors in one pass
+    ----------
+    Parameters
+    ----------
+    anchors: (N, 4) ndarray of float32 or float64
+    deltas: (N, 4) ndarray of the same type, predicted box deltas
+    inds: (P,) int64 ndarray of the anchors to decode
+    im_height, im_width: image size, boxes are clipped to it
+    min_size: boxes with both sides smaller than this are filtered
+    boxes: (P, 4) ndarray of the same type, output, filtered boxes are 0
+    keep: (P,) uint8 ndarray, output, 0 for the filtered boxes
+    Returns
+    -------
+    num_keep: number of boxes not filtered
+    """
+    cdef Py_ssize_t P = inds.shape[0]
+    cdef Py_ssize_t p, n
+    cdef DTYPE_t one = 1, half = 0.5, zero = 0
+    cdef DTYPE_t max_x = <DTYPE_t>im_width - one
+    cdef DTYPE_t max_y = <DTYPE_t>im_height - one
+    cdef DTYPE_t min_side = <DTYPE_t>min_size
+    cdef DTYPE_t w, h, ctr_x, ctr_y, pred_ctr_x, pred_ctr_y, pred_w, pred_h
+    cdef DTYPE_t x1, y1, x2, y2
+    cdef Py_ssize_t num_keep = 0
+    with nogil:
+        for p in prange(P, num_threads=_num_threads, schedule='static'):
+            n = inds[p]
+            # same operations, in the same order, as bbox_transform_inv
+            w = anchors[n, 2] - anchors[n, 0] + one
+            h = anchors[n, 3] - anchors[n, 1] + one
+            ctr_x = anchors[n, 0] + half * w
+            ctr_y = anchors[n, 1] + half * h
+            pred_ctr_x = deltas[n, 0] * w + ctr_x
+            pred_ctr_y = deltas[n, 1] * h + ctr_y
+            if DTYPE_t is np.float32_t:
+                pred_w = expf(deltas[n, 2]) * w
+                pred_h = expf(deltas[n, 3]) * h
+            else:
+                pred_w = exp(deltas[n, 2]) * w
+                pred_h = exp(deltas[n, 3]) * h
+
+            # clip_boxes
+            x1 = max(min(pred_ctr_x - half * pred_w, max_x), zero)
+            y1 = max(min(pred_ctr_y - half * pred_h, max_y), zero)
+            x2 = max(min(pred_ctr_x + half * pred_w, max_x), zero)
+            y2 = max(min(pred_ctr_y + half * pred_h, max_y), zero)
+
+            if x2 - x1 + one < min_side and y2 - y1 + one < min_side:
+                keep[p] = 0
+                boxes[p, 0] = 0
+                boxes[p, 1] = 0
+                boxes[p, 2] = 0
+                boxes[p, 3] = 0
+            else:
+                keep[p] = 1
+                num_keep += 1
+                boxes[p, 0] = x1
+                boxes[p, 1] = y1
+                boxes[p, 2] = x2
+                boxes[p, 3] = y2
+    return num_keep
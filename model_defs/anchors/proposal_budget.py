@@ -0,0 +1,132 @@
+# --------------------------------------------------------
+# Proposal budgets
+#
+# How many proposals the proposal layers send to nms (PRE_NMS_TOP_N) and
+# keep after it (POST_NMS_TOP_N). In 'adaptive' mode both scale with the
+# size of the feature map, and anchors scoring far below the best anchor
+# of their image are dropped, so small images and flat score maps cost
+# less. The counts actually used are recorded, to trade recall for speed.
+# --------------------------------------------------------
+
+import numpy as np
+import torch
+
+
+class ProposalBudget(object):
+    '''
+    Proposal counts of the proposal layers, and a record of their use
+
+    Input parameters:
+        cfg: (Config) uses PRE_NMS_TOP_N, POST_NMS_TOP_N,
+             PROPOSAL_BUDGET_MODE, PROPOSAL_BUDGET_REF_CELLS and
+             PROPOSAL_MIN_SCORE_FRACTION
+    '''
+
+    def __init__(self, cfg):
+        assert cfg.PROPOSAL_BUDGET_MODE in ('fixed', 'adaptive')
+        self.cfg = cfg
+        self.adaptive = cfg.PROPOSAL_BUDGET_MODE == 'adaptive'
+        self.reset()
+
+    def reset(self):
+        '''Forget the recorded counts'''
+        self.num_images = 0
+        self.total_pre_nms = 0
+        self.total_post_nms = 0
+        self.last = None
+
+    def limits(self, height, width, num_anchors, max_keep=0):
+        '''
+        Pre and post nms proposal counts for one feature map
+
+        Input parameters:
+            height: (int) feature map height
+            width: (int) feature map width
+            num_anchors: (int) anchors of the feature map
+
+            max_keep (optional): (int) If > 0, a further cap on the post
+                                 nms count. Default: 0
+
+        Returns:
+            pre_nms_top_n: (int) candidates per image, <= num_anchors
+            post_nms_top_n: (int) max proposals kept per image, 0 for all
+        '''
+        pre_nms_top_n = self.cfg.PRE_NMS_TOP_N
+        post_nms_top_n = max(0, self.cfg.POST_NMS_TOP_N)
+        if self.adaptive:
+            scale = float(height * width) / self.cfg.PROPOSAL_BUDGET_REF_CELLS
+            if pre_nms_top_n > 0:
+                pre_nms_top_n = max(1, int(np.ceil(pre_nms_top_n * scale)))
+            if post_nms_top_n > 0:
+                post_nms_top_n = max(1, int(np.ceil(post_nms_top_n * scale)))
+
+        if pre_nms_top_n > 0:
+            pre_nms_top_n = min(pre_nms_top_n, num_anchors)
+        else:
+            pre_nms_top_n = num_anchors
+        if max_keep > 0 and (post_nms_top_n == 0 or max_keep < post_nms_top_n):
+            post_nms_top_n = max_keep
+        return pre_nms_top_n, post_nms_top_n
+
+    def score_thresholds(self, scores, score_thresh=None):
+        '''
+        Score threshold of each image for the proposal layer prefilter
+
+        Input parameters:
+            scores: (ndarray or torch.FloatTensor) BxN fg scores of the
+                    anchors of each image, only reduced to the per image
+                    max in adaptive mode
+
+            score_thresh (optional): (float) fixed threshold. Default: None
+
+        Returns:
+            None for no prefilter, else B threshold of each image, same
+            type as scores: score_thresh and, in adaptive mode, the
+            cfg.PROPOSAL_MIN_SCORE_FRACTION of the image's max score
+        '''
+        fraction = self.cfg.PROPOSAL_MIN_SCORE_FRACTION
+        relative = self.adaptive and fraction > 0
+        if score_thresh is None and not relative:
+            return None
+        fill = -np.inf if score_thresh is None else score_thresh
+        if torch.is_tensor(scores):
+            thresholds = scores.new_full((scores.size()[0],), fill)
+            if relative:
+                thresholds = torch.max(thresholds,
+                                       scores.max(1)[0] * fraction)
+        else:
+            thresholds = np.full(scores.shape[0], fill, dtype=scores.dtype)
+            if relative:
+                thresholds = np.maximum(thresholds,
+                                        scores.max(axis=1) * fraction)
+        return thresholds
+
+    def record(self, pre_nms_top_n, post_nms_top_n, num_pre_nms,
+               num_post_nms):
+        '''
+        Record the proposal counts of one proposal layer call
+
+        Input parameters:
+            pre_nms_top_n: (int) budget before nms
+            post_nms_top_n: (int) budget after nms, 0 for no limit
+            num_pre_nms: (ndarray) B candidates sent to nms per image
+            num_post_nms: (ndarray) B proposals kept per image
+        '''
+        num_pre_nms = np.asarray(num_pre_nms)
+        num_post_nms = np.asarray(num_post_nms)
+        self.last = {'pre_nms_top_n': pre_nms_top_n,
+                     'post_nms_top_n': post_nms_top_n,
+                     'num_pre_nms': num_pre_nms,
+                     'num_post_nms': num_post_nms}
+        self.num_images += len(num_pre_nms)
+        self.total_pre_nms += int(num_pre_nms.sum())
+        self.total_post_nms += int(num_post_nms.sum())
+
+    def summary(self):
+        '''(str) average proposal counts per image so far'''
+        num_images = max(1, self.num_images)
+        return ('{} proposal budget, {} images, {:.1f} candidates and {:.1f} '
+                'proposals per image').format(
+                    self.cfg.PROPOSAL_BUDGET_MODE, self.num_images,
+                    self.total_pre_nms / float(num_images),
+                    self.total_post_nms / float(num_images))
@@ -9,16 +9,20 @@
 import numpy as np
 import yaml
 
-from .generate_anchors import generate_anchors
-from .bbox_transform import bbox_transform_inv, clip_boxes
-from ..nms.nms_wrapper import nms
+from .anchor_grid import AnchorGrid
+from .proposal_budget import ProposalBudget
+from .workspace import Workspace
+from ..nms.nms_wrapper import batched_nms
 from .cython_bbox import bbox_overlaps, bbox_intersections
+from .cython_bbox import decode_clip_filter
 
 
 
 
 def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16,
-                   anchor_scales=[2, 4, 8],gt_boxes=None):
+                   anchor_scales=[2, 4, 8],gt_boxes=None, anchor_grid=None,
+                   workspace=None, score_thresh=None, max_keep=0,
+                   nms_thresh=None, budget=None):
     ''' 
     Outputs object detection proposals
 
@@ -44,14 +48,33 @@ def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16
         gt_boxes (optional): (ndarray) If not None, return value all_labels
                              will have fg/bg label of each anchor box. If None
                              all_labels will be meaningless. Default: None
+        anchor_grid (optional): (AnchorGrid) shifted anchors for this feature
+                                map size, made here if None. Default: None
+        workspace (optional): (Workspace) reused temporary arrays, made 
+                              here if None. Default: None
+        score_thresh (optional): (float) If not None, anchors with a score
+                                 <= score_thresh (>= 0) are dropped before
+                                 decoding and nms. Only the proposals over
+                                 the threshold are returned, the same ones
+                                 as without it. Default: None
+        max_keep (optional): (int) If > 0, keep at most this many proposals
+                             after nms, on top of cfg.POST_NMS_TOP_N. 
+                             Default: 0
+        nms_thresh (optional): (float) IoU threshold of the nms, 
+                               cfg.NMS_THRESH if None. Default: None
+        budget (optional): (ProposalBudget) pre and post nms proposal 
+                           counts, records the counts used. Made here from
+                           cfg if None. Default: None
 
     Returns:
-        all_proposals: (ndarray) The proposed bounding boxes
-        all_scores: (ndarray) The fg/bg score for each bounding box
-        all_anchor_inds: (ndarray) The index of the anchor box that 
-                         corresponds to the proposed bounding box
+        all_proposals: (ndarray) BxMx4 float32 The proposed bounding boxes
+        all_scores: (ndarray) BxMx1 float32 The fg score for each bounding box
+        all_anchor_inds: (ndarray) BxMx1 int64 The index of the anchor box  
+                         that corresponds to the proposed bounding box
         all_labels: (ndarray) ground truth fg/bg label for each proposed 
                     bounding box. 
+        all_num_valid: (ndarray) number of proposals kept for each batch
+                       element. Rows after that are zero padding.
 
     # Algorithm:
     #
@@ -61,7 +84,7 @@ def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16
     # clip predicted boxes to image
     # remove predicted boxes with either height or width < threshold
     # sort all (proposal, score) pairs by score from highest to lowest
-    # take top cfg.PRE_NMS_TOP_N proposals before NMS
+    # take top cfg.PRE_NMS_TOP_N proposals before NMS (see ProposalBudget)
     # apply NMS with threshold 0.7 to remaining proposals
     # take after_nms_topN proposals after NMS
     # return the top proposals (-> RoIs top, scores top)
@@ -69,37 +92,25 @@ def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16
     ''' 
 
     batch_size = class_prob_reshape.shape[0]
-    _anchors = generate_anchors(scales=np.array(anchor_scales))
-    _num_anchors = _anchors.shape[0]
+    if workspace is None:
+        workspace = Workspace()
+    if budget is None:
+        budget = ProposalBudget(cfg)
+
+    # 1. Generate proposals from bbox deltas and shifted anchors
+    height, width = class_prob_reshape.shape[-2:]
+    if anchor_grid is None:
+        anchor_grid = AnchorGrid(height, width, _feat_stride, anchor_scales,
+                                 img_info)
+    _num_anchors = anchor_grid.num_base_anchors
+    anchors = anchor_grid.anchors
+    total_anchors = anchor_grid.num_anchors
 
     # the first set of _num_anchors channels are bg probs
     # the second set are the fg probs, which we want
     scores = class_prob_reshape[:, _num_anchors:, :, :]
     bbox_deltas = bbox_pred
 
-    # 1. Generate proposals from bbox deltas and shifted anchors
-    height, width = scores.shape[-2:]
-
-    # Enumerate all shifts
-    shift_x = np.arange(0, width) * _feat_stride
-    shift_y = np.arange(0, height) * _feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                        shift_x.ravel(), shift_y.ravel())).transpose()
-
-    # Enumerate all shifted anchors:
-    #
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    A = _num_anchors
-    K = shifts.shape[0]
-    anchors = _anchors.reshape((1, A, 4)) + \
-              shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-    anchors = anchors.reshape((K * A, 4))
-    anchors = np.tile(anchors, (batch_size,1,1))
-
     # Transpose and reshape predicted bbox transformations to get them
     # into the same order as the anchors:
     #
@@ -107,150 +118,200 @@ def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16
     # transpose to (1, H, W, 4 * A)
     # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
     # in slowest to fastest order
-    bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((batch_size,-1, 4))
+    deltas_buffer = workspace.get('proposal_deltas', 
+                                  (batch_size, height, width, 4*_num_anchors))
+    np.copyto(deltas_buffer, bbox_deltas.transpose((0, 2, 3, 1)))
+    bbox_deltas = deltas_buffer.reshape((batch_size,-1, 4))
 
     # Same story for the scores:
     #
     # scores are (1, A, H, W) format
     # transpose to (1, H, W, A)
     # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
-    scores = scores.transpose((0, 2, 3, 1)).reshape((batch_size,-1))
-
-    # Convert anchors into proposals via bbox transformations
-    proposals = bbox_transform_inv(anchors, bbox_deltas)
-
-    # 2. clip predicted boxes to image
-    proposals = clip_boxes(proposals, img_info[:2])
-
-    # 3. remove predicted boxes with either height or width < threshold
+    scores_buffer = workspace.get('proposal_scores', 
+                                  (batch_size, height, width, _num_anchors),
+                                  scores.dtype)
+    np.copyto(scores_buffer, scores.transpose((0, 2, 3, 1)))
+    scores = scores_buffer.reshape((batch_size,-1))
+
+    # 2. - 5. decode, clip, filter, sort and take top cfg.PRE_NMS_TOP_N,
+    # (e.g. 6000) only decoding the anchors that can make the cut
+    pre_nms_top_n, post_nms_top_n = budget.limits(height, width, 
+                                                  total_anchors, max_keep)
+    score_threshs = budget.score_thresholds(scores, score_thresh)
     # (NOTE: convert min_size to input image scale stored in img_info[2])
-    lose = _filter_boxes(proposals, cfg.PROPOSAL_MIN_BOX_SIZE * img_info[2])
-    proposals[lose[0],lose[1],:] = 0
-    scores[lose[0],lose[1]] = 0
-
-    # 4. sort all (proposal, score) pairs by score from highest to lowest
-    # 5. take top cfg.PRE_NMS_TOP_N (e.g. 6000)
-    order = scores.argsort(1)[:,::-1]
-    anchor_inds = np.tile(np.arange(order.shape[1]),(batch_size,1))
-    if cfg.PRE_NMS_TOP_N > 0:
-        order = order[:,:cfg.PRE_NMS_TOP_N]
-    b_select = np.arange(batch_size)
-    proposals = np.take(proposals,order,axis=1)[b_select,b_select,:,:]
-    scores = np.take(scores,order,axis=1)[b_select,b_select,:]
-    anchor_inds = np.take(anchor_inds,order,axis=1)[b_select,b_select,:]
-
-    all_proposals = None
-    all_scores = None
-    all_anchor_inds = None
-    all_labels = None
+    min_size = cfg.PROPOSAL_MIN_BOX_SIZE * img_info[2]
+
+    all_top_proposals = []
+    for batch_ind in range(batch_size):
+        b_score_thresh = None
+        if score_threshs is not None:
+            b_score_thresh = score_threshs[batch_ind]
+        all_top_proposals.append(_top_proposals(anchors, 
+                                                bbox_deltas[batch_ind],
+                                                scores[batch_ind],
+                                                pre_nms_top_n, img_info, 
+                                                min_size, workspace,
+                                                b_score_thresh))
+
+    # output buffers, sized for the most proposals any batch element can
+    # keep. Rows past all_num_valid[batch_ind] are zero padding
+    buffer_rows = pre_nms_top_n
+    if post_nms_top_n > 0:
+        buffer_rows = min(buffer_rows, post_nms_top_n)
+    all_proposals = np.zeros((batch_size, buffer_rows, 4), dtype=np.float32)
+    all_scores = np.zeros((batch_size, buffer_rows, 1), dtype=np.float32)
+    all_anchor_inds = np.zeros((batch_size, buffer_rows, 1), dtype=np.int64)
+    all_labels = np.zeros((batch_size, buffer_rows), dtype=np.int64)
+    all_num_valid = np.zeros(batch_size, dtype=np.int64)
+
+    # 6. apply nms (e.g. threshold = 0.7), one call for the whole batch
+    # 7. take after_nms_topN (e.g. 300)
+    all_dets = np.vstack([np.hstack((b_proposals, b_scores[:, np.newaxis]))
+                          for b_proposals, b_scores, _ in all_top_proposals])
+    group_ids = np.repeat(np.arange(batch_size),
+                          [len(b_scores) for _, b_scores, _ in 
+                           all_top_proposals])
+    if nms_thresh is None:
+        nms_thresh = cfg.NMS_THRESH
+    all_keep = batched_nms(all_dets, group_ids, nms_thresh,
+                           backend=cfg.NMS_BACKEND,
+                           max_keep=post_nms_top_n)
+    group_starts = np.cumsum(np.bincount(group_ids, minlength=batch_size))
+    group_starts = np.append(0, group_starts[:-1])
+    num_keeps = np.bincount(group_ids[all_keep], minlength=batch_size)
+    all_keep = np.split(all_keep, np.cumsum(num_keeps)[:-1])
 
     for batch_ind in range(batch_size):
 
-        b_proposals = proposals[batch_ind,:,:]
-        b_scores = np.expand_dims(scores[batch_ind,:], 1)
-        b_anchor_inds = (np.expand_dims(anchor_inds[batch_ind,:],1) + 
-                         batch_ind*anchors.shape[1])
+        b_proposals, b_scores, b_anchor_inds = all_top_proposals[batch_ind]
 
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
         # 8. return the top proposals (-> RoIs top)
-        keep = nms(np.hstack((b_proposals, b_scores)), cfg.NMS_THRESH)
-        if cfg.POST_NMS_TOP_N > 0:
-            keep = keep[:cfg.POST_NMS_TOP_N]
+        keep = all_keep[batch_ind] - group_starts[batch_ind]
+        num_keep = len(keep)
 
         b_proposals = b_proposals[keep, :]
-        b_scores = b_scores[keep]
-        b_anchor_inds = b_anchor_inds[keep]
-
-        assert(b_anchor_inds.shape[0] == b_scores.shape[0])
-
-        if b_proposals.shape[0] == 0:
-            b_proposals = np.zeros((1,4))
-            b_scores = np.zeros((1,1))
-            b_anchor_inds = np.zeros(1)
+        all_proposals[batch_ind, :num_keep, :] = b_proposals
+        all_scores[batch_ind, :num_keep, 0] = b_scores[keep]
+        all_anchor_inds[batch_ind, :num_keep, 0] = (b_anchor_inds[keep] + 
+                                                   batch_ind*total_anchors)
+        all_num_valid[batch_ind] = num_keep
 
         #match anchor inds with gt boxes
-        b_labels = -1*np.ones(b_anchor_inds.size)
-        if gt_boxes is not None:
-            b_labels.fill(0)
-             #get rid of background gt_boxes
+        b_labels = all_labels[batch_ind, :num_keep]
+        if gt_boxes is None:
+            b_labels.fill(-1)
+        elif gt_boxes[batch_ind,-1] != 0 and num_keep > 0:#not a bg box
             gt_box = np.expand_dims(gt_boxes[batch_ind,:],axis=0)
-            if gt_box[0,-1] == 0:#this is a bg box
-                b_labels.fill(0)
-            else:
-                # overlaps between the anchors and the gt boxes
-                # overlaps (ex, gt), shape is A x G
-                overlaps = bbox_overlaps(
-                    np.ascontiguousarray(b_proposals, dtype=np.float),
-                    np.ascontiguousarray(gt_box, dtype=np.float))
-                argmax_overlaps = overlaps.argmax(axis=1)  # (A)
-                max_overlaps = overlaps[np.arange(len(b_anchor_inds)), argmax_overlaps]
-                gt_argmax_overlaps = overlaps.argmax(axis=0)  # G 
-                gt_max_overlaps = overlaps[gt_argmax_overlaps,
-                                           np.arange(overlaps.shape[1])]
-                gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
-
-                if not cfg.PROPOSAL_CLOBBER_POSITIVES:
-                    # assign bg labels first so that positive labels can clobber them
-                    #labels[max_overlaps < cfg.TRAIN.PROPOSAL_NEGATIVE_OVERLAP] = 0 
-                    b_labels[max_overlaps < .2] = 0 
-
-                # fg label: for each gt, anchor with highest overlap
-                b_labels[gt_argmax_overlaps] = 1 
-                # fg label: above threshold IOU
-                b_labels[max_overlaps >= .5] = 1 
-
-                if True:#cfg.TRAIN.PROPOSAL_CLOBBER_POSITIVES:
-                    # assign bg labels last so that negative labels can clobber positives
-                    b_labels[max_overlaps < .2] = 0 
-
-        #finshed with one batch, update data structs
-        if all_proposals is None:
-            all_proposals = np.expand_dims(b_proposals, axis=0)
-            all_scores = np.expand_dims(b_scores, axis=0)
-            all_anchor_inds = np.expand_dims(b_anchor_inds, axis=0)
-            all_labels = np.expand_dims(b_labels, axis=0)
-        else:
-            all_proposals = _append_and_pad(all_proposals,b_proposals)
-            all_scores = _append_and_pad(all_scores,b_scores)
-            all_anchor_inds = _append_and_pad(all_anchor_inds,b_anchor_inds)
-            all_labels = _append_and_pad(all_labels,b_labels)
-
-    return all_proposals, all_scores,all_anchor_inds,all_labels 
-
-
-def _append_and_pad(all_batches, single_batch):
-    """ appends a1 to a2 at axis 0, padding the shorter of a1,a2"""
-    if all_batches.shape[1] < single_batch.shape[0]:
-        num_to_add = single_batch.shape[0] - all_batches.shape[1]
-        all_batches = _pad_to_match(all_batches, num_to_add, axis=1)
-    elif all_batches.shape[1] > single_batch.shape[0]:
-        num_to_add = all_batches.shape[1] - single_batch.shape[0]
-        single_batch = _pad_to_match(single_batch,num_to_add, axis=0)
-    single_batch = np.expand_dims(single_batch,0)
-
-    return np.concatenate((all_batches,single_batch))
-
-
-def _pad_to_match(to_pad, num_to_add, axis=0):
-        pad_dims = []
-        for dim, dim_size in enumerate(to_pad.shape):
-            if (dim==axis):
-                pad_dims.append(num_to_add)
-            else: 
-                pad_dims.append(dim_size)
-        padding = np.zeros(pad_dims)
-        return np.concatenate((to_pad,padding),axis=axis)
-    
-
-
-def _filter_boxes(boxes, min_size):
-    """Remove all boxes with any side smaller than min_size."""
-    ws = boxes[:,:, 2] - boxes[:,:, 0] + 1
-    hs = boxes[:,:, 3] - boxes[:,:, 1] + 1
-    lose = np.where((ws < min_size) & (hs < min_size))
-    return lose 
-
+            # overlaps between the anchors and the gt boxes
+            # overlaps (ex, gt), shape is A x G
+            overlaps = bbox_overlaps(b_proposals, 
+                                     gt_box[:, :4].astype(np.float32))
+            argmax_overlaps = overlaps.argmax(axis=1)  # (A)
+            max_overlaps = overlaps[np.arange(num_keep), argmax_overlaps]
+            gt_argmax_overlaps = overlaps.argmax(axis=0)  # G 
+            gt_max_overlaps = overlaps[gt_argmax_overlaps,
+                                       np.arange(overlaps.shape[1])]
+            gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+
+            if not cfg.PROPOSAL_CLOBBER_POSITIVES:
+                # assign bg labels first so that positive labels can clobber them
+                #labels[max_overlaps < cfg.TRAIN.PROPOSAL_NEGATIVE_OVERLAP] = 0 
+                b_labels[max_overlaps < .2] = 0 
+
+            # fg label: for each gt, anchor with highest overlap
+            b_labels[gt_argmax_overlaps] = 1 
+            # fg label: above threshold IOU
+            b_labels[max_overlaps >= .5] = 1 
+
+            if True:#cfg.TRAIN.PROPOSAL_CLOBBER_POSITIVES:
+                # assign bg labels last so that negative labels can clobber positives
+                b_labels[max_overlaps < .2] = 0 
+
+    budget.record(pre_nms_top_n, post_nms_top_n, 
+                  [len(b_scores) for _, b_scores, _ in all_top_proposals],
+                  all_num_valid)
+
+    #only keep as much padding as the longest batch element needs,
+    #contiguous so the torch tensors made from them can be viewed
+    num_rows = max(1, all_num_valid.max())
+    return (np.ascontiguousarray(all_proposals[:, :num_rows]),
+            np.ascontiguousarray(all_scores[:, :num_rows]),
+            np.ascontiguousarray(all_anchor_inds[:, :num_rows]),
+            np.ascontiguousarray(all_labels[:, :num_rows]),
+            all_num_valid)
+
+
+def _top_proposals(anchors, bbox_deltas, scores, top_n, img_info, min_size,
+                   workspace, score_thresh=None):
+    """
+    Top scoring proposals of one image, decoding as few anchors as possible.
+
+    Same result as decoding every anchor, zeroing the boxes (and scores)
+    smaller than min_size and taking the top_n by score. Candidates are
+    picked with a partial sort, and the candidate set only grows if too
+    many of them are filtered out.
+
+    With a score_thresh only anchors scoring above it are candidates, and
+    filtered boxes are dropped instead of zeroed, so fewer than top_n 
+    proposals may be returned.
 
+    Input parameters:
+        anchors: (ndarray) Nx4 anchors
+        bbox_deltas: (ndarray) Nx4 predicted deltas
+        scores: (ndarray) N fg scores
+        top_n: (int) number of proposals to return, <= N
+        img_info: (tuple of int) image shape, for clipping
+        min_size: (float) min box side
+        workspace: (Workspace) for the decoded candidates
 
+        score_thresh (optional): (float) Default: None
 
+    Returns:
+        proposals: (ndarray) top_nx4, highest score first
+        scores: (ndarray) top_n 
+        anchor_inds: (ndarray) top_n index of each proposal's anchor
+    """
+    # anchors that can be candidates
+    if score_thresh is None:
+        pool = np.arange(scores.shape[0])
+    else:
+        pool = np.flatnonzero(scores > score_thresh)
+        top_n = min(top_n, len(pool))
+    num_anchors = len(pool)
+    num_candidates = top_n
+    while True:
+        if num_candidates >= num_anchors:
+            candidates = pool
+        elif score_thresh is None:
+            candidates = np.argpartition(scores, 
+                           num_anchors-num_candidates)[-num_candidates:]
+        else:
+            candidates = pool[np.argpartition(scores[pool],
+                           num_anchors-num_candidates)[-num_candidates:]]
+
+        # decode, clip and size filter the candidates in one pass
+        proposals = workspace.get('proposal_boxes', (len(candidates), 4),
+                                  bbox_deltas.dtype)
+        keep = workspace.get('proposal_keep', len(candidates), np.uint8)
+        num_keep = decode_clip_filter(anchors, bbox_deltas, candidates,
+                                      img_info[0], img_info[1], min_size,
+                                      proposals, keep)
+        candidate_scores = workspace.get('proposal_candidate_scores',
+                                         len(candidates), scores.dtype)
+        np.take(scores, candidates, out=candidate_scores)
+
+        if (num_keep >= top_n or 
+                num_candidates >= num_anchors):
+            break
+        #every non candidate scores lower, so enough survivors are exact
+        num_candidates = min(num_anchors, 2*num_candidates)
+
+    if score_thresh is None:
+        # filtered boxes are zeroed by decode_clip_filter
+        candidate_scores[keep == 0] = 0
+        order = candidate_scores.argsort()[::-1][:top_n]
+    else:
+        kept = np.flatnonzero(keep)
+        order = kept[candidate_scores[kept].argsort()[::-1][:top_n]]
+    return proposals[order,:], candidate_scores[order], candidates[order]
@@ -0,0 +1,296 @@
+# --------------------------------------------------------
+# Torch port of proposal_layer.py
+#
+# Same algorithm as the numpy proposal_layer, but all work stays on the
+# device of the network outputs. The numpy version is kept as a reference.
+# --------------------------------------------------------
+
+import numpy as np
+import torch
+
+from .anchor_grid import AnchorGrid
+from .proposal_budget import ProposalBudget
+from ..nms.torch_nms import batched_torch_nms
+
+
+def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16,
+                   anchor_scales=[2, 4, 8],gt_boxes=None, anchor_grid=None,
+                   score_thresh=None, max_keep=0, nms_thresh=None,
+                   budget=None):
+    '''
+    Outputs object detection proposals
+
+    Torch version of proposal_layer.proposal_layer, see there for the
+    algorithm.
+
+    Input parameters:
+
+        class_prob_reshape: (torch.FloatTensor) Bx(A*2)xHxW
+        bbox_pred:  (torch.FloatTensor) Bx(A*4)xHxW
+        img_info:  (tuple of int)
+        cfg: (Config)
+
+        _feat_stride(optional): (int) scaling factor between input feature
+                                map (class_prob_reshape) and original image.
+                                Default: 16
+        anchor_scales (optional):  (list of int) scale for size of anchor boxes
+                                   Default: [2,4,8]
+        gt_boxes (optional): (ndarray) If not None, return value all_labels
+                             will have fg/bg label of each anchor box. If None
+                             all_labels will be meaningless. Default: None
+        anchor_grid (optional): (AnchorGrid) shifted anchors for this feature
+                                map size, made here if None. Default: None
+        score_thresh (optional): (float) If not None, anchors with a score
+                                 <= score_thresh (>= 0) are dropped before
+                                 decoding and nms. Default: None
+        max_keep (optional): (int) If > 0, keep at most this many proposals
+                             after nms, on top of cfg.POST_NMS_TOP_N. 
+                             Default: 0
+        nms_thresh (optional): (float) IoU threshold of the nms, 
+                               cfg.NMS_THRESH if None. Default: None
+        budget (optional): (ProposalBudget) pre and post nms proposal 
+                           counts, records the counts used. Made here from
+                           cfg if None. Default: None
+
+    Returns:
+        all_proposals: (torch.FloatTensor) BxMx4 the proposed bounding boxes
+        all_scores: (torch.FloatTensor) BxMx1 fg score for each bounding box
+        all_anchor_inds: (torch.LongTensor) BxMx1 index of the anchor box
+                         that corresponds to the proposed bounding box
+        all_labels: (torch.LongTensor) BxM ground truth fg/bg label for each
+                    proposed bounding box.
+        all_num_valid: (torch.LongTensor) B number of proposals kept for each
+                       batch element, on the cpu. Rows after that are zero
+                       padding.
+    '''
+    batch_size = class_prob_reshape.size()[0]
+    height, width = class_prob_reshape.size()[2:4]
+    if anchor_grid is None:
+        anchor_grid = AnchorGrid(height, width, _feat_stride, anchor_scales,
+                                 img_info)
+    _num_anchors = anchor_grid.num_base_anchors
+
+    # 1. Generate proposals from bbox deltas and shifted anchors,
+    # rows ordered by (h, w, a)
+    anchors = anchor_grid.torch_anchors(bbox_pred)
+    num_total_anchors = anchor_grid.num_anchors
+
+    # the first set of _num_anchors channels are bg probs
+    # the second set are the fg probs, which we want
+    scores = class_prob_reshape[:, _num_anchors:, :, :]
+    scores = scores.permute(0, 2, 3, 1).contiguous().view(batch_size, -1)
+    bbox_deltas = bbox_pred.permute(0, 2, 3, 1).contiguous()
+    bbox_deltas = bbox_deltas.view(batch_size, -1, 4)
+
+    # (NOTE: convert min_size to input image scale stored in img_info[2])
+    min_size = cfg.PROPOSAL_MIN_BOX_SIZE * img_info[2]
+    if budget is None:
+        budget = ProposalBudget(cfg)
+    num_pre_nms, post_nms_top_n = budget.limits(height, width,
+                                                num_total_anchors, max_keep)
+    score_threshs = budget.score_thresholds(scores, score_thresh)
+
+    # 2. - 5. decode, clip, filter, sort and take top cfg.PRE_NMS_TOP_N.
+    # Candidates of all batch elements are flat, grouped by batch element
+    # with the highest score first
+    if score_threshs is None:
+        proposals, scores, anchor_inds, group_ids = _top_proposals(
+                                            anchors, bbox_deltas, scores,
+                                            num_pre_nms, img_info, min_size)
+    else:
+        proposals, scores, anchor_inds, group_ids = _prefiltered_proposals(
+                                            anchors, bbox_deltas, scores,
+                                            num_pre_nms, img_info, min_size,
+                                            score_threshs)
+
+    # 6. apply nms (e.g. threshold = 0.7), one call for the whole batch
+    # 7. take after_nms_topN (e.g. 300)
+    if nms_thresh is None:
+        nms_thresh = cfg.NMS_THRESH
+    keep = batched_torch_nms(proposals, scores, group_ids, nms_thresh,
+                             max_keep=post_nms_top_n)
+    # proposals kept and nms candidates of each batch element, read by the
+    # host with one copy
+    num_keeps, num_candidates = torch.stack((
+                            torch.bincount(group_ids[keep], minlength=batch_size),
+                            torch.bincount(group_ids, minlength=batch_size))).cpu()
+    all_keep = keep.split(num_keeps.tolist())
+
+    # 8. return the top proposals (-> RoIs top), zero padded to the
+    # longest batch element
+    num_rows = max([max(keep.numel(), 1) for keep in all_keep])
+    all_proposals = proposals.new_zeros((batch_size, num_rows, 4))
+    all_scores = scores.new_zeros((batch_size, num_rows, 1))
+    all_anchor_inds = anchor_inds.new_zeros((batch_size, num_rows, 1))
+    all_labels = anchor_inds.new_zeros((batch_size, num_rows))
+    if gt_boxes is not None:
+        #one copy to the device for the whole batch
+        device_gt_boxes = proposals.new_tensor(np.asarray(gt_boxes[:, :4],
+                                                          dtype=np.float32))
+    for batch_ind, keep in enumerate(all_keep):
+        num_keep = keep.numel()
+        if num_keep == 0:
+            continue
+        b_proposals = proposals[keep]
+        all_proposals[batch_ind, :num_keep] = b_proposals
+        all_scores[batch_ind, :num_keep, 0] = scores[keep]
+        all_anchor_inds[batch_ind, :num_keep, 0] = (anchor_inds[keep] +
+                                              batch_ind*num_total_anchors)
+
+        #match anchor inds with gt boxes
+        if gt_boxes is None:
+            all_labels[batch_ind, :num_keep].fill_(-1)
+        elif gt_boxes[batch_ind,-1] != 0:#not a bg box
+            all_labels[batch_ind, :num_keep] = _proposal_labels(b_proposals,
+                                                  device_gt_boxes[batch_ind])
+
+    all_num_valid = num_keeps
+    budget.record(num_pre_nms, post_nms_top_n, num_candidates.numpy(),
+                  all_num_valid.numpy())
+    return all_proposals, all_scores, all_anchor_inds, all_labels, all_num_valid
+
+
+def _top_proposals(anchors, bbox_deltas, scores, top_n, img_info, min_size):
+    '''
+    Top top_n proposals of each batch element, decoding every anchor
+
+    Boxes smaller than min_size are zeroed and get score 0.
+
+    Returns:
+        proposals: (torch.FloatTensor) (B*top_n)x4
+        scores: (torch.FloatTensor) B*top_n
+        anchor_inds: (torch.LongTensor) B*top_n anchor of each proposal
+        group_ids: (torch.LongTensor) B*top_n batch element of each proposal
+    '''
+    batch_size = scores.size()[0]
+    proposals = bbox_transform_inv(anchors.unsqueeze(0), bbox_deltas)
+
+    # 2. clip predicted boxes to image
+    proposals = clip_boxes(proposals, img_info[:2])
+
+    # 3. remove predicted boxes with either height or width < threshold
+    lose = _filter_boxes(proposals, min_size)
+    proposals = proposals.masked_fill(lose.unsqueeze(2), 0)
+    scores = scores.masked_fill(lose, 0)
+
+    # 4. sort all (proposal, score) pairs by score from highest to lowest
+    # 5. take top cfg.PRE_NMS_TOP_N (e.g. 6000)
+    scores, order = scores.topk(top_n, dim=1, sorted=True)
+    proposals = proposals.gather(1, order.unsqueeze(2).expand(batch_size,
+                                                              top_n, 4))
+    group_ids = torch.arange(batch_size, device=order.device)
+    group_ids = group_ids.unsqueeze(1).expand(batch_size, top_n)
+    return (proposals.view(-1, 4), scores.view(-1), order.view(-1),
+            group_ids.reshape(-1))
+
+
+def _prefiltered_proposals(anchors, bbox_deltas, scores, top_n, img_info,
+                           min_size, score_threshs):
+    '''
+    Like _top_proposals, but only anchors scoring over the B score_threshs
+    of their batch element are decoded, and boxes smaller than min_size are
+    dropped
+
+    Gives the proposals of _top_proposals that score over the threshold, so
+    fewer than top_n may be returned for a batch element.
+    '''
+    batch_size = scores.size()[0]
+    over = scores > score_threshs.unsqueeze(1)
+    batch_inds, anchor_inds = over.nonzero().t()
+    proposals = bbox_transform_inv(anchors[anchor_inds].unsqueeze(0),
+                                   bbox_deltas[batch_inds, 
+                                               anchor_inds].unsqueeze(0))
+    proposals = clip_boxes(proposals, img_info[:2])
+    keep = ~_filter_boxes(proposals, min_size)[0]
+    proposals = proposals[0][keep]
+    batch_inds = batch_inds[keep]
+    anchor_inds = anchor_inds[keep]
+    scores = scores[batch_inds, anchor_inds]
+
+    # highest score first within each batch element, then the top top_n
+    order = scores.sort(descending=True)[1]
+    order = order[batch_inds[order].sort(stable=True)[1]]
+    num_per_batch = torch.bincount(batch_inds, minlength=batch_size)
+    starts = torch.cumsum(num_per_batch, 0) - num_per_batch
+    ranks = (torch.arange(order.numel(), device=order.device) -
+             starts[batch_inds[order]])
+    order = order[ranks < top_n]
+    return (proposals[order], scores[order], anchor_inds[order],
+            batch_inds[order])
+
+
+def bbox_transform_inv(boxes, deltas):
+    '''
+    Apply predicted deltas to boxes, same as bbox_transform.bbox_transform_inv
+
+    boxes: 1xNx4 or BxNx4, deltas: BxNx4
+    '''
+    widths = boxes[:, :, 2] - boxes[:, :, 0] + 1.0
+    heights = boxes[:, :, 3] - boxes[:, :, 1] + 1.0
+    ctr_x = boxes[:, :, 0] + 0.5 * widths
+    ctr_y = boxes[:, :, 1] + 0.5 * heights
+
+    pred_ctr_x = deltas[:, :, 0] * widths + ctr_x
+    pred_ctr_y = deltas[:, :, 1] * heights + ctr_y
+    pred_w = torch.exp(deltas[:, :, 2]) * widths
+    pred_h = torch.exp(deltas[:, :, 3]) * heights
+
+    return torch.stack((pred_ctr_x - 0.5 * pred_w,
+                        pred_ctr_y - 0.5 * pred_h,
+                        pred_ctr_x + 0.5 * pred_w,
+                        pred_ctr_y + 0.5 * pred_h), 2)
+
+
+def clip_boxes(boxes, im_shape):
+    '''
+    Clip BxNx4 boxes to image boundaries.
+    '''
+    #clamp with python numbers, so no bounds tensor is copied to the device
+    xs = boxes[:, :, 0::2].clamp(0, im_shape[1] - 1)
+    ys = boxes[:, :, 1::2].clamp(0, im_shape[0] - 1)
+    return torch.stack((xs[:, :, 0], ys[:, :, 0], xs[:, :, 1], ys[:, :, 1]), 2)
+
+
+def bbox_overlaps(boxes, query_boxes):
+    '''
+    IoU of Nx4 boxes with Kx4 query_boxes, same as cython_bbox.bbox_overlaps
+
+    Returns:
+        (torch.FloatTensor) NxK overlaps
+    '''
+    box_areas = ((boxes[:, 2] - boxes[:, 0] + 1) *
+                 (boxes[:, 3] - boxes[:, 1] + 1))
+    query_areas = ((query_boxes[:, 2] - query_boxes[:, 0] + 1) *
+                   (query_boxes[:, 3] - query_boxes[:, 1] + 1))
+    iw = (torch.min(boxes[:, 2:3], query_boxes[:, 2].unsqueeze(0)) -
+          torch.max(boxes[:, 0:1], query_boxes[:, 0].unsqueeze(0)) + 1)
+    ih = (torch.min(boxes[:, 3:4], query_boxes[:, 3].unsqueeze(0)) -
+          torch.max(boxes[:, 1:2], query_boxes[:, 1].unsqueeze(0)) + 1)
+    inter = iw.clamp(min=0) * ih.clamp(min=0)
+    ua = box_areas.unsqueeze(1) + query_areas.unsqueeze(0) - inter
+    return inter / ua
+
+
+def _filter_boxes(boxes, min_size):
+    """Mask of all boxes with both sides smaller than min_size."""
+    ws = boxes[:, :, 2] - boxes[:, :, 0] + 1
+    hs = boxes[:, :, 3] - boxes[:, :, 1] + 1
+    return (ws < min_size) & (hs < min_size)
+
+
+def _proposal_labels(proposals, gt_box):
+    '''
+    fg/bg label of each proposal given a single (non bg) gt box, a 4 
+    tensor on the device of proposals
+
+    Same rules and thresholds as the numpy proposal_layer.
+    '''
+    overlaps = bbox_overlaps(proposals, gt_box.view(1, 4)).view(-1)
+    labels = torch.zeros_like(overlaps, dtype=torch.long)
+    # fg label: for each gt, anchor with highest overlap
+    labels.masked_fill_(overlaps == overlaps.max(), 1)
+    # fg label: above threshold IOU
+    labels.masked_fill_(overlaps >= .5, 1)
+    # assign bg labels last so that negative labels can clobber positives
+    labels.masked_fill_(overlaps < .2, 0)
+    return labels
@@ -0,0 +1,70 @@
+# --------------------------------------------------------
+# Workspace buffers
+#
+# The numpy proposal and anchor target layers need the same temporary
+# arrays (transposed deltas, decoded boxes, labels, masks) every step, with
+# the same few shapes. A Workspace keeps those buffers between calls, so in
+# steady state the layers allocate almost nothing but their outputs.
+# --------------------------------------------------------
+
+import numpy as np
+
+
+class Workspace(object):
+    '''
+    Named, reusable scratch buffers
+
+    Each name has one buffer per dtype, grown when a bigger array is asked
+    for. Arrays from get() are only valid until the next get() of the same
+    name, so a name must only be used at one place. Never return them from
+    a layer, the outputs may be wrapped by torch.from_numpy.
+
+    Input parameters:
+        max_bytes (optional): (int) buffers are dropped after a get() if
+                              together they use more than this, 0 for no
+                              limit. Default: 0
+    '''
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._buffers = {}
+        self.num_allocations = 0
+
+    def get(self, name, shape, dtype=np.float32):
+        '''
+        Uninitialized array of the given shape
+
+        Input parameters:
+            name: (str) use site of the array
+            shape: (tuple of int)
+            dtype (optional): (numpy dtype) Default: np.float32
+
+        Returns:
+            (ndarray) C contiguous view of the buffer
+        '''
+        dtype = np.dtype(dtype)
+        shape = tuple(int(s) for s in np.atleast_1d(shape))
+        size = int(np.prod(shape))
+        key = (name, dtype)
+        buf = self._buffers.get(key)
+        if buf is None or buf.size < size:
+            # some room to grow, sizes change a bit from step to step
+            buf = np.empty(size + size//8, dtype=dtype)
+            self._buffers[key] = buf
+            self.num_allocations += 1
+            if self.max_bytes > 0 and self.nbytes > self.max_bytes:
+                self._buffers = {key: buf}
+        return buf[:size].reshape(shape)
+
+    def zeros(self, name, shape, dtype=np.float32):
+        '''Same as get(), filled with 0'''
+        arr = self.get(name, shape, dtype)
+        arr.fill(0)
+        return arr
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+    def clear(self):
+        self._buffers = {}
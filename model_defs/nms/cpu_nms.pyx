@@ -5,64 +5,131 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
+cimport cython
+from cython.parallel cimport prange
+import os
 import numpy as np
 cimport numpy as np
 
-cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
+#threads used to suppress boxes, only has an effect in an OpenMP build
+cdef int _num_threads = os.cpu_count() or 1
+#under this many boxes left a kept box suppresses the rest on one thread
+cdef Py_ssize_t _MIN_PARALLEL_BOXES = 2048
+
+cdef inline np.float32_t max(np.float32_t a, np.float32_t b) nogil:
     return a if a >= b else b
 
-cdef inline np.float32_t min(np.float32_t a, np.float32_t b):
+cdef inline np.float32_t min(np.float32_t a, np.float32_t b) nogil:
     return a if a <= b else b
 
-def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
-    cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
-    cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
-    cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
-    cdef np.ndarray[np.float32_t, ndim=1] y2 = dets[:, 3]
-    cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4]
 
-    cdef np.ndarray[np.float32_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    cdef np.ndarray[np.int_t, ndim=1] order = scores.argsort()[::-1]
+def set_num_threads(int num_threads):
+    """Threads for cpu_nms, <= 0 for one per core."""
+    global _num_threads
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+    _num_threads = num_threads
 
-    cdef int ndets = dets.shape[0]
-    cdef np.ndarray[np.int_t, ndim=1] suppressed = \
-            np.zeros((ndets), dtype=np.int)
 
-    # nominal indices
-    cdef int _i, _j
-    # sorted indices
-    cdef int i, j
-    # temp variables for box i's (the box currently under consideration)
-    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+def get_num_threads():
+    return _num_threads
+
+
+cdef inline bint _suppresses(np.float32_t ix1, np.float32_t iy1,
+                             np.float32_t ix2, np.float32_t iy2,
+                             np.float32_t iarea, np.float32_t* x1,
+                             np.float32_t* y1, np.float32_t* x2,
+                             np.float32_t* y2, np.float32_t* areas,
+                             Py_ssize_t j, double thresh) nogil:
+    """Whether kept box i suppresses (lower scoring) box j."""
     # variables for computing overlap with box j (lower scoring box)
     cdef np.float32_t xx1, yy1, xx2, yy2
     cdef np.float32_t w, h
     cdef np.float32_t inter, ovr
+    xx1 = max(ix1, x1[j])
+    yy1 = max(iy1, y1[j])
+    xx2 = min(ix2, x2[j])
+    yy2 = min(iy2, y2[j])
+    w = max(0.0, xx2 - xx1 + 1)
+    h = max(0.0, yy2 - yy1 + 1)
+    inter = w * h
+    ovr = inter / (iarea + areas[j] - inter)
+    return ovr >= thresh
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, double thresh,
+            int max_keep=0):
+    """
+    Greedy nms, stops once max_keep boxes are kept if max_keep > 0.
+
+    Runs without the GIL. Boxes are visited in score order, each kept box
+    checks the boxes still left on all threads, and the suppressed ones
+    are then dropped from the list of boxes left.
+    """
+    if dets.shape[0] == 0:
+        return np.zeros((0,), dtype=np.intp)
+
+    cdef np.ndarray[np.intp_t, ndim=1] order_arr = \
+            np.ascontiguousarray(dets[:, 4].argsort()[::-1])
+    #sorted copies, so the inner loop reads memory in order
+    cdef np.float32_t[::1] x1 = np.ascontiguousarray(dets[order_arr, 0])
+    cdef np.float32_t[::1] y1 = np.ascontiguousarray(dets[order_arr, 1])
+    cdef np.float32_t[::1] x2 = np.ascontiguousarray(dets[order_arr, 2])
+    cdef np.float32_t[::1] y2 = np.ascontiguousarray(dets[order_arr, 3])
+    cdef np.intp_t[::1] order = order_arr
+
+    cdef Py_ssize_t ndets = dets.shape[0]
+    cdef np.float32_t[::1] areas = np.empty((ndets), dtype=np.float32)
+    #sorted positions of the boxes not kept or suppressed yet
+    cdef np.intp_t[::1] left = np.arange(ndets, dtype=np.intp)
+    cdef Py_ssize_t num_left = ndets
+    cdef np.uint8_t[::1] suppressed = np.zeros((ndets), dtype=np.uint8)
+    keep_arr = np.empty((ndets), dtype=np.intp)
+    cdef np.intp_t[::1] keep = keep_arr
+    cdef Py_ssize_t num_keep = 0
+
+    # sorted indices
+    cdef Py_ssize_t i, _j, num_next
+    # temp variables for box i's (the box currently under consideration)
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+
+    with nogil:
+        for i in range(ndets):
+            areas[i] = (x2[i] - x1[i] + 1) * (y2[i] - y1[i] + 1)
+
+        while num_left > 0:
+            i = left[0]
+            keep[num_keep] = order[i]
+            num_keep = num_keep + 1
+            if max_keep > 0 and num_keep >= max_keep:
+                break
+            ix1 = x1[i]
+            iy1 = y1[i]
+            ix2 = x2[i]
+            iy2 = y2[i]
+            iarea = areas[i]
+            num_next = 0
+            if _num_threads > 1 and num_left >= _MIN_PARALLEL_BOXES:
+                for _j in prange(1, num_left, num_threads=_num_threads,
+                                 schedule='static'):
+                    suppressed[_j] = _suppresses(ix1, iy1, ix2, iy2, iarea,
+                                                 &x1[0], &y1[0], &x2[0],
+                                                 &y2[0], &areas[0],
+                                                 left[_j], thresh)
+                for _j in range(1, num_left):
+                    if not suppressed[_j]:
+                        left[num_next] = left[_j]
+                        num_next = num_next + 1
+            else:
+                #one thread, drop the suppressed boxes in the same pass
+                for _j in range(1, num_left):
+                    if not _suppresses(ix1, iy1, ix2, iy2, iarea,
+                                       &x1[0], &y1[0], &x2[0], &y2[0],
+                                       &areas[0], left[_j], thresh):
+                        left[num_next] = left[_j]
+                        num_next = num_next + 1
+            num_left = num_next
 
-    keep = []
-    for _i in range(ndets):
-        i = order[_i]
-        if suppressed[i] == 1:
-            continue
-        keep.append(i)
-        ix1 = x1[i]
-        iy1 = y1[i]
-        ix2 = x2[i]
-        iy2 = y2[i]
-        iarea = areas[i]
-        for _j in range(_i + 1, ndets):
-            j = order[_j]
-            if suppressed[j] == 1:
-                continue
-            xx1 = max(ix1, x1[j])
-            yy1 = max(iy1, y1[j])
-            xx2 = min(ix2, x2[j])
-            yy2 = min(iy2, y2[j])
-            w = max(0.0, xx2 - xx1 + 1)
-            h = max(0.0, yy2 - yy1 + 1)
-            inter = w * h
-            ovr = inter / (iarea + areas[j] - inter)
-            if ovr >= thresh:
-                suppressed[j] = 1
-
-    return keep
+    return keep_arr[:num_keep]
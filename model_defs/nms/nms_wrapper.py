@@ -5,18 +5,234 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-#from faster_rcnn.nms.cpu_nms import cpu_nms
-#from faster_rcnn.nms.gpu_nms import gpu_nms
-from .cpu_nms import cpu_nms
-from .gpu_nms import gpu_nms
+import numpy as np
 
+from .py_cpu_nms import py_cpu_nms
 
-def nms(dets, thresh, force_cpu=False):
-    """Dispatch to either CPU or GPU NMS implementations."""
+#the compiled and torch backends are optional, nms picks from what is there
+try:
+    from .cpu_nms import cpu_nms
+    from . import cpu_nms as _cpu_nms_module
+except ImportError:
+    cpu_nms = None
+    _cpu_nms_module = None
+try:
+    from ..anchors import cython_bbox as _cython_bbox_module
+except ImportError:
+    _cython_bbox_module = None
+try:
+    from .gpu_nms import gpu_nms
+except ImportError:
+    gpu_nms = None
+try:
+    import torch
+    from .torch_nms import torch_nms, batched_torch_nms, fast_nms
+except ImportError:
+    torch = None
+    torch_nms = None
+    batched_torch_nms = None
+    fast_nms = None
+
+#under this many boxes the gpu is not worth the copies
+GPU_NMS_MIN_BOXES = 1000
+#prefer backends that stop early when at most 1/this of the boxes are kept
+EARLY_STOP_MIN_RATIO = 4
+
+
+def set_num_threads(num_threads):
+    """
+    Threads used by the cython box overlap and cpu_nms kernels. Only has an
+    effect if they were built with OpenMP.
+
+    Input parameters:
+        num_threads: (int) <= 0 for one per core
+    """
+    for module in (_cpu_nms_module, _cython_bbox_module):
+        if module is not None:
+            module.set_num_threads(num_threads)
+
+
+def available_backends():
+    """Names of the nms backends that can run here, fastest first."""
+    backends = []
+    if gpu_nms is not None and torch is not None and torch.cuda.is_available():
+        backends.append('gpu')
+    if torch_nms is not None:
+        backends.append('torch')
+    if cpu_nms is not None:
+        backends.append('cpu')
+    backends.append('numpy')
+    return backends
+
+
+def choose_backend(num_boxes, force_cpu=False, max_keep=0):
+    """
+    The backend nms uses for num_boxes boxes when backend is 'auto'.
+
+    The gpu is only used for large inputs. On the cpu torchvision's kernel
+    is preferred, then the cython cpu_nms, then numpy, which always works.
+    If only a few boxes will be kept (max_keep), the cpu backends that stop
+    early are preferred over torchvision, which always finishes.
+    """
+    backends = available_backends()
+    if 'gpu' in backends and (force_cpu or num_boxes < GPU_NMS_MIN_BOXES):
+        backends.remove('gpu')
+    if ('torch' in backends and backends[0] != 'gpu' and max_keep > 0 and
+            max_keep*EARLY_STOP_MIN_RATIO <= num_boxes):
+        backends.remove('torch')
+    return backends[0]
+
+
+def nms(dets, thresh, force_cpu=False, backend='auto', max_keep=0,
+        score_thresh=None):
+    """
+    Dispatch to one of the NMS implementations.
+
+    All backends keep the same boxes, up to boxes whose overlap is within
+    float rounding of thresh (cpu_nms suppresses an overlap of exactly 
+    thresh, the others keep it).
+
+    Input parameters:
+        dets: (ndarray) Nx5 float32 boxes (x1,y1,x2,y2) and scores
+        thresh: (float) IoU threshold
+
+        force_cpu (optional): (bool) never use the gpu. Default: False
+        backend (optional): (str) 'auto', 'gpu', 'torch', 'cpu' or 'numpy'.
+                            Default: 'auto', pick with choose_backend
+        max_keep (optional): (int) if > 0, stop once this many boxes are
+                             kept. Same as keep[:max_keep]. Default: 0
+        score_thresh (optional): (float) boxes scoring below this are
+                                 never kept. Default: None
+
+    Returns:
+        (ndarray) int64 indices of kept boxes, highest score first
+    """
+    inds = None
+    if score_thresh is not None:
+        #boxes below the floor come last, so they can not suppress any
+        #kept box and can be dropped up front
+        inds = np.where(dets[:, 4] >= score_thresh)[0]
+        dets = dets[inds, :]
 
     if dets.shape[0] == 0:
-        return []
-    if True: #cfg.USE_GPU_NMS and not force_cpu:
-        return gpu_nms(dets, thresh, device_id=0)
+        return np.zeros((0,), dtype=np.int64)
+    if backend == 'auto':
+        backend = choose_backend(dets.shape[0], force_cpu=force_cpu,
+                                 max_keep=max_keep)
+
+    if backend == 'gpu':
+        keep = gpu_nms(dets, thresh, device_id=0)
+        if max_keep > 0:
+            keep = keep[:max_keep]
+    elif backend == 'torch':
+        dets = torch.from_numpy(np.ascontiguousarray(dets, dtype=np.float32))
+        keep = torch_nms(dets[:, :4], dets[:, 4], thresh,
+                         max_keep=max_keep).numpy()
+    elif backend == 'cpu':
+        keep = cpu_nms(np.ascontiguousarray(dets, dtype=np.float32), thresh,
+                       max_keep=max_keep)
+    elif backend == 'numpy':
+        keep = py_cpu_nms(dets, thresh, max_keep=max_keep)
     else:
-        return cpu_nms(dets, thresh)
+        raise ValueError('unknown nms backend: {}'.format(backend))
+
+    keep = np.asarray(keep, dtype=np.int64)
+    if inds is not None:
+        keep = inds[keep]
+    return keep
+
+
+def batched_nms(dets, group_ids, thresh, force_cpu=False, backend='auto',
+                max_keep=0, mode='exact'):
+    """
+    NMS of many independent groups of boxes (batch elements, targets) in
+    one call. Boxes only suppress boxes of their own group.
+
+    In 'exact' mode the result is the same as calling nms on each group
+    with the same backend. On the gpu ('gpu', or 'auto' once the whole 
+    batch is large enough for the gpu) every group is done in one 
+    batched_torch_nms call on cuda tensors, with the same kept boxes as
+    gpu_nms up to the order of tied scores. The cpu backends run the 
+    groups one after the other.
+
+    The 'matrix' mode uses fast_nms, which checks every group at once with
+    one IoU matrix and no sequential loop, but can drop a few more boxes
+    than greedy NMS. It builds an MxM matrix per group, M the size of the
+    largest group, so it is meant for the few hundred boxes per target
+    left at test time, and pays off on the gpu.
+
+    Input parameters:
+        dets: (ndarray) Nx5 float32 boxes (x1,y1,x2,y2) and scores
+        group_ids: (ndarray) N int group of each box
+        thresh: (float) IoU threshold
+
+        force_cpu (optional): (bool) never use the gpu. Default: False
+        backend (optional): (str) 'auto', 'gpu', 'torch', 'cpu' or 'numpy'.
+                            Only for 'exact' mode. Default: 'auto'
+        max_keep (optional): (int) if > 0, keep at most this many boxes of
+                             each group. Default: 0
+        mode (optional): (str) 'exact' or 'matrix'. Default: 'exact'
+
+    Returns:
+        (ndarray) int64 indices of kept boxes, ordered by group and then 
+        highest score first
+    """
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    if dets.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    if mode == 'matrix':
+        if fast_nms is None:
+            raise ValueError('matrix nms needs torch')
+        dets = torch.from_numpy(np.ascontiguousarray(dets, dtype=np.float32))
+        device_group_ids = torch.from_numpy(group_ids)
+        if not force_cpu and torch.cuda.is_available():
+            dets = dets.cuda()
+            device_group_ids = device_group_ids.cuda()
+        keep = fast_nms(dets[:, :4], dets[:, 4], device_group_ids, thresh)
+        keep = _first_of_each_group(keep.cpu().numpy(), group_ids, max_keep)
+        return keep.astype(np.int64)
+    elif mode != 'exact':
+        raise ValueError('unknown batched nms mode: {}'.format(mode))
+
+    if (backend == 'auto' and 
+            choose_backend(dets.shape[0], force_cpu=force_cpu) == 'gpu'):
+        backend = 'gpu'
+    if backend in ('torch', 'gpu'):
+        #on the gpu all groups go to the kernel in one launch
+        dets = torch.from_numpy(np.ascontiguousarray(dets, dtype=np.float32))
+        device_group_ids = torch.from_numpy(group_ids)
+        if backend == 'gpu':
+            dets = dets.cuda()
+            device_group_ids = device_group_ids.cuda()
+        keep = batched_torch_nms(dets[:, :4], dets[:, 4], device_group_ids,
+                                 thresh, max_keep=max_keep)
+        return keep.cpu().numpy().astype(np.int64)
+
+    #boxes of different groups never interact, so on the cpu running the
+    #groups one after the other is as fast as it gets, and every group
+    #still stops early at max_keep
+    order = np.argsort(group_ids, kind='stable')
+    groups, starts = np.unique(group_ids[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    all_keep = []
+    for start, end in zip(starts, ends):
+        inds = order[start:end]
+        keep = nms(dets[inds, :], thresh, force_cpu=force_cpu, 
+                   backend=backend, max_keep=max_keep)
+        all_keep.append(inds[keep])
+    return np.concatenate(all_keep).astype(np.int64)
+
+
+def _first_of_each_group(inds, group_ids, max_num):
+    """
+    Stable reorder of inds by group_ids[inds], keeping the first max_num
+    of each group (all of them if max_num <= 0)
+    """
+    inds = inds[np.argsort(group_ids[inds], kind='stable')]
+    if max_num <= 0:
+        return inds
+    _, starts, inverse = np.unique(group_ids[inds], return_index=True,
+                                   return_inverse=True)
+    ranks = np.arange(len(inds)) - starts[inverse]
+    return inds[ranks < max_num]
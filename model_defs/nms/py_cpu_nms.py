@@ -7,8 +7,8 @@
 
 import numpy as np
 
-def py_cpu_nms(dets, thresh):
-    """Pure Python NMS baseline."""
+def py_cpu_nms(dets, thresh, max_keep=0):
+    """Pure Python NMS baseline, stops after max_keep boxes if max_keep > 0."""
     x1 = dets[:, 0]
     y1 = dets[:, 1]
     x2 = dets[:, 2]
@@ -22,6 +22,8 @@ def py_cpu_nms(dets, thresh):
     while order.size > 0:
         i = order[0]
         keep.append(i)
+        if max_keep > 0 and len(keep) >= max_keep:
+            break
         xx1 = np.maximum(x1[i], x1[order[1:]])
         yy1 = np.maximum(y1[i], y1[order[1:]])
         xx2 = np.minimum(x2[i], x2[order[1:]])
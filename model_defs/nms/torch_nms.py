@@ -0,0 +1,190 @@
+# --------------------------------------------------------
+# Greedy NMS on torch tensors
+#
+# Uses torchvision's nms kernel when torchvision is installed, otherwise
+# a greedy loop over the pairwise IoU matrix. Runs on the device of the
+# boxes.
+# --------------------------------------------------------
+
+import torch
+
+try:
+    from torchvision.ops import nms as _torchvision_nms
+except ImportError:
+    _torchvision_nms = None
+
+
+def torch_nms(boxes, scores, thresh, max_keep=0):
+    '''
+    Greedy non maximum suppression on the device of boxes
+
+    Matches gpu_nms: boxes are inclusive pixel coordinates, a box is
+    suppressed if its IoU with a higher scoring box is > thresh.
+
+    Input parameters:
+        boxes: (torch.FloatTensor) Nx4
+        scores: (torch.FloatTensor) N
+        thresh: (float) IoU threshold
+
+        max_keep (optional): (int) if > 0, keep at most this many boxes.
+                             Default: 0
+
+    Returns:
+        (torch.LongTensor) indices of kept boxes, highest score first
+    '''
+    if boxes.size()[0] == 0:
+        return boxes.new_zeros((0,), dtype=torch.long)
+    if _torchvision_nms is not None:
+        # torchvision uses exclusive x2,y2, shift them to keep the +1 area
+        shifted = boxes.clone()
+        shifted[:, 2:] += 1
+        keep = _torchvision_nms(shifted, scores, thresh)
+        if max_keep > 0:
+            keep = keep[:max_keep]
+        return keep
+
+    order = scores.sort(0, descending=True)[1]
+    boxes = boxes[order]
+    areas = ((boxes[:, 2] - boxes[:, 0] + 1) *
+             (boxes[:, 3] - boxes[:, 1] + 1))
+    iw = (torch.min(boxes[:, 2:3], boxes[:, 2].unsqueeze(0)) -
+          torch.max(boxes[:, 0:1], boxes[:, 0].unsqueeze(0)) + 1)
+    ih = (torch.min(boxes[:, 3:4], boxes[:, 3].unsqueeze(0)) -
+          torch.max(boxes[:, 1:2], boxes[:, 1].unsqueeze(0)) + 1)
+    inter = iw.clamp(min=0) * ih.clamp(min=0)
+    overlaps = inter / (areas.unsqueeze(1) + areas.unsqueeze(0) - inter)
+
+    overlaps = (overlaps > thresh).cpu()
+    suppressed = torch.zeros(order.numel(), dtype=torch.bool)
+    keep = []
+    for i in range(order.numel()):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        if max_keep > 0 and len(keep) >= max_keep:
+            break
+        suppressed |= overlaps[i]
+    keep = torch.tensor(keep, dtype=torch.long, device=order.device)
+    return order[keep]
+
+
+def batched_torch_nms(boxes, scores, group_ids, thresh, max_keep=0):
+    '''
+    torch_nms of many independent groups of boxes in one call
+
+    Same result as running torch_nms on each group. On the gpu every group
+    is suppressed in a single kernel call, by moving each group's boxes far
+    enough apart that boxes from different groups can not overlap (done in
+    float64, so the shifted coordinates are exact). On the cpu that only
+    adds work, so the groups are run one after the other.
+
+    Input parameters:
+        boxes: (torch.FloatTensor) Nx4
+        scores: (torch.FloatTensor) N
+        group_ids: (torch.LongTensor) N group of each box
+        thresh: (float) IoU threshold
+
+        max_keep (optional): (int) if > 0, keep at most this many boxes of
+                             each group. Default: 0
+
+    Returns:
+        (torch.LongTensor) indices of kept boxes, ordered by group and then
+        highest score first
+    '''
+    if boxes.size()[0] == 0:
+        return boxes.new_zeros((0,), dtype=torch.long)
+
+    if not boxes.is_cuda:
+        all_keep = []
+        for group_id in group_ids.unique():
+            inds = (group_ids == group_id).nonzero().view(-1)
+            keep = torch_nms(boxes[inds], scores[inds], thresh,
+                             max_keep=max_keep)
+            all_keep.append(inds[keep])
+        return torch.cat(all_keep)
+
+    boxes = boxes.double()
+    boxes = boxes - boxes.min()
+    offsets = group_ids.double() * (boxes.max() + 2)
+    keep = torch_nms(boxes + offsets.view(-1, 1), scores.double(), thresh)
+    return _first_of_each_group(keep, group_ids, max_keep)
+
+
+def fast_nms(boxes, scores, group_ids, thresh, top_k=0):
+    '''
+    Approximate NMS of many groups of boxes with one batched IoU matrix
+
+    A box is dropped if it overlaps (IoU > thresh) any higher scoring box
+    of its group, even one that was itself dropped, so it can drop a few
+    more boxes than greedy NMS. There is no sequential loop, so all groups
+    are done at once.
+
+    Input parameters:
+        boxes: (torch.FloatTensor) Nx4
+        scores: (torch.FloatTensor) N
+        group_ids: (torch.LongTensor) N group of each box
+        thresh: (float) IoU threshold
+
+        top_k (optional): (int) if > 0, only the top_k scoring boxes of each
+                          group are considered. Default: 0
+
+    Returns:
+        (torch.LongTensor) indices of kept boxes, ordered by group and then
+        highest score first
+    '''
+    if boxes.size()[0] == 0:
+        return boxes.new_zeros((0,), dtype=torch.long)
+
+    # order by group, then by score, and pad each group to the same size
+    order = scores.sort(0, descending=True)[1]
+    order = order[group_ids[order].sort(stable=True)[1]]
+    if top_k > 0:
+        order = _first_of_each_group(order, group_ids, top_k)
+    groups, group_inds, group_sizes = group_ids[order].unique(
+                                            return_inverse=True,
+                                            return_counts=True)
+    group_starts = group_sizes.cumsum(0) - group_sizes
+    ranks = torch.arange(order.numel(), device=order.device)
+    ranks = ranks - group_starts[group_inds]
+
+    num_groups = groups.numel()
+    max_size = int(group_sizes.max())
+    padded = boxes.new_zeros((num_groups, max_size, 4))
+    padded[group_inds, ranks] = boxes[order]
+    valid = torch.zeros((num_groups, max_size), dtype=torch.bool,
+                        device=boxes.device)
+    valid[group_inds, ranks] = True
+
+    # GxMxM IoU of every pair of boxes in a group
+    areas = ((padded[:, :, 2] - padded[:, :, 0] + 1) *
+             (padded[:, :, 3] - padded[:, :, 1] + 1))
+    iw = (torch.min(padded[:, :, 2:3], padded[:, :, 2].unsqueeze(1)) -
+          torch.max(padded[:, :, 0:1], padded[:, :, 0].unsqueeze(1)) + 1)
+    ih = (torch.min(padded[:, :, 3:4], padded[:, :, 3].unsqueeze(1)) -
+          torch.max(padded[:, :, 1:2], padded[:, :, 1].unsqueeze(1)) + 1)
+    inter = iw.clamp(min=0) * ih.clamp(min=0)
+    overlaps = inter / (areas.unsqueeze(2) + areas.unsqueeze(1) - inter)
+
+    # only compare with higher scoring, real boxes
+    overlaps = overlaps.triu(diagonal=1)
+    overlaps.masked_fill_(~valid.unsqueeze(2), 0)
+    max_overlaps = overlaps.max(1)[0]
+
+    keep = (max_overlaps <= thresh)[group_inds, ranks]
+    return order[keep]
+
+
+def _first_of_each_group(inds, group_ids, max_num):
+    '''
+    Stable reorder of inds by group_ids[inds], keeping the first max_num
+    of each group (all of them if max_num <= 0)
+    '''
+    inds = inds[group_ids[inds].sort(stable=True)[1]]
+    if max_num <= 0:
+        return inds
+    _, group_inds, group_sizes = group_ids[inds].unique(return_inverse=True,
+                                                        return_counts=True)
+    group_starts = group_sizes.cumsum(0) - group_sizes
+    ranks = torch.arange(inds.numel(), device=inds.device)
+    ranks = ranks - group_starts[group_inds]
+    return inds[ranks < max_num]
@@ -30,7 +30,7 @@ def locate_cuda():
     and values giving the absolute path to each directory.
 
     Starts by looking for the CUDA_HOME env variable. If not found, everything
-    is based on finding 'nvcc' in the PATH.
+    is based on finding 'nvcc' in the PATH. Returns None if there is no nvcc.
     """
 
     # first check if the CUDAHOME env variable is in use
@@ -42,8 +42,10 @@ def locate_cuda():
         default_path = pjoin(os.sep, 'usr', 'local', 'cuda', 'bin')
         nvcc = find_in_path('nvcc', os.environ['PATH'] + os.pathsep + default_path)
         if nvcc is None:
-            raise EnvironmentError('The nvcc binary could not be '
-                                   'located in your $PATH. Either add it to your path, or set $CUDAHOME')
+            print('The nvcc binary could not be located in your $PATH, '
+                  'building without gpu_nms. Either add it to your path, '
+                  'or set $CUDAHOME')
+            return None
         home = os.path.dirname(os.path.dirname(nvcc))
 
     cudaconfig = {'home': home, 'nvcc': nvcc,
@@ -58,8 +60,43 @@ def locate_cuda():
     return cudaconfig
 
 
+def has_openmp():
+    """Whether the C compiler can build and link an OpenMP program."""
+    import tempfile
+    import shutil
+    from distutils.ccompiler import new_compiler
+    from distutils.sysconfig import customize_compiler
+    from distutils.errors import CompileError, LinkError
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src = pjoin(tmp_dir, 'test_openmp.c')
+        with open(src, 'w') as f:
+            f.write('#include <omp.h>\n'
+                    'int main(void) { return omp_get_max_threads() < 1; }\n')
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        objs = compiler.compile([src], output_dir=tmp_dir,
+                                extra_postargs=['-fopenmp'])
+        compiler.link_executable(objs, pjoin(tmp_dir, 'test_openmp'),
+                                 extra_postargs=['-fopenmp'])
+        return True
+    except (CompileError, LinkError):
+        return False
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 CUDA = locate_cuda()
 
+# The box and cpu nms kernels run their loops on all cores with OpenMP,
+# and fall back to a serial build if the compiler does not support it
+if os.environ.get('TDID_NO_OPENMP') != '1' and has_openmp():
+    OPENMP_ARGS = ['-fopenmp']
+else:
+    print('OpenMP not available, building serial cython kernels')
+    OPENMP_ARGS = []
+
 # Obtain the numpy include directory.  This logic works across numpy versions.
 try:
     numpy_include = np.get_include()
@@ -117,33 +154,39 @@ ext_modules = [
     Extension(
         "anchors.cython_bbox",
         ["anchors/bbox.pyx"],
-        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"] +
+                                   OPENMP_ARGS},
+        extra_link_args=OPENMP_ARGS,
         include_dirs=[numpy_include]
     ),
     Extension(
         "nms.cpu_nms",
         ["nms/cpu_nms.pyx"],
-        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"] +
+                                   OPENMP_ARGS},
+        extra_link_args=OPENMP_ARGS,
         include_dirs=[numpy_include]
     ),
-    Extension('nms.gpu_nms',
-              ['nms/nms_kernel.cu', 'nms/gpu_nms.pyx'],
-              library_dirs=[CUDA['lib64']],
-              libraries=['cudart'],
-              language='c++',
-              runtime_library_dirs=[CUDA['lib64']],
-              # this syntax is specific to this build system
-              # we're only going to use certain compiler args with nvcc and not with gcc
-              # the implementation of this trick is in customize_compiler() below
-              extra_compile_args={'gcc': ["-Wno-unused-function"],
-                                  'nvcc': ['-arch=sm_35',
-                                           '--ptxas-options=-v',
-                                           '-c',
-                                           '--compiler-options',
-                                           "'-fPIC'"]},
-              include_dirs=[numpy_include, CUDA['include']]
-              ),
 ]
+if CUDA is not None:
+    ext_modules.append(
+        Extension('nms.gpu_nms',
+                  ['nms/nms_kernel.cu', 'nms/gpu_nms.pyx'],
+                  library_dirs=[CUDA['lib64']],
+                  libraries=['cudart'],
+                  language='c++',
+                  runtime_library_dirs=[CUDA['lib64']],
+                  # this syntax is specific to this build system
+                  # we're only going to use certain compiler args with nvcc and not with gcc
+                  # the implementation of this trick is in customize_compiler() below
+                  extra_compile_args={'gcc': ["-Wno-unused-function"],
+                                      'nvcc': ['-arch=sm_35',
+                                               '--ptxas-options=-v',
+                                               '-c',
+                                               '--compiler-options',
+                                               "'-fPIC'"]},
+                  include_dirs=[numpy_include, CUDA['include']]
+                  ))
 
 setup(
     name='tdid',
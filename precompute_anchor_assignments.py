@@ -0,0 +1,120 @@
+import torch
+import torch.utils.data
+import sys
+import importlib
+import numpy as np
+
+from model_defs.TDID import TDID
+from model_defs.anchors.anchor_grid import AnchorGrid
+from model_defs.anchors.anchor_assignment_cache import write_anchor_assignments
+from utils import *
+
+import active_vision_dataset_processing.data_loading.active_vision_dataset as AVD
+
+# load config
+cfg_file = 'configAVD1' #NO FILE EXTENSTION!
+cfg = importlib.import_module('configs.'+cfg_file)
+cfg = cfg.get_config()
+
+
+def training_boxes(cfg, dataset):
+    '''
+    Yields every gt box the training loop can give the anchor target layer
+
+    Boxes are scaled like in train_tdid.py, by 1 and, if images are ever
+    resized, by cfg.RESIZE_IMG_FACTOR.
+
+    Input parameters:
+        cfg: (Config)
+        dataset: AVD training set
+
+    Yields:
+        (tuple) ((rows, cols) of the scaled image, Nx4 float32 boxes)
+    '''
+    scales = [1]
+    if cfg.RESIZE_IMG > 0:
+        scales.append(cfg.RESIZE_IMG_FACTOR)
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=1,
+                                         num_workers=cfg.NUM_WORKERS,
+                                         collate_fn=AVD.collate)
+    for batch in loader:
+        im_data = batch[0]
+        #same dtype and math as train_tdid.py, so the keys match exactly
+        gt_boxes = np.asarray(batch[1][0],dtype=np.float32)
+        if gt_boxes.shape[0] == 0:
+            continue
+        gt_boxes = gt_boxes[gt_boxes[:,4] != 0]
+        for scale in scales:
+            boxes = gt_boxes[:,:4].copy()
+            img_size = im_data.shape[:2]
+            if scale != 1:
+                boxes *= scale
+                img_size = tuple(int(round(s*scale)) for s in img_size)
+            yield img_size, boxes
+
+
+def grids_and_boxes(cfg, net, dataset):
+    '''
+    Pairs each training box with the anchor grid of every image size it
+    may be padded to in a batch
+
+    Batches are padded to their largest image, so a box can be seen with
+    any image size of the training set that is at least as big as its own
+    image. Pairs that are not stored are just computed during training.
+
+    Input parameters:
+        cfg: (Config)
+        net: (TDID) only its feature net is used, to get feature map sizes
+        dataset: AVD training set
+
+    Yields:
+        (tuple) (AnchorGrid, Nx4 float32 boxes)
+    '''
+    boxes_by_size = {}
+    for img_size, boxes in training_boxes(cfg, dataset):
+        boxes_by_size.setdefault(img_size, []).append(boxes)
+    print('{} image sizes'.format(len(boxes_by_size)))
+
+    for img_size in boxes_by_size.keys():
+        #feature map size of the padded image
+        with torch.no_grad():
+            feats = net.features(torch.zeros(1, 3, img_size[0], img_size[1]))
+        height, width = feats.size()[2:4]
+        img_info = (img_size[0], img_size[1], 3)
+        anchor_grid = AnchorGrid(height, width, net._feat_stride,
+                                 net.anchor_scales, img_info)
+        for box_size, boxes in boxes_by_size.items():
+            if box_size[0] <= img_size[0] and box_size[1] <= img_size[1]:
+                yield anchor_grid, np.concatenate(boxes)
+
+
+if cfg.PYTORCH_FEATURE_NET:
+    target_images = get_target_images(cfg.TARGET_IMAGE_DIR,cfg.NAME_TO_ID.keys())
+else:
+    raise NotImplementedError
+train_ids = check_object_ids(cfg.TRAIN_OBJ_IDS, cfg.ID_TO_NAME,target_images)
+if train_ids==-1:
+    print('Invalid IDS!')
+    sys.exit()
+
+print('Setting up training data...')
+#every image, the boxes of images picked without a box are not needed
+train_set = get_AVD_dataset(cfg.AVD_ROOT_DIR,
+                            cfg.TRAIN_LIST,
+                            train_ids,
+                            max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
+                            fraction_of_no_box=0)
+
+net = TDID(cfg)
+net.eval()
+
+cache_dir = cfg.ANCHOR_ASSIGNMENT_CACHE_DIR
+if not cache_dir:
+    print('Set ANCHOR_ASSIGNMENT_CACHE_DIR in the config')
+    sys.exit()
+print('Computing anchor assignments...')
+path = write_anchor_assignments(cache_dir, cfg,
+                                grids_and_boxes(cfg, net, train_set),
+                                net._feat_stride)
+print('saved: {}'.format(path))
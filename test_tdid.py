@@ -8,13 +8,14 @@ import importlib
 import json
 
 from model_defs.TDID import TDID
-from model_defs.nms.nms_wrapper import nms
+from model_defs.nms.nms_wrapper import batched_nms
 from utils import * 
 
 import active_vision_dataset_processing.data_loading.active_vision_dataset as AVD  
 
 
-def im_detect(net, target_data,im_data, im_info, features_given=True):
+def im_detect(net, target_data,im_data, im_info, features_given=True,
+              score_thresh=None, max_dets=0, nms_thresh=None):
     """
     Detect single target object in a single scene image.
 
@@ -27,6 +28,9 @@ def im_detect(net, target_data,im_data, im_info, features_given=True):
         features_given(optional): (bool) if true, target_data and im_data
                                   are feature maps from net.features,
                                   not images. Default: True
+        score_thresh (optional): (float) passed to net.detect. Default: None
+        max_dets (optional): (int) passed to net.detect. Default: 0
+        nms_thresh (optional): (float) passed to net.detect. Default: None
                                     
 
     Returns:
@@ -36,15 +40,62 @@ def im_detect(net, target_data,im_data, im_info, features_given=True):
     """
 
     cls_prob, rois = net(target_data, im_data, im_info,
-                                    features_given=features_given)
-    scores = cls_prob.data.cpu().numpy()[0,:,:]
+                                    features_given=features_given,
+                                    score_thresh=score_thresh,
+                                    max_dets=max_dets,
+                                    nms_thresh=nms_thresh)
+    #skip padding
+    num_valid = net.num_valid_proposals[0]
+    scores = cls_prob.data.cpu().numpy()[0,:num_valid,:]
     zs = np.zeros((scores.size, 1))
     scores = np.concatenate((zs,scores),1)
-    boxes = rois.data.cpu().numpy()[0,:, :]
+    boxes = rois.data.cpu().numpy()[0,:num_valid, :]
 
     return scores, boxes
 
 
+def im_detect_targets(net, target_embeddings, img_features, im_info,
+                      score_thresh=None, max_dets=0, nms_thresh=None):
+    """
+    Detect several target objects in a single scene image with one pass.
+
+    Input Parameters:
+        net: (TDID) the network
+        target_embeddings: (tuple) embeddings of N targets, from
+                           net.stack_target_embeddings
+        img_features: (torch Variable) scene image feature map from
+                      net.features
+        im_info: (tuple) (height,width,channels) of the scene image
+
+        score_thresh (optional): (float) passed to net.detect. Default: None
+        max_dets (optional): (int) passed to net.detect. Default: 0
+        nms_thresh (optional): (float) passed to net.detect. Default: None
+
+    Returns:
+        all_scores (list): N arrays, each M x 2 array of class scores
+                           (M boxes, classes={background,target})
+        all_boxes (list): N arrays, each M x 4 array of predicted boxes
+    """
+
+    cls_prob, rois = net.detect(img_features, target_embeddings, im_info,
+                                score_thresh=score_thresh, max_dets=max_dets,
+                                nms_thresh=nms_thresh)
+    cls_prob = cls_prob.data.cpu().numpy()
+    rois = rois.data.cpu().numpy()
+    num_valid = net.num_valid_proposals.numpy()
+
+    all_scores = []
+    all_boxes = []
+    for target_ind in range(cls_prob.shape[0]):
+        #skip padding
+        scores = cls_prob[target_ind,:num_valid[target_ind],:]
+        zs = np.zeros((scores.size, 1))
+        all_scores.append(np.concatenate((zs,scores),1))
+        all_boxes.append(rois[target_ind,:num_valid[target_ind],:])
+
+    return all_scores, all_boxes
+
+
 def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
              max_dets_per_target=5, score_thresh=0.1,
              output_dir=None):
@@ -81,13 +132,43 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
             os.makedirs(output_dir)
         det_file = os.path.join(output_dir, model_name+'.json')
 
-    #load targets, maybe compute features
-    target_features_dict = {}
+    #boxes under score_thresh are dropped below, so the proposal layer can
+    #skip their anchors before decoding and nms. The proposal nms can also
+    #stop at max_dets_per_target if the nms below can not suppress any of
+    #the boxes it keeps
+    proposal_thresh = None
+    proposal_max_dets = 0
+    proposal_nms_thresh = None
+    if cfg.TEST_SINGLE_STAGE_POSTPROCESS:
+        #the proposals are the final detections: score threshold, one nms
+        #at the test threshold and the max_dets_per_target cut, all in the
+        #proposal layer. There is no second nms below
+        if score_thresh >= 0:
+            proposal_thresh = score_thresh
+        proposal_max_dets = max(0, max_dets_per_target)
+        proposal_nms_thresh = cfg.TEST_NMS_OVERLAP_THRESH
+    elif cfg.TEST_PROPOSAL_PREFILTER and score_thresh >= 0:
+        proposal_thresh = score_thresh
+        if (cfg.TEST_NMS_OVERLAP_THRESH >= cfg.NMS_THRESH and 
+                cfg.TEST_NMS_MODE == 'exact' and 
+                cfg.TEST_RESIZE_IMG_FACTOR <= 0 and 
+                cfg.TEST_RESIZE_BOXES_FACTOR <= 0):
+            proposal_max_dets = max(0, max_dets_per_target)
+
+    #proposal counts of this run, printed at the end
+    net.proposal_budget.reset()
+
+    #targets folded into the head weights skip the NUM_TARGETS*C channel
+    #corr/diff maps of every image
+    fold_targets = cfg.TEST_FOLD_TARGETS and cfg.CORR_WITH_POOLED
+
+    #load targets, maybe compute embeddings
+    target_ids = [t_id for t_id in chosen_ids 
+                  if id_to_name[t_id] != 'background']
+    target_embeddings_dict = {}
     target_data_dict = {}
-    for id_ind,t_id in enumerate(chosen_ids):
+    for t_id in target_ids:
         target_name = id_to_name[t_id]
-        if target_name == 'background':
-            continue
         target_data = []
         for t_type,_ in enumerate(target_images[target_name]):
             img_ind = np.random.choice(np.arange(
@@ -97,12 +178,14 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
             target_data.append(target_img)
 
         target_data = match_and_concat_images_list(target_data)
-        target_data = np_to_variable(target_data, is_cuda=True)
+        target_data = np_to_variable(target_data, device=net.device)
         target_data = target_data.permute(0, 3, 1, 2)
         if cfg.TEST_ONE_AT_A_TIME:
             target_data_dict[target_name] = target_data
         else:
-            target_features_dict[target_name] = net.features(target_data)
+            target_embeddings_dict[target_name] = net.encode_targets(
+                                                            target_data,
+                                                            fold=fold_targets)
 
     for i,batch in enumerate(dataloader):
         im_data= batch[0]
@@ -111,7 +194,7 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
         if cfg.TEST_RESIZE_IMG_FACTOR > 0:
             im_data = cv2.resize(im_data,(0,0),fx=cfg.TEST_RESIZE_IMG_FACTOR, fy=cfg.TEST_RESIZE_IMG_FACTOR)
         im_data = normalize_image(im_data,cfg)
-        im_data = np_to_variable(im_data, is_cuda=True)
+        im_data = np_to_variable(im_data, device=net.device)
         im_data = im_data.unsqueeze(0)
         im_data = im_data.permute(0, 3, 1, 2)
 
@@ -123,47 +206,83 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
         if not cfg.TEST_ONE_AT_A_TIME:
             img_features = net.features(im_data)
 
-        for id_ind,t_id in enumerate(chosen_ids):
-            target_name = id_to_name[t_id]
-            if target_name == 'background':
-                continue
-
-            if cfg.TEST_ONE_AT_A_TIME:
-                target_data = target_data_dict[target_name]
+        #detect every target, (target id, scores, boxes, detect time)
+        all_detections = []
+        if cfg.TEST_ONE_AT_A_TIME:
+            for t_id in target_ids:
+                target_data = target_data_dict[id_to_name[t_id]]
                 _t['im_detect'].tic()
                 scores, boxes = im_detect(net, target_data, im_data, im_info,
-                                          features_given=False)
+                                          features_given=False,
+                                          score_thresh=proposal_thresh,
+                                          max_dets=proposal_max_dets,
+                                          nms_thresh=proposal_nms_thresh)
                 detect_time = _t['im_detect'].toc(average=False)
+                all_detections.append((t_id, scores, boxes, detect_time))
+        else:
+            #full target feature maps can only be batched if same size
+            if cfg.TEST_TARGETS_IN_ONE_PASS and cfg.CORR_WITH_POOLED:
+                chunk_size = net.targets_per_batch(img_features,
+                                               cfg.TEST_TARGET_BATCH_MEMORY_MB,
+                                               folded=fold_targets)
             else:
-                target_features = target_features_dict[target_name]
+                chunk_size = 1
+            for start_ind in range(0, len(target_ids), chunk_size):
+                chunk_ids = target_ids[start_ind:start_ind+chunk_size]
+                target_embeddings = net.stack_target_embeddings(
+                                    [target_embeddings_dict[id_to_name[t_id]] 
+                                     for t_id in chunk_ids])
                 _t['im_detect'].tic()
-                scores, boxes = im_detect(net, target_features, img_features,
-                                          im_info, features_given=True)
-                detect_time = _t['im_detect'].toc(average=False)
-            _t['misc'].tic()
-
+                all_scores, all_boxes = im_detect_targets(net, 
+                                                          target_embeddings,
+                                                          img_features,
+                                                          im_info,
+                                                          proposal_thresh,
+                                                          proposal_max_dets,
+                                                          proposal_nms_thresh)
+                detect_time = (_t['im_detect'].toc(average=False) / 
+                               len(chunk_ids))
+                for t_id,scores,boxes in zip(chunk_ids,all_scores,all_boxes):
+                    all_detections.append((t_id, scores, boxes, detect_time))
+
+        #get scores for foreground, non maximum supression of every target
+        #in one call
+        _t['misc'].tic()
+        all_fg_dets = []
+        for t_id, scores, boxes, detect_time in all_detections:
             if cfg.TEST_RESIZE_IMG_FACTOR > 0:
                 boxes *= (1.0/cfg.TEST_RESIZE_IMG_FACTOR) 
             if cfg.TEST_RESIZE_BOXES_FACTOR > 0:
                 boxes *= cfg.TEST_RESIZE_BOXES_FACTOR
 
-            #get scores for foreground, non maximum supression
             inds = np.where(scores[:, 1] > score_thresh)[0]
             fg_scores = scores[inds, 1]
             fg_boxes = boxes[inds,:]
-            fg_dets = np.hstack((fg_boxes, fg_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(fg_dets, cfg.TEST_NMS_OVERLAP_THRESH)
-            fg_dets = fg_dets[keep, :]
-
-            # Limit to max_per_target detections *over all classes*
-            if max_dets_per_target > 0:
-                image_scores = np.hstack([fg_dets[:, -1]])
-                if len(image_scores) > max_dets_per_target:
-                    image_thresh = np.sort(image_scores)[-max_dets_per_target]
-                    keep = np.where(fg_dets[:, -1] >= image_thresh)[0]
-                    fg_dets = fg_dets[keep, :]
-            nms_time = _t['misc'].toc(average=False)
+            all_fg_dets.append(np.hstack((fg_boxes, fg_scores[:, np.newaxis]))
+                               .astype(np.float32, copy=False))
+        group_ids = np.repeat(np.arange(len(all_fg_dets)),
+                              [len(fg_dets) for fg_dets in all_fg_dets])
+        #no targets to detect leaves nothing to stack
+        all_fg_dets = np.vstack(all_fg_dets + 
+                                [np.zeros((0, 5), dtype=np.float32)])
+        if cfg.TEST_SINGLE_STAGE_POSTPROCESS:
+            #already the final detections
+            keep = np.arange(len(all_fg_dets))
+        else:
+            # Limit to max_per_target detections *over all classes*,
+            # nms stops once it has kept that many
+            keep = batched_nms(all_fg_dets, group_ids, 
+                               cfg.TEST_NMS_OVERLAP_THRESH,
+                               backend=cfg.NMS_BACKEND,
+                               max_keep=max(0, max_dets_per_target),
+                               mode=cfg.TEST_NMS_MODE)
+        num_keeps = np.bincount(group_ids[keep], 
+                                minlength=len(all_detections))
+        all_keep = np.split(keep, np.cumsum(num_keeps)[:-1])
+        nms_time = _t['misc'].toc(average=False) / max(1,len(all_detections))
+
+        for (t_id, _, _, detect_time), keep in zip(all_detections, all_keep):
+            fg_dets = all_fg_dets[keep, :]
 
             print( 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
                 .format(i + 1, num_images, detect_time, nms_time))
@@ -184,6 +303,7 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
                 org_img = cv2.rectangle(org_img, (box[0], box[1]), (box[2],box[3]), (255,0,0), 2)
 
         cv2.imwrite('./out_img.jpg', org_img)
+    print(net.proposal_budget.summary())
     if output_dir is not None:
         with open(det_file, 'w') as f:
             json.dump(results,f)
@@ -233,8 +353,11 @@ if __name__ == '__main__':
     net.features.eval()#freeze batchnorms layers?
     print('load model successfully!')
     
-    net.cuda()
+    device = get_device(cfg.DEVICE)
+    net.to(device)
     net.eval()
+    if device.type == 'cpu':
+        net.optimize_for_cpu_inference()
     
     # evaluation
     test_net(cfg.MODEL_BASE_SAVE_NAME, net, testloader, 
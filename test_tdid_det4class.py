@@ -56,7 +56,7 @@ def test_net(model_name, net, dataloader, id_to_name, target_images, chosen_ids,
             target_data.append(target_img)
 
         target_data = match_and_concat_images_list(target_data)
-        target_data = np_to_variable(target_data, is_cuda=True)
+        target_data = np_to_variable(target_data, device=net.device)
         target_data = target_data.permute(0, 3, 1, 2)
         if cfg.TEST_ONE_AT_A_TIME:
             target_data_dict[target_name] = target_data
@@ -73,7 +73,7 @@ def test_net(model_name, net, dataloader, id_to_name, target_images, chosen_ids,
         im_data= batch[0]
         im_info = im_data.shape[:]
         im_data=normalize_image(im_data,cfg)
-        im_data = np_to_variable(im_data, is_cuda=True)
+        im_data = np_to_variable(im_data, device=net.device)
         im_data = im_data.unsqueeze(0)
         im_data = im_data.permute(0, 3, 1, 2)
 
@@ -187,7 +187,7 @@ if __name__ == '__main__':
         net.features.eval()#freeze batchnorms layers?
         print('load model successfully!')
         
-        net.cuda()
+        net.to(get_device(cfg.DEVICE))
         net.eval()
         
         # evaluation
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+#the repo root, so tests import model_defs like the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ProposalConfig(object):
+    '''The proposal and anchor settings of configs/configAVD1.py'''
+    ANCHOR_SCALES = [1,2,4]
+    PRE_NMS_TOP_N = 6000
+    POST_NMS_TOP_N = 300
+    PROPOSAL_BUDGET_MODE = 'fixed'
+    PROPOSAL_BUDGET_REF_CELLS = 68*120
+    PROPOSAL_MIN_SCORE_FRACTION = .01
+    NMS_THRESH = .7
+    NMS_BACKEND = 'auto'
+    PROPOSAL_MIN_BOX_SIZE = 8
+    PROPOSAL_CLOBBER_POSITIVES = False
+    PROPOSAL_NEGATIVE_OVERLAP = .3
+    PROPOSAL_POSITIVE_OVERLAP = .6
+    PROPOSAL_FG_FRACTION = .5
+    PROPOSAL_BATCH_SIZE = 300
+
+
+@pytest.fixture
+def cfg():
+    '''(ProposalConfig) a fresh config, tests may change it'''
+    return ProposalConfig()
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('model_defs.anchors.cython_bbox')
+from model_defs.anchors.anchor_grid import AnchorGrid
+from model_defs.anchors.anchor_target_layer import anchor_target_layer
+from model_defs.anchors.anchor_target_layer_torch import \
+    anchor_target_layer as anchor_target_layer_torch
+from model_defs.anchors.bbox_transform import bbox_transform
+from model_defs.anchors.cython_bbox import bbox_overlaps
+
+FEAT_STRIDE = 16
+HEIGHT, WIDTH = 20, 30
+IMG_INFO = (HEIGHT*FEAT_STRIDE, WIDTH*FEAT_STRIDE, 1)
+#one gt box per batch element, the second is a dummy bg box
+GT_BOXES = np.array([[40, 60, 103, 123, 1],
+                     [0, 0, 1, 1, 0],
+                     [250, 20, 281, 67, 2],
+                     [100.5, 150, 140, 190.5, 3]], dtype=np.float32)
+
+
+def reference_targets(anchor_grid, gt_boxes, cfg):
+    '''
+    Labels of every inside anchor, one anchor at a time, without any
+    subsampling. Returns anchor inds, labels and fg bbox targets in the
+    order of the anchor target layers.
+    '''
+    anchors = anchor_grid.inside_anchors
+    all_anchor_inds, all_labels, all_bbox_targets = [], [], []
+    for batch_ind, gt_box in enumerate(gt_boxes):
+        labels = np.zeros(len(anchors), dtype=np.int64)
+        if gt_box[4] != 0:
+            overlaps = bbox_overlaps(anchors, gt_box[np.newaxis, :4])[:, 0]
+            gt_max_overlap = overlaps.max()
+            for pos, overlap in enumerate(overlaps):
+                fg = (overlap == gt_max_overlap or
+                      overlap >= cfg.PROPOSAL_POSITIVE_OVERLAP)
+                bg = overlap < cfg.PROPOSAL_NEGATIVE_OVERLAP
+                if bg and (cfg.PROPOSAL_CLOBBER_POSITIVES or not fg):
+                    labels[pos] = 0
+                elif fg:
+                    labels[pos] = 1
+                else:
+                    labels[pos] = -1
+        sampled = np.where(labels != -1)[0]
+        fg = sampled[labels[sampled] == 1]
+        all_anchor_inds.append(batch_ind*anchor_grid.num_anchors +
+                               anchor_grid.inds_inside[sampled])
+        all_labels.append(labels[sampled])
+        all_bbox_targets.append(bbox_transform(
+                                    anchors[fg].astype(np.float64),
+                                    np.tile(gt_box[:4], (len(fg), 1))))
+    return (np.concatenate(all_anchor_inds), np.concatenate(all_labels),
+            np.vstack(all_bbox_targets))
+
+
+@pytest.mark.parametrize('positive_overlap', [.6, .4])
+@pytest.mark.parametrize('clobber_positives', [False, True])
+@pytest.mark.parametrize('use_torch', [False, True])
+def test_anchor_targets_match_reference(cfg, use_torch, clobber_positives,
+                                        positive_overlap):
+    #large enough that nothing is subsampled
+    cfg.PROPOSAL_BATCH_SIZE = 10**7
+    cfg.PROPOSAL_CLOBBER_POSITIVES = clobber_positives
+    cfg.PROPOSAL_POSITIVE_OVERLAP = positive_overlap
+    num_anchors = 3*len(cfg.ANCHOR_SCALES)
+    cls_score = np.zeros((len(GT_BOXES), 2*num_anchors, HEIGHT, WIDTH),
+                         dtype=np.float32)
+
+    if use_torch:
+        outputs = anchor_target_layer_torch(torch.from_numpy(cls_score),
+                                            GT_BOXES, IMG_INFO, cfg,
+                                            FEAT_STRIDE, cfg.ANCHOR_SCALES)
+        outputs = [output.numpy() for output in outputs]
+    else:
+        outputs = anchor_target_layer(cls_score, GT_BOXES, IMG_INFO, cfg,
+                                      FEAT_STRIDE, cfg.ANCHOR_SCALES)
+    anchor_inds, labels, bbox_targets = outputs
+
+    anchor_grid = AnchorGrid(HEIGHT, WIDTH, FEAT_STRIDE, cfg.ANCHOR_SCALES,
+                             IMG_INFO)
+    ref_anchor_inds, ref_labels, ref_bbox_targets = reference_targets(
+                                                        anchor_grid,
+                                                        GT_BOXES, cfg)
+    np.testing.assert_array_equal(anchor_inds, ref_anchor_inds)
+    np.testing.assert_array_equal(labels, ref_labels)
+    assert bbox_targets.shape == ref_bbox_targets.shape
+    np.testing.assert_allclose(bbox_targets, ref_bbox_targets,
+                               rtol=1e-5, atol=1e-5)
+
+    #every fg element has some fg anchors, the dummy bg box has none
+    batch_inds = anchor_inds // anchor_grid.num_anchors
+    fg_elements = np.unique(batch_inds[labels == 1])
+    np.testing.assert_array_equal(fg_elements, [0, 2, 3])
+    assert (labels[batch_inds == 1] == 0).all()
+
+
+@pytest.mark.parametrize('use_torch', [False, True])
+def test_no_anchor_inside_the_image(cfg, use_torch):
+    #every anchor of a 2x2 map sticks out of a 4x4 image
+    img_info = (4, 4, 1)
+    num_anchors = 3*len(cfg.ANCHOR_SCALES)
+    cls_score = np.zeros((2, 2*num_anchors, 2, 2), dtype=np.float32)
+    gt_boxes = np.array([[0, 0, 3, 3, 1],
+                         [0, 0, 1, 1, 0]], dtype=np.float32)
+    assert len(AnchorGrid(2, 2, FEAT_STRIDE, cfg.ANCHOR_SCALES,
+                          img_info).inds_inside) == 0
+
+    if use_torch:
+        outputs = anchor_target_layer_torch(torch.from_numpy(cls_score),
+                                            gt_boxes, img_info, cfg,
+                                            FEAT_STRIDE, cfg.ANCHOR_SCALES)
+        outputs = [output.numpy() for output in outputs]
+    else:
+        outputs = anchor_target_layer(cls_score, gt_boxes, img_info, cfg,
+                                      FEAT_STRIDE, cfg.ANCHOR_SCALES)
+    anchor_inds, labels, bbox_targets = outputs
+    assert anchor_inds.shape == (0,) and anchor_inds.dtype == np.int64
+    assert labels.shape == (0,) and labels.dtype == np.int64
+    assert bbox_targets.shape == (0, 4) and bbox_targets.dtype == np.float32
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import torch
+
+from model_defs.nms.nms_wrapper import available_backends, batched_nms, nms
+from model_defs.nms.torch_nms import batched_torch_nms, torch_nms
+
+
+def random_dets(num_boxes, rng, num_scores=None):
+    '''
+    Nx5 float32 boxes and scores, clustered so that many boxes overlap.
+    With num_scores, scores only take that many values, so there are ties.
+    '''
+    centers = rng.randint(0, 3, size=(num_boxes, 2)) * 80 + 40
+    centers = centers + rng.randn(num_boxes, 2) * 5
+    sizes = rng.uniform(30, 50, size=(num_boxes, 2))
+    boxes = np.hstack((centers - sizes/2, centers + sizes/2))
+    if num_scores is None:
+        scores = rng.permutation(num_boxes) / float(num_boxes)
+    else:
+        scores = rng.randint(0, num_scores, size=num_boxes) / float(num_scores)
+    return np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32)
+
+
+def grouped_dets(rng, num_scores=None):
+    '''dets and group ids, groups 1 and 4 are empty'''
+    group_sizes = [30, 0, 1, 60, 0, 25]
+    group_ids = np.repeat(np.arange(len(group_sizes)), group_sizes)
+    order = rng.permutation(len(group_ids))
+    return random_dets(len(group_ids), rng, num_scores), group_ids[order]
+
+
+def per_group_nms(dets, group_ids, thresh, backend, max_keep=0):
+    '''nms of each group in turn, the reference for batched_nms'''
+    all_keep = []
+    for group_id in np.unique(group_ids):
+        inds = np.where(group_ids == group_id)[0]
+        keep = nms(dets[inds], thresh, backend=backend, max_keep=max_keep)
+        all_keep.append(inds[keep])
+    return np.concatenate(all_keep)
+
+
+@pytest.mark.parametrize('backend', ['gpu', 'torch', 'cpu', 'numpy'])
+@pytest.mark.parametrize('num_scores', [None, 4])
+@pytest.mark.parametrize('max_keep', [0, 3])
+def test_batched_nms_matches_per_group_nms(backend, num_scores, max_keep):
+    if backend not in available_backends():
+        pytest.skip('{} nms is not available'.format(backend))
+    if backend == 'gpu' and num_scores is not None:
+        pytest.skip('batched gpu nms may order tied scores differently')
+    rng = np.random.RandomState(0)
+    dets, group_ids = grouped_dets(rng, num_scores)
+
+    keep = batched_nms(dets, group_ids, .5, backend=backend,
+                       max_keep=max_keep)
+    expected = per_group_nms(dets, group_ids, .5, backend, max_keep)
+    assert keep.dtype == np.int64
+    np.testing.assert_array_equal(keep, expected)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs a gpu')
+@pytest.mark.parametrize('max_keep', [0, 3])
+def test_batched_torch_nms_gpu_matches_cpu(max_keep):
+    rng = np.random.RandomState(1)
+    dets, group_ids = grouped_dets(rng)
+    dets = torch.from_numpy(dets)
+    group_ids = torch.from_numpy(group_ids)
+
+    keep = batched_torch_nms(dets[:, :4], dets[:, 4], group_ids, .5,
+                             max_keep=max_keep)
+    gpu_keep = batched_torch_nms(dets[:, :4].cuda(), dets[:, 4].cuda(),
+                                 group_ids.cuda(), .5, max_keep=max_keep)
+    np.testing.assert_array_equal(gpu_keep.cpu().numpy(), keep.numpy())
+
+
+def test_batched_nms_without_boxes():
+    dets = np.zeros((0, 5), dtype=np.float32)
+    group_ids = np.zeros((0,), dtype=np.int64)
+    for mode in ['exact', 'matrix']:
+        assert len(batched_nms(dets, group_ids, .5, mode=mode)) == 0
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fast_nms_keeps_a_subset_of_greedy_nms(seed):
+    rng = np.random.RandomState(seed)
+    dets, group_ids = grouped_dets(rng)
+
+    keep = batched_nms(dets, group_ids, .5, force_cpu=True, mode='matrix')
+    greedy_keep = per_group_nms(dets, group_ids, .5, 'numpy')
+    assert len(np.unique(keep)) == len(keep)
+    assert set(keep.tolist()) <= set(greedy_keep.tolist())
+    #the top box of every group is always kept
+    for group_id in np.unique(group_ids):
+        inds = np.where(group_ids == group_id)[0]
+        assert inds[dets[inds, 4].argmax()] in keep
+    #grouped like the exact mode, highest score first
+    kept_groups = group_ids[keep]
+    assert (np.diff(kept_groups) >= 0).all()
+    for group_id in np.unique(kept_groups):
+        assert (np.diff(dets[keep[kept_groups == group_id], 4]) <= 0).all()
+
+
+def test_torch_nms_matches_numpy():
+    rng = np.random.RandomState(2)
+    dets = random_dets(200, rng)
+    keep = torch_nms(torch.from_numpy(dets[:, :4]),
+                     torch.from_numpy(dets[:, 4]), .5).numpy()
+    np.testing.assert_array_equal(keep, nms(dets, .5, backend='numpy'))
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('model_defs.anchors.cython_bbox')
+from model_defs.anchors.proposal_layer import proposal_layer
+from model_defs.anchors.proposal_layer_torch import \
+    proposal_layer as proposal_layer_torch
+
+FEAT_STRIDE = 16
+
+
+def random_outputs(batch_size, height, width, num_anchors, seed=0):
+    '''
+    Class probabilities and box deltas like the network outputs.
+
+    The fg scores of all anchors are distinct, so both layers rank the
+    anchors the same way.
+    '''
+    rng = np.random.RandomState(seed)
+    num_scores = batch_size*num_anchors*height*width
+    fg = (rng.permutation(num_scores) + 1) / float(num_scores + 1)
+    fg = fg.reshape((batch_size, num_anchors, height, width))
+    class_prob = np.concatenate((1 - fg, fg), axis=1).astype(np.float32)
+    bbox_pred = rng.randn(batch_size, 4*num_anchors, height, width) * .2
+    return class_prob, bbox_pred.astype(np.float32)
+
+
+@pytest.mark.parametrize('budget_mode', ['fixed', 'adaptive'])
+@pytest.mark.parametrize('score_thresh', [None, .5])
+def test_numpy_and_torch_layers_match(cfg, budget_mode, score_thresh):
+    cfg.PROPOSAL_BUDGET_MODE = budget_mode
+    cfg.PRE_NMS_TOP_N = 2000
+    height, width = 20, 30
+    img_info = (height*FEAT_STRIDE, width*FEAT_STRIDE, 1)
+    num_anchors = 3*len(cfg.ANCHOR_SCALES)
+    class_prob, bbox_pred = random_outputs(3, height, width, num_anchors)
+    #one element with a gt box, one with a dummy bg box
+    gt_boxes = np.array([[40, 60, 200, 180, 1],
+                         [0, 0, 1, 1, 0],
+                         [250, 20, 460, 300, 2]], dtype=np.float32)
+
+    np_out = proposal_layer(class_prob, bbox_pred, img_info, cfg,
+                            FEAT_STRIDE, cfg.ANCHOR_SCALES, gt_boxes=gt_boxes,
+                            score_thresh=score_thresh)
+    torch_out = proposal_layer_torch(torch.from_numpy(class_prob),
+                                     torch.from_numpy(bbox_pred), img_info,
+                                     cfg, FEAT_STRIDE, cfg.ANCHOR_SCALES,
+                                     gt_boxes=gt_boxes,
+                                     score_thresh=score_thresh)
+    proposals, scores, anchor_inds, labels, num_valid = np_out
+    t_proposals, t_scores, t_anchor_inds, t_labels, t_num_valid = [
+        out.numpy() for out in torch_out]
+
+    np.testing.assert_array_equal(num_valid, t_num_valid)
+    assert num_valid.min() > 0
+    assert proposals.shape == t_proposals.shape
+    np.testing.assert_array_equal(anchor_inds, t_anchor_inds)
+    np.testing.assert_array_equal(scores, t_scores)
+    #float32 exp is not rounded the same way by numpy and torch
+    np.testing.assert_allclose(proposals, t_proposals, rtol=0, atol=1e-3)
+    np.testing.assert_array_equal(labels, t_labels)
+    if score_thresh is not None:
+        for batch_ind, num_keep in enumerate(num_valid):
+            assert (scores[batch_ind, :num_keep] > score_thresh).all()
+
+
+def test_score_thresh_keeps_the_same_proposals(cfg):
+    height, width = 20, 30
+    img_info = (height*FEAT_STRIDE, width*FEAT_STRIDE, 1)
+    class_prob, bbox_pred = random_outputs(2, height, width,
+                                           3*len(cfg.ANCHOR_SCALES), seed=1)
+    proposals, scores, _, _, num_valid = proposal_layer(
+                                            class_prob, bbox_pred, img_info,
+                                            cfg, FEAT_STRIDE,
+                                            cfg.ANCHOR_SCALES)
+    t_proposals, t_scores, _, _, t_num_valid = proposal_layer(
+                                            class_prob, bbox_pred, img_info,
+                                            cfg, FEAT_STRIDE,
+                                            cfg.ANCHOR_SCALES,
+                                            score_thresh=.5)
+    #the thresholded proposals are the ones over the threshold without it
+    for batch_ind in range(2):
+        over = scores[batch_ind, :num_valid[batch_ind], 0] > .5
+        assert over.sum() == t_num_valid[batch_ind]
+        np.testing.assert_array_equal(
+            proposals[batch_ind, :num_valid[batch_ind]][over],
+            t_proposals[batch_ind, :t_num_valid[batch_ind]])
@@ -111,8 +111,9 @@ if not os.path.exists(cfg.SNAPSHOT_SAVE_DIR):
 if not os.path.exists(cfg.META_SAVE_DIR):
     os.makedirs(cfg.META_SAVE_DIR)
 
-#put net on gpu
-net.cuda()
+#put net on the gpu, or cfg.DEVICE
+device = get_device(cfg.DEVICE)
+net.to(device)
 net.train()
 
 #setup optimizer
@@ -202,22 +203,22 @@ for epoch in range(1,cfg.MAX_NUM_EPOCHS+1):
         im_data = match_and_concat_images_list(batch_im_data)
         gt_boxes = np.asarray(batch_gt_boxes) 
         im_info = im_data.shape[1:]
-        im_data = np_to_variable(im_data, is_cuda=True)
+        im_data = np_to_variable(im_data, device=device)
         im_data = im_data.permute(0, 3, 1, 2)
-        target_data = np_to_variable(target_data, is_cuda=True)
+        target_data = np_to_variable(target_data, device=device)
         target_data = target_data.permute(0, 3, 1, 2)
 
         # forward
         net(target_data, im_data, im_info, gt_boxes=gt_boxes)
- #       if cfg.USE_ROI_LOSS_ONLY:
- #           loss = net.roi_cross_entropy_loss
- #       else:
- #           loss = net.loss
-        loss = net.loss
+        if cfg.USE_ROI_LOSS_ONLY:
+            #makes the proposals if the forward pass skipped them
+            loss = net.roi_cross_entropy_loss
+        else:
+            loss = net.loss
 
-        train_loss += loss.data[0]
+        train_loss += loss.item()
         epoch_step_cnt += 1
-        epoch_loss += loss.data[0]
+        epoch_loss += loss.item()
 
         # backprop and parameter update
         optimizer.zero_grad()
@@ -233,7 +234,7 @@ for epoch in range(1,cfg.MAX_NUM_EPOCHS+1):
             log_text = 'step %d, epoch_avg_loss: %.4f, fps: %.2f (%.2fs per batch) ' \
                        'epoch:%d loss: %.4f tot_avg_loss: %.4f %s' % (
                 step,  epoch_loss/epoch_step_cnt, fps, 1./fps, 
-                epoch, loss.data[0],train_loss/(step+1), cfg.MODEL_BASE_SAVE_NAME)
+                epoch, loss.item(),train_loss/(step+1), cfg.MODEL_BASE_SAVE_NAME)
             print(log_text)
             print(target_use_cnt)
 
@@ -460,6 +460,44 @@ class FC(nn.Module):
         return x
 
 
+class CPUFeatureNet(nn.Module):
+    '''
+        A feature net prepared for inference on the cpu. 
+
+        Runs the net in channels last layout, which the oneDNN convs of 
+        torch are fastest with, and can freeze it with torch.jit, which 
+        folds batchnorms into the convs and pre-packs the conv weights. 
+        Inputs and outputs are normal (contiguous) tensors. Can not be 
+        trained, and a frozen net has no state_dict entries.
+
+        Input parameters:
+            features: (nn.Module) feature net, moved to the cpu and eval mode
+
+            channels_last (optional): (bool) Default: True
+            prepack (optional): (bool) freeze with pre-packed weights. 
+                                Default: True
+    '''
+    def __init__(self, features, channels_last=True, prepack=True):
+        super(CPUFeatureNet, self).__init__()
+        self.memory_format = torch.contiguous_format
+        if channels_last:
+            self.memory_format = torch.channels_last
+        features = features.cpu().eval().to(memory_format=self.memory_format)
+        if prepack:
+            #the traced net has no size dependent logic, so any input size
+            #can be used to trace it
+            example = torch.zeros(1, 3, 64, 64).contiguous(
+                                            memory_format=self.memory_format)
+            with torch.no_grad():
+                features = torch.jit.optimize_for_inference(torch.jit.freeze(
+                                        torch.jit.trace(features, example)))
+        self.features = features
+
+    def forward(self, x):
+        x = x.contiguous(memory_format=self.memory_format)
+        return self.features(x).contiguous()
+
+
 def save_net(fname, net):
     '''
     Saves a network using h5py
@@ -487,7 +525,8 @@ def load_net(fname, net):
         v.copy_(param)
 
 
-def np_to_variable(np_var, is_cuda=True, dtype=torch.FloatTensor):
+def np_to_variable(np_var, is_cuda=True, dtype=torch.FloatTensor, 
+                   device=None):
     '''
     Converts numpy array to pytorch Variable
 
@@ -498,16 +537,140 @@ def np_to_variable(np_var, is_cuda=True, dtype=torch.FloatTensor):
                            applied. If false nothing happens. Default: True
         dtype (optional):  (type) desired type of returned torch variable.
                             Default: torch.FloatTensor
+        device (optional): (torch.device or str) If not None, the variable
+                           is put on this device and is_cuda is ignored.
+                           Default: None
 
     Returns:
         (torch.autograd.Variable) a torch variable version of the np_var
     '''
     pytorch_var = Variable(torch.from_numpy(np_var).type(dtype))
-    if is_cuda:
+    if device is not None:
+        pytorch_var = pytorch_var.to(device)
+    elif is_cuda:
         pytorch_var = pytorch_var.cuda()
     return pytorch_var 
 
 
+def get_device(name='auto'):
+    '''
+    The torch device to run on
+
+    Input parameters:
+        name (optional): (str) 'auto' for the gpu if there is one, else the
+                         cpu, or any torch device name ('cuda', 'cuda:1',
+                         'cpu'). Default: 'auto'
+
+    Returns:
+        (torch.device)
+    '''
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(name)
+
+
+def set_cpu_threads(intra_op_threads=0, inter_op_threads=0):
+    '''
+    Set the number of threads torch uses on the cpu
+
+    Input parameters:
+        intra_op_threads (optional): (int) threads inside one op (convs, 
+                                     matmuls), 0 to leave torch's default.
+                                     Default: 0
+        inter_op_threads (optional): (int) threads running independent ops 
+                                     at once, 0 to leave torch's default. 
+                                     Torch only allows setting it before any
+                                     parallel work started. Default: 0
+    '''
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0 and torch.get_num_interop_threads() != inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            print('Can not set inter op threads after parallel work started, '
+                  'using {}'.format(torch.get_num_interop_threads()))
+
+
+class TransferCounter(object):
+    '''
+    Counts the host/device data movement of the torch ops run in a with block
+
+    Ex) with TransferCounter() as counter:
+            net(target_data, img_data, img_info)
+        print(counter)
+
+    Counts are:
+        host_tensors: tensors made from host data (torch.tensor, new_tensor,
+                      from_numpy, np_to_variable), an upload each when the
+                      model runs on a gpu
+        host_to_device: copies from the cpu to another device
+        device_to_host: copies from another device to the cpu
+        syncs: device values read by the host (.item())
+
+    Ops outside of torch (e.g. .tolist()) are not seen. Needs
+    torch.utils._python_dispatch (pytorch >= 1.13).
+    '''
+
+    def __init__(self):
+        self.reset()
+        self._mode = None
+
+    def reset(self):
+        self.host_tensors = 0
+        self.host_to_device = 0
+        self.device_to_host = 0
+        self.syncs = 0
+
+    @property
+    def total(self):
+        '''(int) every counted transfer'''
+        return (self.host_tensors + self.host_to_device + 
+                self.device_to_host + self.syncs)
+
+    def __enter__(self):
+        from torch.utils._python_dispatch import TorchDispatchMode
+        counter = self
+
+        class _CountingMode(TorchDispatchMode):
+            def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+                kwargs = kwargs or {}
+                counter._count(func, args, kwargs)
+                return func(*args, **kwargs)
+
+        self._mode = _CountingMode()
+        self._mode.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._mode.__exit__(*exc)
+        self._mode = None
+        return False
+
+    def _count(self, func, args, kwargs):
+        name = func.overloadpacket.__name__
+        if name == 'lift_fresh':
+            self.host_tensors += 1
+        elif name == '_local_scalar_dense':
+            self.syncs += 1
+        elif name in ('_to_copy', 'copy_'):
+            if name == '_to_copy':
+                src, dst = args[0].device, kwargs.get('device')
+            else:
+                src, dst = args[1].device, args[0].device
+            if dst is None or src == dst:
+                return
+            if src.type == 'cpu':
+                self.host_to_device += 1
+            elif dst.type == 'cpu':
+                self.device_to_host += 1
+
+    def __str__(self):
+        return ('{} host tensors, {} host to device, {} device to host, '
+                '{} syncs').format(self.host_tensors, self.host_to_device,
+                                   self.device_to_host, self.syncs)
+
+
 def weights_normal_init(model, dev=0.01):
     '''
     Initialize weights of model randomly according to a normal distribution